@@ -1,21 +1,46 @@
-import copy
+import hashlib
 import itertools
 import logging
 import os
 
+from google.appengine.api import memcache
 from google.appengine.ext.webapp import RequestHandler
 
 from .gae_bingo import choose_alternative, delete_experiment, resume_experiment
-from .gae_bingo import archive_experiment, modulo_choose, ExperimentController
-from .models import _GAEBingoExperimentNotes
+from .gae_bingo import archive_experiment, ExperimentController
+from .models import AlternativeView, _GAEBingoExperimentNotes
 from .cache import BingoCache
-from .stats import describe_result_in_words
+from .stats import describe_result_in_words, analyze_alternatives
+from .summary import experiments_from_cache, summary_context
 from .config import config
 from .jsonify import jsonify
 from .plots import get_experiment_timeline_data
 from .identity import can_control_experiments, identity
+import archives
+import assignments
+import bayes
 import instance_cache
+import journal
+import persist_telemetry
 import request_cache
+import sequential
+import snapshots
+import summary
+import synchronized_counter
+
+def etag_matches(etag, if_none_match):
+    """True if an If-None-Match header lists etag, or is "*".
+
+    If-None-Match uses weak comparison, so W/"x" matches "x".
+    """
+    for token in (if_none_match or "").split(","):
+        token = token.strip()
+        if token.startswith("W/"):
+            token = token[2:]
+        if token == "*" or token == etag:
+            return True
+    return False
+
 
 class GAEBingoAPIRequestHandler(RequestHandler):
     """Request handler for all GAE/Bingo API requests.
@@ -30,65 +55,84 @@ class GAEBingoAPIRequestHandler(RequestHandler):
         """True if request is interacting with archived data."""
         return self.request.get("archives") == "1"
 
+    def write_json(self, data):
+        """Write data as the JSON response, indented only if ?pretty=1."""
+        self.response.headers["Content-Type"] = "application/json"
+        self.response.out.write(jsonify(data,
+                compact=self.request.get("pretty") != "1"))
+
+    def respond_not_modified(self, counter_keys=()):
+        """Tag the response w/ the current data version, and if the client
+        already has it, respond 304 Not Modified.
+
+        The version changes whenever the shared BingoCache is written to
+        memcache, which includes every persist of new counts, whenever the
+        summary is refreshed, and whenever a snapshot is taken. Responses that include memcache's running counts
+        pass their counter keys, so the version changes w/ them too. Call
+        this before loading anything else so an unchanged poll stays cheap.
+
+        Args:
+            counter_keys: synchronized counter keys whose running counts the
+                response includes
+        Returns:
+            True if the handler shouldn't write a response.
+        """
+        generation = BingoCache.generation()
+        if generation is None:
+            return False
+
+        etag = "%s-%s" % (generation, snapshots.last_tick())
+        if counter_keys:
+            running_counts = memcache.get_multi(list(counter_keys))
+            etag += "-" + hashlib.md5(
+                    repr(sorted(running_counts.items()))).hexdigest()[:12]
+        etag = '"%s"' % etag
+
+        self.response.headers["ETag"] = etag
+        self.response.headers["Cache-Control"] = "private, no-cache"
+
+        if etag_matches(etag, self.request.headers.get("If-None-Match")):
+            self.response.set_status(304)
+            return True
+        return False
+
+    @staticmethod
+    def running_counter_keys(bingo_cache, expt_names):
+        """Counter keys of the running counts shown w/ these experiments."""
+        alternatives = []
+        for expt_name in expt_names:
+            alternatives.extend(bingo_cache.get_alternatives(expt_name))
+        return AlternativeView.counter_keys(alternatives)
+
     def flush_in_app_caches(self):
         """Flush in-app request and instance caches of gae/bingo state."""
         request_cache.flush_request_cache()
         instance_cache.flush()
 
-    def request_bingo_cache(self):
+    def request_bingo_cache(self, canonical_names=(), experiment_names=()):
         """Return BingoCache object for live/archived data, as appropriate.
 
         A BingoCache obect acts as the datastore for experiments and
         alternatives for the length of an API request. If loaded from archives,
         the experiments will be inactive and read-only unless permanently
         deleting them.
+
+        Archived experiments are only loaded if they have one of the given
+        canonical names or names. Every archived experiment is loaded if
+        neither are given.
         """
         # Flush in-app caches so we load the latest shared experiment state
         self.flush_in_app_caches()
 
         if self.is_requesting_archives():
+            if canonical_names or experiment_names:
+                return archives.load_bingo_cache(canonical_names,
+                                                 experiment_names)
             return BingoCache.load_from_datastore(archives=True)
         else:
             return BingoCache.get()
 
 
-def experiments_from_cache(bingo_cache, requesting_archives):
-    """Retrieve experiments data for consumption via the API.
-
-    Arguments:
-        bingo_cache - the cache where the data is to be retrieved from
-        requesting_archives - whether or not archived experiments should be
-            returned or non-archived experiments
-    """
-    experiment_results = {}
-
-    for canonical_name in bingo_cache.experiment_names_by_canonical_name:
-        experiments, alternative_lists = bingo_cache.experiments_and_alternatives_from_canonical_name(canonical_name)
-
-        if not experiments or not alternative_lists:
-            continue
-
-        for experiment, alternatives in itertools.izip(
-                experiments, alternative_lists):
-
-            # Combine related experiments and alternatives into a single
-            # canonical experiment for response
-            if experiment.canonical_name not in experiment_results:
-                experiment.alternatives = alternatives
-                experiment_results[experiment.canonical_name] = experiment
-
-    # Sort by status primarily, then name or date
-    results = experiment_results.values()
-
-    if requesting_archives:
-        results.sort(key=lambda ex: ex.dt_started, reverse=True)
-    else:
-        results.sort(key=lambda ex: ex.pretty_canonical_name)
-
-    results.sort(key=lambda ex: ex.live, reverse=True)
-    return results
-
-
 class Experiments(GAEBingoAPIRequestHandler):
 
     def get(self):
@@ -96,13 +140,30 @@ class Experiments(GAEBingoAPIRequestHandler):
         if not can_control_experiments():
             return
 
+        if self.respond_not_modified():
+            return
+
+        if not self.is_requesting_archives():
+            stored_summary = summary.load()
+            if stored_summary and summary.is_current(stored_summary,
+                                                     BingoCache.get()):
+                self.write_json({"experiment_results":
+                                 stored_summary["experiment_results"]})
+                return
+        elif not archives.needs_index():
+            # Archives are listed the old way until their index is complete
+            cursor = self.request.get("cursor")
+            entries, next_cursor = archives.list_archived(cursor or None)
+            self.write_json({"experiment_results": entries,
+                             "cursor": next_cursor})
+            return
+
         bingo_cache = self.request_bingo_cache()
         results = experiments_from_cache(
                 bingo_cache, self.is_requesting_archives())
         context = { "experiment_results": results }
 
-        self.response.headers["Content-Type"] = "application/json"
-        self.response.out.write(jsonify(context))
+        self.write_json(context)
 
 class ExperimentSummary(GAEBingoAPIRequestHandler):
 
@@ -111,61 +172,27 @@ class ExperimentSummary(GAEBingoAPIRequestHandler):
         if not can_control_experiments():
             return
 
-        bingo_cache = self.request_bingo_cache()
+        if self.respond_not_modified():
+            return
+
         canonical_name = self.request.get("canonical_name")
+
+        if not self.is_requesting_archives():
+            stored_summary = summary.load()
+            if stored_summary and canonical_name in stored_summary["summaries"]:
+                self.write_json(stored_summary["summaries"][canonical_name])
+                return
+
+        bingo_cache = self.request_bingo_cache(canonical_names=[canonical_name])
         experiments, alternatives = bingo_cache.experiments_and_alternatives_from_canonical_name(canonical_name)
 
         if not experiments:
             raise Exception("No experiments matching canonical name: %s" % canonical_name)
 
-        context = {}
-        prev = None
-        prev_dict = {}
-
         experiment_notes = _GAEBingoExperimentNotes.get_for_experiment(experiments[0])
-        if experiment_notes:
-            context["notes"] = experiment_notes.notes
-            context["emotions"] = experiment_notes.emotions
-
-        experiments = sorted(experiments, key=lambda experiment: experiment.conversion_name)
-        for experiment in experiments:
-            if "canonical_name" not in context:
-                context["canonical_name"] = experiment.canonical_name
-
-            if "live" not in context:
-                context["live"] = experiment.live
-
-            if "multiple_experiments" not in context:
-                context["multiple_experiments"] = len(experiments) > 1
-
-            if "experiments" not in context:
-                context["experiments"] = []
-
-            exp_dict = {
-                "conversion_name": experiment.conversion_name,
-                "experiment_name": experiment.name,
-                "pretty_conversion_name": experiment.pretty_conversion_name,
-                "archived": experiment.archived,
-            }
-
-            if prev and prev.conversion_group == experiment.conversion_group:
-                if "conversion_group" not in prev_dict:
-                    prev_dict["start_conversion_group"] = True
-                    prev_dict["conversion_group"] = prev.conversion_group
-                exp_dict["conversion_group"] = experiment.conversion_group
-            else:
-                if "conversion_group" in prev_dict:
-                    prev_dict["end_conversion_group"] = True
-
-            context["experiments"].append(exp_dict)
-            prev_dict = exp_dict
-            prev = experiment
-
-        if "conversion_group" in prev_dict:
-            prev_dict["end_conversion_group"] = True
+        context = summary_context(experiments, experiment_notes)
 
-        self.response.headers["Content-Type"] = "application/json"
-        self.response.out.write(jsonify(context))
+        self.write_json(context)
 
 class ExperimentConversions(GAEBingoAPIRequestHandler):
 
@@ -173,48 +200,133 @@ class ExperimentConversions(GAEBingoAPIRequestHandler):
         if not can_control_experiments():
             return
 
-        bingo_cache = self.request_bingo_cache()
         expt_name = self.request.get("experiment_name")
+        bingo_cache = self.request_bingo_cache(experiment_names=[expt_name])
+
+        if self.respond_not_modified(
+                self.running_counter_keys(bingo_cache, [expt_name])):
+            return
 
         data = self.get_context(bingo_cache, expt_name)
 
-        self.response.headers["Content-Type"] = "application/json"
-        self.response.out.write(jsonify(data))
+        self.write_json(data)
 
     @staticmethod
     def get_context(bingo_cache, expt_name):
-        expt = bingo_cache.get_experiment(expt_name)
-        alts = bingo_cache.get_alternatives(expt_name)
-        if not expt or not alts:
-            raise Exception("No experiment matching name: %s" % expt_name)
-
-        short_circuit_number = -1
-
-        # Make a deep copy of these alternatives so we can modify their
-        # participants and conversion counts below for an up-to-date dashboard
-        # without impacting counts in shared memory.
-        alts = copy.deepcopy(alts)
-        for alt in alts:
-            if not expt.live and expt.short_circuit_content == alt.content:
-                short_circuit_number = alt.number
-
-            # Load the latest alternative counts into these copies of
-            # alternative models for up-to-date dashboard counts.
-            alt.participants = alt.latest_participants_count()
-            alt.conversions = alt.latest_conversions_count()
-
-        return {
-            "canonical_name": expt.canonical_name,
-            "hashable_name": expt.hashable_name,
-            "live": expt.live,
-            "total_participants": sum(a.participants for a in alts),
-            "total_conversions": sum(a.conversions for a in alts),
-            "alternatives": alts,
-            "significance_test_results": describe_result_in_words(alts),
-            "y_axis_title": expt.y_axis_title,
-            "timeline_series": get_experiment_timeline_data(expt, alts),
-            "short_circuit_number": short_circuit_number
-        }
+        return ExperimentConversions.get_contexts(bingo_cache, [expt_name])[0]
+
+    @staticmethod
+    def get_contexts(bingo_cache, expt_names):
+        """get_context for many experiments, sharing each kind of load.
+
+        Every alternative's latest counts come from one memcache get, all
+        timelines from another (w/ the queries of any that aren't cached
+        running in parallel), and sequential test state from one datastore
+        get.
+        """
+        experiments = []
+        cached_alternative_lists = []
+        for expt_name in expt_names:
+            expt = bingo_cache.get_experiment(expt_name)
+            alts = bingo_cache.get_alternatives(expt_name)
+            if not expt or not alts:
+                raise Exception("No experiment matching name: %s" % expt_name)
+
+            experiments.append(expt)
+            cached_alternative_lists.append(alts)
+
+        # Overlay the latest counts on views of the cached alternatives for
+        # an up-to-date dashboard without impacting counts in shared memory.
+        running_counts = synchronized_counter.SynchronizedCounter.get_multi(
+                list(AlternativeView.counter_keys(
+                    itertools.chain(*cached_alternative_lists))))
+        alternative_lists = [[AlternativeView(alt, running_counts)
+                              for alt in alts]
+                             for alts in cached_alternative_lists]
+
+        experiments_and_alternatives = zip(experiments, alternative_lists)
+        analyses = analyze_alternatives(
+                alternative_lists,
+                [expt.conversion_type for expt in experiments])
+        sequential_tests = sequential.summarize_experiments(
+                experiments_and_alternatives)
+        bayesian_summaries = bayes.summarize_experiments(
+                experiments_and_alternatives)
+        samples_list = snapshots.cached_samples_multi(experiments)
+
+        contexts = []
+        for expt, alts, analysis, sequential_test, bayesian, samples in (
+                itertools.izip(experiments, alternative_lists, analyses,
+                               sequential_tests, bayesian_summaries,
+                               samples_list)):
+            short_circuit_number = -1
+            if not expt.live:
+                short_circuit_content = expt.short_circuit_content
+                for alt in alts:
+                    if short_circuit_content == alt.content:
+                        short_circuit_number = alt.number
+
+            contexts.append({
+                "canonical_name": expt.canonical_name,
+                "experiment_name": expt.name,
+                "hashable_name": expt.hashable_name,
+                "live": expt.live,
+                "total_participants": sum(a.participants for a in alts),
+                "total_conversions": sum(a.conversions for a in alts),
+                "alternatives": alts,
+                "significance_test_results": describe_result_in_words(
+                    alts, expt.conversion_type),
+                "analysis": analysis,
+                "sequential_test": sequential_test,
+                "bayesian": bayesian,
+                "y_axis_title": expt.y_axis_title,
+                "timeline_series": get_experiment_timeline_data(
+                    expt, alts, samples),
+                "short_circuit_number": short_circuit_number
+            })
+        return contexts
+
+class ExperimentConversionsBatch(GAEBingoAPIRequestHandler):
+    """Conversion data of every experiment w/ the given canonical names.
+
+    Takes one or more canonical_name params and responds w/ a map of each
+    canonical name to ExperimentConversions' data for each of its
+    experiments, all loaded together by ExperimentConversions.get_contexts.
+    """
+
+    def get(self):
+        if not can_control_experiments():
+            return
+
+        canonical_names = self.request.get_all("canonical_name")
+        bingo_cache = self.request_bingo_cache(canonical_names=canonical_names)
+
+        expt_names_by_canonical_name = []
+        for canonical_name in canonical_names:
+            expt_names = bingo_cache.get_experiment_names_by_canonical_name(
+                    canonical_name)
+            if not expt_names:
+                raise Exception("No experiments matching canonical name: %s"
+                                % canonical_name)
+            expt_names_by_canonical_name.append((canonical_name, expt_names))
+        all_expt_names = [expt_name
+                          for _, expt_names in expt_names_by_canonical_name
+                          for expt_name in expt_names]
+
+        if self.respond_not_modified(
+                self.running_counter_keys(bingo_cache, all_expt_names)):
+            return
+
+        contexts = ExperimentConversions.get_contexts(bingo_cache,
+                                                      all_expt_names)
+
+        data = {}
+        start = 0
+        for canonical_name, expt_names in expt_names_by_canonical_name:
+            data[canonical_name] = contexts[start:start + len(expt_names)]
+            start += len(expt_names)
+
+        self.write_json(data)
 
 class ControlExperiment(GAEBingoAPIRequestHandler):
 
@@ -250,8 +362,13 @@ class ControlExperiment(GAEBingoAPIRequestHandler):
             elif action == "archive":
                 archive_experiment(canonical_name)
 
-        self.response.headers["Content-Type"] = "application/json"
-        self.response.out.write(jsonify(True))
+        if not self.is_requesting_archives():
+            summary.refresh(BingoCache.get())
+        else:
+            # Deleting archives doesn't touch the shared BingoCache
+            BingoCache.bump_generation()
+
+        self.write_json(True)
 
 class NoteExperiment(GAEBingoAPIRequestHandler):
     """Request handler for saving experiments' notes and list of emotions."""
@@ -261,8 +378,8 @@ class NoteExperiment(GAEBingoAPIRequestHandler):
         if not can_control_experiments():
             return
 
-        bingo_cache = self.request_bingo_cache()
         canonical_name = self.request.get("canonical_name")
+        bingo_cache = self.request_bingo_cache(canonical_names=[canonical_name])
         experiments, alternative_lists = bingo_cache.experiments_and_alternatives_from_canonical_name(canonical_name)
 
         if not experiments:
@@ -273,8 +390,14 @@ class NoteExperiment(GAEBingoAPIRequestHandler):
 
         _GAEBingoExperimentNotes.save(experiments[0], notes, emotions)
 
-        self.response.headers["Content-Type"] = "application/json"
-        self.response.out.write(jsonify(True))
+        # Notes are part of live experiments' summaries, and refreshing the
+        # summary bumps the generation once it's stored
+        if not self.is_requesting_archives():
+            summary.refresh(bingo_cache)
+        else:
+            BingoCache.bump_generation()
+
+        self.write_json(True)
 
 class Alternatives(GAEBingoAPIRequestHandler):
 
@@ -294,20 +417,39 @@ class Alternatives(GAEBingoAPIRequestHandler):
 
         bingo_cache = self.request_bingo_cache()
 
-        chosen_alternatives = {}
-
-        for experiment_name in bingo_cache.experiments:
-            experiment = bingo_cache.get_experiment(experiment_name)
-
-            if experiment.canonical_name not in chosen_alternatives:
-                alternatives = bingo_cache.get_alternatives(experiment_name)
-                alternative = modulo_choose(experiment, alternatives, id)
-                chosen_alternatives[experiment.canonical_name] = str(alternative.content)
+        chosen_alternatives = dict(
+                (canonical_name, str(content)) for canonical_name, content
+                in assignments.for_identity(id, bingo_cache).iteritems())
 
         context = {
             "identity": id,
             "alternatives": chosen_alternatives,
         }
 
-        self.response.headers["Content-Type"] = "application/json"
-        self.response.out.write(jsonify(context))
+        self.write_json(context)
+
+class JournalReconciliation(GAEBingoAPIRequestHandler):
+    """Report memcache vs. durable journal totals for each counter."""
+
+    def get(self):
+
+        if not can_control_experiments():
+            return
+
+        context = {
+            "journal_enabled": journal.is_enabled(),
+            "report": journal.reconciliation_report(),
+        }
+
+        self.write_json(context)
+
+
+class PersistStatus(GAEBingoAPIRequestHandler):
+    """Report recent persist runs' timings and whether persists are lagging."""
+
+    def get(self):
+
+        if not can_control_experiments():
+            return
+
+        self.write_json(persist_telemetry.status())
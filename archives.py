@@ -0,0 +1,247 @@
+"""An index of archived experiments, so the archives don't need loading whole.
+
+Archived experiments never change, but there's one for every experiment ever
+archived, so loading every archived experiment and alternative into a
+BingoCache just to list them gets slower and hungrier every year. Instead,
+archiving a canonical experiment adds a _GAEBingoArchivedExperiment entry to
+an index w/ its name, dates and totals. The dashboard lists archives a page
+of entries at a time, newest first, w/ a query cursor, and an archived
+experiment's experiments and alternatives are only loaded (by
+load_bingo_cache) once it's opened.
+
+Experiments archived before the index existed are indexed by rebuild_index,
+which is queued the first time the archives are listed w/out a complete
+index. Until it's done and has marked the index complete, the archives are
+listed the old way.
+"""
+import logging
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+
+from .cache import BingoCache
+from .models import _GAEBingoAlternative, _GAEBingoArchivedExperiment
+from .models import _GAEBingoArchiveIndexState, _GAEBingoExperiment
+from config import config
+
+# Archived experiments are listed this many at a time
+PAGE_SIZE = 50
+
+# rebuild_index indexes this many archived experiments at a time, and
+# re-queues itself after working for this long
+REBUILD_BATCH_SIZE = 100
+REBUILD_SECONDS = 5 * 60
+
+INDEX_COMPLETE_KEY = "_gae_bingo_archive_index_complete"
+
+
+def entry_for(experiments, alternative_lists):
+    """Return the index entry of a canonical experiment's archived experiments.
+
+    Like the list of live experiments, totals are those of the first
+    experiment (by name) sharing the canonical name.
+    """
+    pairs = sorted([(experiment, alternatives) for experiment, alternatives
+                    in zip(experiments, alternative_lists) if experiment],
+                   key=lambda pair: pair[0].name)
+    experiment, alternatives = pairs[0]
+
+    return _GAEBingoArchivedExperiment(
+            key_name=experiment.canonical_name,
+            canonical_name=experiment.canonical_name,
+            experiment_names=[ex.name for ex, _ in pairs],
+            dt_started=experiment.dt_started,
+            total_participants=sum(alt.participants for alt in alternatives),
+            total_conversions=sum(alt.conversions for alt in alternatives))
+
+
+def add_to_index(experiments, alternative_lists):
+    """Index a canonical experiment's newly archived experiments.
+
+    A canonical name can be reused once it's been archived, so this merges
+    w/ any entry already indexed under it rather than replacing it.
+    """
+    if not any(experiments):
+        return
+
+    entry = entry_for(experiments, alternative_lists)
+
+    def txn():
+        existing = _GAEBingoArchivedExperiment.get_by_key_name(
+                entry.key().name())
+        if existing:
+            experiment_names = sorted(set(existing.experiment_names) |
+                                      set(entry.experiment_names))
+            if experiment_names[0] not in entry.experiment_names:
+                # Totals are the first experiment's, which is already indexed
+                entry.dt_started = existing.dt_started
+                entry.total_participants = existing.total_participants
+                entry.total_conversions = existing.total_conversions
+            entry.experiment_names = experiment_names
+        entry.put()
+
+    db.run_in_transaction(txn)
+
+
+def remove_from_index(canonical_name):
+    db.delete(db.Key.from_path(_GAEBingoArchivedExperiment.kind(),
+                               canonical_name))
+
+
+def list_archived(cursor=None, limit=PAGE_SIZE):
+    """Return a page of the index, newest first.
+
+    Returns:
+        (entries, cursor) where cursor is the next page's, or None if this is
+        the last page.
+    """
+    query = _GAEBingoArchivedExperiment.all().order("-dt_started")
+    if cursor:
+        query.with_cursor(cursor)
+    entries = query.fetch(limit)
+    if len(entries) < limit:
+        return entries, None
+
+    next_cursor = query.cursor()
+    has_more = (_GAEBingoArchivedExperiment.all(keys_only=True)
+                    .order("-dt_started")
+                    .with_cursor(next_cursor)
+                    .get())
+    return entries, (next_cursor if has_more else None)
+
+
+def is_index_complete():
+    if memcache.get(INDEX_COMPLETE_KEY):
+        return True
+    if _GAEBingoArchiveIndexState.get_by_key_name(INDEX_COMPLETE_KEY):
+        memcache.set(INDEX_COMPLETE_KEY, True)
+        return True
+    return False
+
+
+def mark_index_complete():
+    _GAEBingoArchiveIndexState(key_name=INDEX_COMPLETE_KEY).put()
+    memcache.set(INDEX_COMPLETE_KEY, True)
+
+
+def needs_index():
+    """True if the index isn't complete yet, in which case rebuild_index is
+    queued.
+
+    Entries added as experiments are archived don't make the index complete,
+    only rebuild_index finishing does. If nothing's been archived yet, the
+    empty index is already complete.
+    """
+    if is_index_complete():
+        return False
+
+    if not (_GAEBingoExperiment.all(keys_only=True)
+                .filter("archived =", True).get()):
+        mark_index_complete()
+        return False
+
+    queue_rebuild_index()
+    return True
+
+
+def load_bingo_cache(canonical_names=(), experiment_names=()):
+    """Return a read-only BingoCache of just some archived experiments.
+
+    Args:
+        canonical_names: canonical names of experiments to load
+        experiment_names: names of experiments to load
+    """
+    bingo_cache = BingoCache()
+    bingo_cache.storage_disabled = True
+
+    # Kick all of the queries off w/ run() so they'll run in parallel
+    queries = ([_GAEBingoExperiment.all()
+                    .filter("archived =", True)
+                    .filter("canonical_name =", canonical_name).run()
+                for canonical_name in canonical_names] +
+               [_GAEBingoExperiment.all()
+                    .filter("archived =", True)
+                    .filter("name =", experiment_name).run()
+                for experiment_name in experiment_names])
+
+    experiments = {}
+    for query in queries:
+        for experiment in query:
+            experiments[experiment.name] = experiment
+
+    experiments = experiments.values()
+    alternative_queries = [_GAEBingoAlternative.all()
+                               .ancestor(experiment).run()
+                           for experiment in experiments]
+
+    for experiment, query in zip(experiments, alternative_queries):
+        alternatives = sorted(query, key=lambda alt: alt.number)
+        if alternatives:
+            bingo_cache.add_experiment(experiment, alternatives)
+
+    # Everything we just loaded is already in the datastore
+    bingo_cache.unpersisted_experiment_names.clear()
+
+    return bingo_cache
+
+
+def queue_rebuild_index():
+    """Queue up rebuild_index, at most once per 10 minutes."""
+    window = int(time.time() / 600)
+    try:
+        deferred.defer(rebuild_index, _queue=config.QUEUE_NAME,
+                _name="gae-bingo-archive-index-%s" % window)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def rebuild_index(cursor=None):
+    """Index every archived experiment, a batch at a time.
+
+    Archived experiments are walked w/ a query cursor. If this runs out of
+    time, it defers itself to pick up where it left off. Re-indexing a
+    canonical experiment just overwrites its entry, so this is safe to retry.
+    Once every archived experiment has been walked, the index is marked
+    complete.
+
+    Returns:
+        The # of archived experiments walked.
+    """
+    deadline = time.time() + REBUILD_SECONDS
+    walked = 0
+
+    while True:
+        query = _GAEBingoExperiment.all().filter("archived =", True)
+        if cursor:
+            query.with_cursor(cursor)
+        experiments = query.fetch(REBUILD_BATCH_SIZE)
+        walked += len(experiments)
+
+        # Entries cover every experiment sharing a canonical name, not just
+        # those in this batch
+        canonical_names = set(ex.canonical_name for ex in experiments)
+        bingo_cache = load_bingo_cache(canonical_names)
+
+        entries = []
+        for canonical_name in canonical_names:
+            experiments_and_alternatives = (bingo_cache
+                    .experiments_and_alternatives_from_canonical_name(
+                        canonical_name))
+            if experiments_and_alternatives[0]:
+                entries.append(entry_for(*experiments_and_alternatives))
+        db.put(entries)
+
+        if len(experiments) < REBUILD_BATCH_SIZE:
+            mark_index_complete()
+            break
+
+        cursor = query.cursor()
+        if time.time() > deadline:
+            deferred.defer(rebuild_index, cursor, _queue=config.QUEUE_NAME)
+            break
+
+    logging.info("Indexed %s archived gae/bingo experiments" % walked)
+    return walked
@@ -0,0 +1,81 @@
+import datetime
+
+from google.appengine.ext import db
+import mock
+
+from testutil import gae_model
+
+from . import archives
+from . import models
+
+
+class ArchivesTest(gae_model.GAEModelTestCase):
+    def setUp(self):
+        super(ArchivesTest, self).setUp()
+        start = datetime.datetime(2012, 1, 1)
+        for i, name in enumerate(["monkeys", "monkeys (bananas)", "gorillas",
+                                  "chimps"]):
+            experiment, alternatives = (
+                    models.create_experiment_and_alternatives(
+                        name, name.split()[0]))
+            experiment.archived = True
+            experiment.live = False
+            experiment.dt_started = start + datetime.timedelta(days=i)
+            for alternative in alternatives:
+                alternative.archived = True
+                alternative.participants = 10
+            db.put([experiment] + alternatives)
+
+    def test_index_is_rebuilt_and_paginated(self):
+        with mock.patch.object(archives, "queue_rebuild_index") as queue:
+            self.assertTrue(archives.needs_index())
+            self.assertTrue(queue.called)
+
+        self.assertEqual(4, archives.rebuild_index())
+        self.assertFalse(archives.needs_index())
+
+        entries, cursor = archives.list_archived(limit=2)
+        self.assertEqual(["chimps", "gorillas"],
+                         [entry.canonical_name for entry in entries])
+        self.assertTrue(cursor)
+
+        entries, cursor = archives.list_archived(cursor, limit=2)
+        self.assertEqual(["monkeys"],
+                         [entry.canonical_name for entry in entries])
+        self.assertEqual(["monkeys", "monkeys (bananas)"],
+                         entries[0].experiment_names)
+        self.assertEqual(20, entries[0].total_participants)
+        self.assertIsNone(cursor)
+
+    def test_index_incomplete_until_rebuilt(self):
+        bingo_cache = archives.load_bingo_cache(["chimps"])
+        archives.add_to_index(
+                *bingo_cache.experiments_and_alternatives_from_canonical_name(
+                    "chimps"))
+
+        # Newly archived experiments alone don't make the index complete
+        with mock.patch.object(archives, "queue_rebuild_index"):
+            self.assertTrue(archives.needs_index())
+        archives.rebuild_index()
+        self.assertFalse(archives.needs_index())
+
+    def test_reused_canonical_name_merges_into_entry(self):
+        archives.rebuild_index()
+
+        experiment, alternatives = models.create_experiment_and_alternatives(
+                "monkeys (coconuts)", "monkeys")
+        for alternative in alternatives:
+            alternative.participants = 5
+        archives.add_to_index([experiment], [alternatives])
+
+        entry = models._GAEBingoArchivedExperiment.get_by_key_name("monkeys")
+        self.assertEqual(
+                ["monkeys", "monkeys (bananas)", "monkeys (coconuts)"],
+                entry.experiment_names)
+        self.assertEqual(20, entry.total_participants)
+
+    def test_load_bingo_cache_loads_only_whats_asked_for(self):
+        bingo_cache = archives.load_bingo_cache(["monkeys"], ["chimps"])
+        self.assertEqual(["chimps", "monkeys", "monkeys (bananas)"],
+                         sorted(bingo_cache.experiments))
+        self.assertEqual(2, len(bingo_cache.get_alternatives("chimps")))
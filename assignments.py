@@ -0,0 +1,151 @@
+"""Which alternative an identity gets in every experiment, computed at once.
+
+modulo_choose picks an identity's alternative by hashing the experiment's
+hashable name w/ the identity and walking the alternatives' weights. The
+dashboard's Alternatives endpoint and get_experiment_participation need an
+identity's alternative in many experiments, so for_identity picks them all
+in one pass over a plan of every experiment's weight thresholds. The plan is
+built once per version of the BingoCache (see BingoCache.get_version), and
+experiments sharing a hashable name (e.g. one per conversion of a canonical
+experiment) share a hash.
+
+An identity's assignments are cached for the rest of the request, and
+briefly in a small per-instance LRU, both keyed by the version of the
+BingoCache they were computed from. Assignments from BingoCaches w/out a
+version, like the archives' read-only ones, aren't cached at all.
+"""
+import datetime
+import hashlib
+
+from .cache import BingoCache
+import instance_cache
+import request_cache
+
+# TODO(eliana) remove once current expts end
+SORT_BY_NUMBER_SINCE = datetime.datetime(2013, 3, 26, 18, 0, 0, 0)
+
+# Plans and assignments are cached in instance memory this long, and the
+# instance LRU holds this many identities' assignments
+INSTANCE_SECONDS = 60
+INSTANCE_MAX_IDENTITIES = 1000
+
+PLAN_KEY = "_gae_bingo_assignment_plan:%s"
+REQUEST_KEY = "_gae_bingo_assignments:%s:%s"
+
+_recent = instance_cache.LRUCache(INSTANCE_MAX_IDENTITIES,
+                                  expiry=INSTANCE_SECONDS)
+
+
+def weight_thresholds(experiment, alternatives):
+    """Weights of alternatives in the order modulo_choose checks them.
+
+    Returns:
+        (total weight, [(threshold, alternative)]), where an identity gets the
+        first alternative whose threshold its hash (mod total weight) is at
+        or above.
+    """
+    total_weight = sum(alternative.weight for alternative in alternatives)
+
+    if experiment.dt_started > SORT_BY_NUMBER_SINCE:
+        sorter = lambda alt: (alt.weight, alt.number)
+    else:
+        sorter = lambda alt: alt.weight
+
+    thresholds = []
+    current_weight = total_weight
+    for alternative in sorted(alternatives, key=sorter, reverse=True):
+        current_weight -= alternative.weight
+        thresholds.append((current_weight, alternative))
+
+    return total_weight, thresholds
+
+
+def choose(signature, total_weight, thresholds):
+    """Pick from weight_thresholds by an identity's md5 signature."""
+    index_weight = int(signature.hexdigest(), base=16) % total_weight
+    for threshold, alternative in thresholds:
+        if index_weight >= threshold:
+            return alternative
+
+
+def _build_plan(bingo_cache):
+    """Return (canonical name, hashable name, total weight, thresholds) of
+    the experiment find_alternative_for_user uses for each canonical name,
+    where thresholds hold alternatives' contents instead of alternatives.
+    """
+    plan = []
+    for canonical_name in bingo_cache.experiment_names_by_canonical_name:
+        experiment_names = bingo_cache.get_experiment_names_by_canonical_name(
+                canonical_name)
+        if not experiment_names:
+            continue
+
+        experiment = bingo_cache.get_experiment(experiment_names[-1])
+        alternatives = bingo_cache.get_alternatives(experiment_names[-1])
+        if not experiment or not alternatives:
+            continue
+
+        total_weight, thresholds = weight_thresholds(experiment, alternatives)
+        if total_weight:
+            plan.append((canonical_name, experiment.hashable_name,
+                         total_weight,
+                         [(threshold, alternative.content)
+                          for threshold, alternative in thresholds]))
+    return plan
+
+
+def _assign(plan, identity_str):
+    signatures = {}
+    assignments = {}
+    for canonical_name, hashable_name, total_weight, thresholds in plan:
+        signature = signatures.get(hashable_name)
+        if signature is None:
+            signature = hashlib.md5(hashable_name + identity_str)
+            signatures[hashable_name] = signature
+        assignments[canonical_name] = choose(signature, total_weight,
+                                             thresholds)
+    return assignments
+
+
+def for_identity(identity_val, bingo_cache=None):
+    """Return the content of the alternative modulo_choose picks for
+    identity_val in every experiment, by canonical name.
+
+    Cookie overrides and experiments that have ended aren't taken into
+    account, see find_alternative_for_user. Since the BingoCache can be up
+    to INSTANCE_SECONDS out of date, experiments created since may be
+    missing.
+
+    Args:
+        identity_val: a bingo identity, as returned by identity()
+        bingo_cache: the BingoCache to use, defaults to BingoCache.get().
+            Plans and assignments are cached by the version of the
+            BingoCache they're computed from, so nothing's cached for
+            BingoCaches w/out one (e.g. archives' read-only BingoCaches).
+    """
+    identity_str = str(identity_val)
+    bingo_cache = bingo_cache or BingoCache.get()
+    version = bingo_cache.get_version()
+    if version is None:
+        return _assign(_build_plan(bingo_cache), identity_str)
+
+    request_key = REQUEST_KEY % (version, identity_str)
+    assignments = request_cache.cache.get(request_key)
+    if assignments is not None:
+        return assignments
+
+    recent_key = (identity_str, version)
+    assignments = _recent.get(recent_key)
+
+    if assignments is None:
+        plan = instance_cache.get(PLAN_KEY % version)
+        if plan is None:
+            plan = _build_plan(bingo_cache)
+            instance_cache.set(PLAN_KEY % version, plan,
+                               expiry=INSTANCE_SECONDS)
+
+        assignments = _assign(plan, identity_str)
+        _recent.set(recent_key, assignments)
+
+    request_cache.cache[request_key] = assignments
+    return assignments
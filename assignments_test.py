@@ -0,0 +1,62 @@
+from testutil import gae_model
+
+from . import assignments
+from . import cache
+from . import gae_bingo
+from . import models
+
+
+class AssignmentsTest(gae_model.GAEModelTestCase):
+    def setUp(self):
+        super(AssignmentsTest, self).setUp()
+        self.bingo_cache = cache.BingoCache()
+        for name, conversion_name, params in [
+                ("monkeys", None, ["a", "b", "c"]),
+                ("gorillas (escaped)", "escaped", {"x": 1, "y": 4}),
+                ("gorillas (talked)", "talked", {"x": 1, "y": 4})]:
+            experiment, alternatives = (
+                    models.create_experiment_and_alternatives(
+                        name, name.split()[0], alternative_params=params,
+                        conversion_name=conversion_name))
+            self.bingo_cache.add_experiment(experiment, alternatives)
+
+    def test_assignments_match_modulo_choose(self):
+        for i in range(50):
+            identity_val = "identity %s" % i
+            chosen = assignments.for_identity(identity_val, self.bingo_cache)
+
+            self.assertEqual(set(["monkeys", "gorillas"]), set(chosen))
+            for canonical_name, content in chosen.iteritems():
+                experiments, alternative_lists = (self.bingo_cache
+                        .experiments_and_alternatives_from_canonical_name(
+                            canonical_name))
+                self.assertEqual(content, gae_bingo.modulo_choose(
+                        experiments[-1], alternative_lists[-1],
+                        identity_val).content)
+
+    def test_read_only_cache_isnt_cached(self):
+        archived = cache.BingoCache()
+        archived.storage_disabled = True
+        experiment, alternatives = models.create_experiment_and_alternatives(
+                "bananas", "bananas", alternative_params=["p", "q"])
+        archived.add_experiment(experiment, alternatives)
+
+        self.assertEqual(["bananas"],
+                         list(assignments.for_identity("monkey", archived)))
+        self.assertEqual(set(["monkeys", "gorillas"]),
+                         set(assignments.for_identity("monkey",
+                                                      self.bingo_cache)))
+
+    def test_changed_cache_isnt_served_old_assignments(self):
+        # As if just stored in memcache
+        self.bingo_cache.dirty = False
+        self.bingo_cache.version = "1"
+        self.assertEqual(set(["monkeys", "gorillas"]),
+                         set(assignments.for_identity("monkey",
+                                                      self.bingo_cache)))
+
+        self.bingo_cache.add_experiment(
+                *models.create_experiment_and_alternatives(
+                    "bananas", "bananas", alternative_params=["p", "q"]))
+        self.assertIn("bananas",
+                      assignments.for_identity("monkey", self.bingo_cache))
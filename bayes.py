@@ -0,0 +1,207 @@
+"""Bayesian summaries of experiments' alternatives.
+
+For every alternative, we estimate the probability that it's the best one
+and its expected loss: how much conversion rate we'd expect to give up by
+picking it if it isn't actually the best. Both come from Monte Carlo draws
+of each alternative's posterior conversion rate, w/ uniform priors:
+
+    Binary conversions   -> Beta(1 + conversions, 1 + non-converters)
+    Counting conversions -> Gamma(1 + conversions, rate=1 + participants),
+                            the rate of conversions per participant
+
+Draws for the alternatives of many experiments are taken together, in
+batches of at most MAX_BATCH_COLUMNS alternatives so the draws held in memory
+at once stay bounded however many experiments are summarized. Draws are
+seeded, so the same counts always get the same summary, and summaries are
+cached in a bounded per-instance LRU by their counts so repeated dashboard
+polls don't redraw anything. The LRU isn't cleared when request handlers
+flush the rest of the instance cache. NumPy is used when the app enables it
+(see app.yaml's libraries section), w/ a slower, smaller plain Python
+fallback.
+"""
+import random
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .models import ConversionTypes
+import instance_cache
+
+# Monte Carlo draws per alternative, w/ and w/out NumPy
+DRAWS = 20000
+PYTHON_DRAWS = 2000
+
+SEED = 1337
+
+# NumPy draws at most this many alternatives' posteriors at once, i.e.
+# DRAWS * MAX_BATCH_COLUMNS floats (~10MB). An experiment w/ more alternatives
+# than this is drawn on its own.
+MAX_BATCH_COLUMNS = 64
+
+# Summaries are cached in instance memory by their counts for this long, in
+# an LRU of at most this many
+CACHE_SECONDS = 60 * 60
+CACHE_MAX_ENTRIES = 1000
+
+_summaries = instance_cache.LRUCache(CACHE_MAX_ENTRIES, expiry=CACHE_SECONDS)
+
+
+def _draws_numpy(counts_list, counting):
+    """Posterior draws, one column per alternative of every experiment."""
+    counts = numpy.array([count for counts in counts_list
+                          for count in counts], dtype=float)
+    participants, conversions = counts[:, 0], counts[:, 1]
+
+    random_state = numpy.random.RandomState(SEED)
+    size = (DRAWS, len(counts))
+    if counting:
+        return random_state.gamma(1 + conversions, 1 / (1 + participants),
+                                  size=size)
+    else:
+        return random_state.beta(1 + conversions,
+                                 1 + participants - conversions, size=size)
+
+
+def _batches(counts_list):
+    """Split counts_list into runs of whole experiments w/ at most
+    MAX_BATCH_COLUMNS alternatives between them, where possible."""
+    batch = []
+    columns = 0
+    for counts in counts_list:
+        if batch and columns + len(counts) > MAX_BATCH_COLUMNS:
+            yield batch
+            batch = []
+            columns = 0
+        batch.append(counts)
+        columns += len(counts)
+    if batch:
+        yield batch
+
+
+def _summaries_numpy(counts_list, counting):
+    summaries = []
+    for batch in _batches(counts_list):
+        draws = _draws_numpy(batch, counting)
+
+        start = 0
+        for counts in batch:
+            experiment_draws = draws[:, start:start + len(counts)]
+            start += len(counts)
+
+            best = experiment_draws.argmax(axis=1)
+            loss = experiment_draws.max(axis=1)[:, None] - experiment_draws
+            summaries.append({
+                "probability_best": (numpy.bincount(best,
+                                                    minlength=len(counts))
+                                     / float(DRAWS)).tolist(),
+                "expected_loss": loss.mean(axis=0).tolist(),
+            })
+
+        # Let this batch's draws go before drawing the next
+        del draws
+    return summaries
+
+
+def _summary_python(counts, counting):
+    rng = random.Random(SEED)
+    wins = [0] * len(counts)
+    losses = [0.0] * len(counts)
+
+    for _ in xrange(PYTHON_DRAWS):
+        if counting:
+            draws = [rng.gammavariate(1 + conversions, 1.0 / (1 + participants))
+                     for participants, conversions in counts]
+        else:
+            draws = [rng.betavariate(1 + conversions,
+                                     1 + participants - conversions)
+                     for participants, conversions in counts]
+
+        best = max(draws)
+        wins[draws.index(best)] += 1
+        for index, draw in enumerate(draws):
+            losses[index] += best - draw
+
+    return {
+        "probability_best": [float(w) / PYTHON_DRAWS for w in wins],
+        "expected_loss": [loss / PYTHON_DRAWS for loss in losses],
+    }
+
+
+def summarize_counts(counts_list, counting=False):
+    """Summarize many experiments' alternatives in one batch.
+
+    Args:
+        counts_list: list of each experiment's alternatives' counts, as lists
+            of (participants, conversions) tuples
+        counting: True if these are Counting experiments' counts
+    Returns:
+        A list of dicts w/ lists of each alternative's probability_best and
+        expected_loss, in the same order as counts_list.
+    """
+    kind = "counting" if counting else "binary"
+    keys = [(kind, tuple(map(tuple, counts))) for counts in counts_list]
+    summaries = [_summaries.get(key) for key in keys]
+
+    missing = [index for index, summary in enumerate(summaries)
+               if summary is None and counts_list[index]]
+    if missing:
+        missing_counts = [counts_list[index] for index in missing]
+        if not counting:
+            # Non-converters can't be negative, even if conversions raced
+            # ahead of participants in memcache.
+            missing_counts = [[(participants, min(conversions, participants))
+                               for participants, conversions in counts]
+                              for counts in missing_counts]
+
+        if numpy:
+            computed = _summaries_numpy(missing_counts, counting)
+        else:
+            computed = [_summary_python(counts, counting)
+                        for counts in missing_counts]
+
+        for index, summary in zip(missing, computed):
+            summaries[index] = summary
+            _summaries.set(keys[index], summary)
+
+    return [summary or {"probability_best": [], "expected_loss": []}
+            for summary in summaries]
+
+
+def summarize_experiments(experiments_and_alternatives):
+    """summarize_counts for (experiment, alternatives) pairs.
+
+    Returns:
+        A list of each experiment's summaries, as lists of dicts w/ each
+        alternative's number, probability_best and expected_loss.
+    """
+    results = [None] * len(experiments_and_alternatives)
+
+    for counting in [False, True]:
+        indices = [index for index, (experiment, _)
+                   in enumerate(experiments_and_alternatives)
+                   if (experiment.conversion_type ==
+                       ConversionTypes.Counting) == counting]
+        if not indices:
+            continue
+
+        alternative_lists = [experiments_and_alternatives[index][1]
+                             for index in indices]
+        summaries = summarize_counts(
+                [[(alternative.participants, alternative.conversions)
+                  for alternative in alternatives]
+                 for alternatives in alternative_lists],
+                counting=counting)
+
+        for index, alternatives, summary in zip(indices, alternative_lists,
+                                                summaries):
+            results[index] = [{
+                    "number": alternative.number,
+                    "probability_best": probability_best,
+                    "expected_loss": expected_loss,
+                } for alternative, probability_best, expected_loss
+                in zip(alternatives, summary["probability_best"],
+                       summary["expected_loss"])]
+
+    return results
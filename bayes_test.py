@@ -0,0 +1,34 @@
+import mock
+
+from testutil import gae_model
+
+from . import bayes
+
+
+class BayesTest(gae_model.GAEModelTestCase):
+    COUNTS = [[(1000, 100), (1000, 130), (1000, 90)], [(10, 1), (10, 0)]]
+
+    def test_summaries(self):
+        clear_winner, small = bayes.summarize_counts(self.COUNTS)
+
+        self.assertAlmostEqual(1.0, sum(clear_winner["probability_best"]))
+        self.assertTrue(clear_winner["probability_best"][1] > 0.95)
+        self.assertEqual(1, clear_winner["expected_loss"].index(
+                min(clear_winner["expected_loss"])))
+
+        self.assertTrue(0.5 < small["probability_best"][0] < 0.95)
+
+    def test_summaries_are_memoized(self):
+        bayes.summarize_counts(self.COUNTS)
+        with mock.patch.object(bayes, "_summaries_numpy") as numpy_summaries:
+            with mock.patch.object(bayes, "_summary_python") as summary:
+                bayes.summarize_counts(self.COUNTS)
+        self.assertFalse(numpy_summaries.called)
+        self.assertFalse(summary.called)
+
+    def test_batches_bound_alternatives_drawn_at_once(self):
+        counts_list = [[(10, 1)] * 3, [(10, 1)] * 2, [(10, 1)] * 5]
+        with mock.patch.object(bayes, "MAX_BATCH_COLUMNS", 5):
+            batches = list(bayes._batches(counts_list))
+        self.assertEqual([[3, 2], [5]],
+                         [map(len, batch) for batch in batches])
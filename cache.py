@@ -28,25 +28,54 @@ Each of them are cached at multiple layers, summarized below:
 
 import hashlib
 import logging
+import time
+import uuid
 import zlib
 
 from google.appengine.ext import db
 from google.appengine.ext import deferred
+from google.appengine.ext import ndb
 from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.datastore import entity_pb
 from google.appengine.ext.webapp import RequestHandler
 
-from .models import _GAEBingoExperiment, _GAEBingoAlternative, _GAEBingoIdentityRecord, _GAEBingoSnapshotLog
+from .models import _GAEBingoExperiment, _GAEBingoAlternative, _GAEBingoIdentityRecord
 from config import config
 from identity import identity
 import instance_cache
+import journal
+import persist_telemetry
 import pickle_util
 import request_cache
+import snapshots
 import synchronized_counter
 
 
+# Identities used to wait for persistence in this many memcache buckets. Any
+# left over from before the identity queue, or put there when the identity
+# queue can't be used, are still drained.
 NUM_IDENTITY_BUCKETS = 51
 
+# Identity records are put in chunks of this many
+IDENTITY_PUT_BATCH = 500
+
+# Identities waiting in config.IDENTITY_QUEUE_NAME are leased this many at a
+# time, at most MAX_IDENTITY_LEASE_BATCHES times per persist before the rest
+# is handed off to a deferred task.
+IDENTITY_LEASE_BATCH = 1000
+MAX_IDENTITY_LEASE_BATCHES = 5
+IDENTITY_LEASE_SECONDS = 5 * 60
+
+# Identity queues this instance has found undeclared in queue.yaml, so they
+# aren't tried (and logged about) again for every identity
+_undeclared_identity_queues = set()
+
+# Fingerprints of recently persisted identity records are cached in memcache
+# under this prefix so unchanged records can be skipped w/o a datastore read.
+IDENTITY_FINGERPRINT_PREFIX = "_gae_bingo_identity_fingerprint:"
+IDENTITY_FINGERPRINT_SECONDS = 24 * 60 * 60
+
 
 class CacheLayers(object):
     """Gets and sets BingoCache/BingoIdentityCaches in multiple cache layers.
@@ -190,11 +219,33 @@ class BingoCache(object):
     """Stores all shared bingo experiment and alternative data."""
     CACHE_KEY = "_gae_bingo_compressed_cache"
 
+    # How many times update_shared retries its compare-and-set
+    MAX_SHARED_UPDATE_ATTEMPTS = 10
+
+    # Incremented every time the shared BingoCache is written to memcache
+    GENERATION_KEY = "_gae_bingo_cache_generation"
+
     @staticmethod
     def get():
         return CacheLayers.get(BingoCache.CACHE_KEY,
                 BingoCache.load_from_datastore)
 
+    @staticmethod
+    def generation():
+        """Return the shared BingoCache's generation, or None if unknown.
+
+        Any two reads that see the same generation see the same experiments,
+        alternatives and persisted counts.
+        """
+        return memcache.get(BingoCache.GENERATION_KEY)
+
+    @staticmethod
+    def bump_generation():
+        # Seeded from the clock in ms, so a generation evicted from memcache
+        # doesn't restart from a number clients have already seen.
+        memcache.incr(BingoCache.GENERATION_KEY,
+                      initial_value=int(time.time() * 1000))
+
     def __init__(self):
         self.dirty = False
         self.storage_disabled = False # True if loading archives that shouldn't be cached
@@ -208,6 +259,20 @@ class BingoCache(object):
         self.experiment_names_by_conversion_name = {} # Mapping of conversion names to experiment names
         self.experiment_names_by_canonical_name = {} # Mapping of canonical names to experiment names
 
+        self.unpersisted_experiment_names = set() # Experiments w/ property changes that haven't been put yet
+
+        self.version = None # Unique to each copy stored in memcache, see get_version
+
+    def get_unpersisted_experiment_names(self):
+        """Return names of experiments whose properties haven't been put yet.
+
+        BingoCaches pickled before we tracked this don't know which
+        experiments have changed, so they treat every experiment as changed.
+        """
+        if not hasattr(self, "unpersisted_experiment_names"):
+            self.unpersisted_experiment_names = set(self.experiments)
+        return self.unpersisted_experiment_names
+
     def store_if_dirty(self):
         # Only write cache if a change has been made
         if getattr(self, "storage_disabled", False) or not self.dirty:
@@ -220,100 +285,330 @@ class BingoCache(object):
         # No longer dirty
         self.dirty = False
 
+        self.version = uuid.uuid4().hex
         CacheLayers.set(self.CACHE_KEY, self)
+        BingoCache.bump_generation()
+
+    def store_shared_if_dirty(self):
+        """Like store_if_dirty, but w/out overwriting the shared BingoCache.
+
+        Persist tasks use this instead of store_if_dirty, since a plain set
+        from a stale copy could overwrite counts other persist shards have
+        merged in. This copy's new and changed experiments are merged into
+        the shared copy via update_shared instead, and this copy is only
+        stored whole if memcache has no shared copy at all.
+        """
+        if getattr(self, "storage_disabled", False) or not self.dirty:
+            return
+
+        changed_names = set(self.get_unpersisted_experiment_names())
+
+        def merge_changes(shared):
+            if shared is self:
+                return
 
-    def persist_to_datastore(self):
-        """Persist current state of experiment and alternative models.
+            for experiment_name in changed_names:
+                experiment_model = self.get_experiment(experiment_name)
+                if not experiment_model:
+                    continue
 
-        This persists the entire BingoCache state to the datastore. Individual
-        participants/conversions sums might be slightly out-of-date during any
-        given persist, but hopefully not by much. This can be caused by
-        memcache being cleared at unwanted times between a participant or
-        conversion count increment and a persist.
-        TODO(kamens): make persistence not rely on memcache so heavily.
+                if experiment_name in shared.experiments:
+                    # Leave the shared copy's alternatives alone, they have
+                    # the latest counts.
+                    shared.update_experiment(experiment_model)
+                else:
+                    shared.add_experiment(experiment_model,
+                            self.get_alternatives(experiment_name))
+
+        if self.update_shared(merge_changes) is not self:
+            # Only the shared copy was stored w/ these changes
+            self.version = None
+        self.dirty = False
+
+    def _compress_for_storage(self):
+        # Wipe out deserialized models before serialization for speed
+        self.experiment_models = {}
+        self.alternative_models = {}
+        self.dirty = False
+        self.version = uuid.uuid4().hex
+        return CacheLayers.compress(self)
+
+    def get_version(self):
+        """Return a version unique to the copy of the shared BingoCache this
+        is, or None if it's been changed since it was stored (or was never
+        stored at all, like archives' BingoCaches).
+
+        Unlike generation(), which is bumped only after the shared copy is
+        written, this always describes this copy's experiments and
+        alternatives, so it's safe to cache things derived from them by it.
+        BingoCaches pickled before versions existed have none.
+        """
+        if self.dirty:
+            return None
+        return getattr(self, "version", None)
+
+    def update_shared(self, fxn_update):
+        """Atomically apply fxn_update to the BingoCache shared in memcache.
+
+        Parallel persist shards each update their own experiments' counts in
+        the single shared BingoCache, so a plain set could overwrite another
+        shard's update with a stale copy. Instead this uses memcache's
+        compare-and-set, re-applying fxn_update to the latest copy until it
+        goes through. If memcache has no shared copy, this BingoCache is
+        used as the starting point.
+
+        Args:
+            fxn_update: function that takes a BingoCache and modifies it. It
+                may be called more than once, each time w/ a fresher copy.
+        Returns:
+            The updated shared BingoCache.
+        """
+        client = memcache.Client()
+
+        for attempt in range(BingoCache.MAX_SHARED_UPDATE_ATTEMPTS):
+            compressed = client.gets(self.CACHE_KEY)
+
+            if compressed is None:
+                shared = self
+                fxn_update(shared)
+                if client.add(self.CACHE_KEY, shared._compress_for_storage()):
+                    break
+            else:
+                shared = CacheLayers.decompress(compressed)
+                fxn_update(shared)
+                if client.cas(self.CACHE_KEY, shared._compress_for_storage()):
+                    break
+        else:
+            # We'd rather risk clobbering someone else's update than lose
+            # the counts we've just popped.
+            logging.error("Failed to update shared BingoCache after %s "
+                          "attempts, overwriting it" %
+                          BingoCache.MAX_SHARED_UPDATE_ATTEMPTS)
+            client.set(self.CACHE_KEY, shared._compress_for_storage())
+
+        BingoCache.bump_generation()
+        instance_cache.set(self.CACHE_KEY, shared,
+                           expiry=CacheLayers.INSTANCE_SECONDS)
+
+        return shared
+
+    def persist_to_datastore(self, experiment_names=None,
+                             journal_deltas=None, lock=None):
+        """Persist changed experiment and alternative models.
+
+        This persists the BingoCache state that has changed since the last
+        persist to the datastore. Experiments are only put when their
+        properties have changed (or they've never been put), and alternatives
+        are only put when their experiment was or when they've accumulated new
+        participants or conversions. Individual participants/conversions sums
+        might be slightly out-of-date during any given persist, but hopefully
+        not by much. This can be caused by memcache being cleared at unwanted
+        times between a participant or conversion count increment and a
+        persist, unless the durable journal is in use (see journal.py).
+
+        Popped counts are added to the alternatives in the shared, memcached
+        BingoCache via update_shared rather than to this copy's, so this copy
+        only needs to be fresh enough to know which experiments exist. That
+        lets parallel persist shards safely share a single BingoCache.
 
         This persistence should be run constantly in the background via chained
         task queues.
+
+        Args:
+            experiment_names: names of the experiments to persist, or None to
+                persist every experiment in the cache. Only these experiments'
+                counters are popped.
+            journal_deltas: if the durable journal is enabled, the journaled
+                counter deltas to fold into alternatives in place of the
+                counts popped from memcache. Keyed by counter key just like
+                SynchronizedCounter.pop_counters' results.
+            lock: the persist.PersistLock held by the caller, if any. Its
+                fencing token is checked before counters are popped, so a
+                persist that has lost its lease raises StalePersistLockError
+                before it's taken anything. Once counters are popped they're
+                always merged and written.
+        Returns:
+            A dict of stats about this persist: the # of experiments and
+            alternatives written and skipped, and "popped_counts", the counts
+            popped from memcache keyed by counter key.
         """
+        if experiment_names is None:
+            experiment_names = self.experiments.keys()
+        else:
+            experiment_names = [name for name in experiment_names
+                                if name in self.experiments]
 
-        # Start putting the experiments asynchronously.
-        experiments_to_put = []
-        for experiment_name in self.experiments:
-            experiment_model = self.get_experiment(experiment_name)
-            experiments_to_put.append(experiment_model)
-        async_experiments = db.put_async(experiments_to_put)
+        # Make sure any changes made to this copy have made it to memcache
+        # before we start merging into the shared copy.
+        self.store_shared_if_dirty()
 
         # Fetch all current counts available in memcache...
         counter_keys = []
-        for experiment_name in self.experiments:
+        for experiment_name in experiment_names:
             experiment_model = self.get_experiment(experiment_name)
             counter_keys.append(experiment_model.participants_key)
             counter_keys.append(experiment_model.conversions_key)
+            counter_keys.append(experiment_model.conversions_sq_key)
+            counter_keys.append(experiment_model.conversions_sq_invalid_key)
+
+        if lock:
+            # Once counters are popped there's no going back, so make sure
+            # we still hold the lock.
+            lock.assert_current()
 
         # ...and when we grab the current counts, reset the currently
         # accumulating counters at the same time.
-        count_results = synchronized_counter.SynchronizedCounter.pop_counters(
+        popped_counts = synchronized_counter.SynchronizedCounter.pop_counters(
                 counter_keys)
+        count_results = popped_counts
+
+        if journal_deltas is not None:
+            # The journal is the durable source of truth for counts, so the
+            # counts popped from memcache have only reset its read view. Keep
+            # track of how the two compare.
+            journal.record_reconciliation(popped_counts, journal_deltas)
+            count_results = {key: journal_deltas.get(key) or
+                    [0] * synchronized_counter.COUNTERS_PER_COMBINATION
+                    for key in counter_keys}
+
+        # Popped counts exist nowhere else now, so they're always merged in,
+        # even if we've lost the lock since. Merging goes through
+        # update_shared's compare-and-set, so it can't clobber whoever holds
+        # the lock now.
 
-        # Now add the latest accumulating counters to each alternative.
+        experiments_to_put = []
         alternatives_to_put = []
-        for experiment_name in self.alternatives:
-
-            experiment_model = self.get_experiment(experiment_name)
-            alternative_models = self.get_alternatives(experiment_name)
-            participants = count_results[experiment_model.participants_key]
-            conversions = count_results[experiment_model.conversions_key]
-
-            for alternative_model in alternative_models:
-
-                # When persisting to datastore, we want to update with the most
-                # recent accumulated counter from memcache.
-                if alternative_model.number < len(participants):
-                    delta_participants = participants[alternative_model.number]
-                    alternative_model.participants += delta_participants
-
-                if alternative_model.number < len(conversions):
-                    delta_conversions = conversions[alternative_model.number]
-                    alternative_model.conversions += delta_conversions
-
-                alternatives_to_put.append(alternative_model)
-                self.update_alternative(alternative_model)
+        skipped = {"experiments": 0, "alternatives": 0}
+
+        def add_counts(shared):
+            # This may be retried w/ a fresher shared BingoCache, so start over
+            experiments_to_put[:] = []
+            alternatives_to_put[:] = []
+            skipped["experiments"] = skipped["alternatives"] = 0
+
+            unpersisted_names = shared.get_unpersisted_experiment_names()
+
+            # Now add the latest accumulating counters to each alternative.
+            for experiment_name in experiment_names:
+
+                experiment_model = shared.get_experiment(experiment_name)
+                if not experiment_model:
+                    # Deleted or archived since our copy was loaded
+                    continue
+
+                if experiment_name in unpersisted_names:
+                    experiment_changed = True
+                    experiments_to_put.append(experiment_model)
+                else:
+                    experiment_changed = False
+                    skipped["experiments"] += 1
+
+                alternative_models = shared.get_alternatives(experiment_name)
+                participants = count_results[experiment_model.participants_key]
+                conversions = count_results[experiment_model.conversions_key]
+                conversions_sq = count_results[
+                        experiment_model.conversions_sq_key]
+                conversions_sq_invalid = count_results[
+                        experiment_model.conversions_sq_invalid_key]
+
+                for alternative_model in alternative_models:
+
+                    delta_participants = 0
+                    delta_conversions = 0
+                    delta_conversions_sq = 0
+
+                    # When persisting to datastore, we want to update with the
+                    # most recent accumulated counter from memcache.
+                    if alternative_model.number < len(participants):
+                        delta_participants = participants[
+                                alternative_model.number]
+                        alternative_model.participants += delta_participants
+
+                    if alternative_model.number < len(conversions):
+                        delta_conversions = conversions[
+                                alternative_model.number]
+                        alternative_model.conversions += delta_conversions
+
+                    # Unknown sums (e.g. legacy alternatives') stay unknown
+                    # rather than starting from these deltas.
+                    invalidated = False
+                    if (alternative_model.conversions_sq is not None and
+                            alternative_model.number < len(conversions_sq)):
+                        if conversions_sq_invalid[alternative_model.number]:
+                            # The sum has missed an increment
+                            alternative_model.conversions_sq = None
+                            invalidated = True
+                        else:
+                            delta_conversions_sq = conversions_sq[
+                                    alternative_model.number]
+                            alternative_model.conversions_sq += (
+                                    delta_conversions_sq)
+
+                    if (experiment_changed or delta_participants or
+                            delta_conversions or delta_conversions_sq or
+                            invalidated):
+                        alternatives_to_put.append(alternative_model)
+                        shared.update_alternative(alternative_model)
+                    else:
+                        skipped["alternatives"] += 1
 
         # When periodically persisting to datastore, first make sure memcache
         # has relatively up-to-date participant/conversion counts for each
         # alternative.
-        self.dirty = True
-        self.store_if_dirty()
+        self.update_shared(add_counts)
 
-        # Once memcache is done, put alternatives.
+        # Once memcache is done, put experiments and alternatives.
+        async_experiments = db.put_async(experiments_to_put)
         async_alternatives = db.put_async(alternatives_to_put)
 
         async_experiments.get_result()
         async_alternatives.get_result()
 
+        # Keep this copy consistent w/ what we just wrote
+        for alternative_model in alternatives_to_put:
+            self.update_alternative(alternative_model)
+
+        if experiments_to_put:
+            # Only forget about experiment changes once they've been put.
+            put_names = [experiment_model.name
+                         for experiment_model in experiments_to_put]
+            self.update_shared(lambda shared:
+                    shared.get_unpersisted_experiment_names().difference_update(
+                        put_names))
+            self.get_unpersisted_experiment_names().difference_update(
+                    put_names)
+
+        # Memcache already has all of our changes, though not as this copy
+        self.dirty = False
+        self.version = None
+
+        stats = {
+            "experiments_written": len(experiments_to_put),
+            "experiments_skipped": skipped["experiments"],
+            "alternatives_written": len(alternatives_to_put),
+            "alternatives_skipped": skipped["alternatives"],
+            "popped_counts": popped_counts,
+        }
+
+        logging.info("Persisted %(experiments_written)s experiments "
+                     "(%(experiments_skipped)s unchanged) and "
+                     "%(alternatives_written)s alternatives "
+                     "(%(alternatives_skipped)s unchanged)" % stats)
+
+        return stats
+
     def log_cache_snapshot(self):
 
         # Log current data on live experiments to the datastore
-        log_entries = []
+        experiments_and_alternatives = []
 
         for experiment_name in self.experiments:
             experiment_model = self.get_experiment(experiment_name)
             if experiment_model and experiment_model.live:
-                log_entries += self.log_experiment_snapshot(experiment_model)
-
-        db.put(log_entries)
-
-    def log_experiment_snapshot(self, experiment_model):
-
-        log_entries = []
+                experiments_and_alternatives.append((experiment_model,
+                        self.get_alternatives(experiment_name)))
 
-        alternative_models = self.get_alternatives(experiment_model.name)
-        for alternative_model in alternative_models:
-            # When logging, we want to store the most recent value we've got
-            log_entry = _GAEBingoSnapshotLog(parent=experiment_model, alternative_number=alternative_model.number, conversions=alternative_model.latest_conversions_count(), participants=alternative_model.latest_participants_count())
-            log_entries.append(log_entry)
-
-        return log_entries
+        snapshots.record_snapshots(experiments_and_alternatives)
 
     @staticmethod
     def load_from_datastore(archives=False):
@@ -354,9 +649,14 @@ class BingoCache(object):
             if ex and alts:
                 bingo_cache.add_experiment(ex, alts)
 
+        # Everything we just loaded is already in the datastore
+        bingo_cache.unpersisted_experiment_names.clear()
+
         # Immediately store in memcache as soon as possible after loading from
-        # datastore to minimize # of datastore loads
-        bingo_cache.store_if_dirty()
+        # datastore to minimize # of datastore loads. If someone else has
+        # stored a shared copy since we found memcache empty, theirs is kept,
+        # since it may already have counts merged into it.
+        bingo_cache.store_shared_if_dirty()
 
         return bingo_cache
 
@@ -379,12 +679,14 @@ class BingoCache(object):
         for alternative in alternatives:
             self.update_alternative(alternative)
 
+        self.get_unpersisted_experiment_names().add(experiment.name)
         self.dirty = True
 
     def update_experiment(self, experiment):
         self.experiment_models[experiment.name] = experiment
         self.experiments[experiment.name] = db.model_to_protobuf(experiment).Encode()
 
+        self.get_unpersisted_experiment_names().add(experiment.name)
         self.dirty = True
 
     def update_alternative(self, alternative):
@@ -419,6 +721,8 @@ class BingoCache(object):
         if experiment.canonical_name in self.experiment_names_by_canonical_name:
             self.experiment_names_by_canonical_name[experiment.canonical_name].remove(experiment.name)
 
+        self.get_unpersisted_experiment_names().discard(experiment.name)
+
         self.dirty = True
 
         # Immediately store in memcache as soon as possible after deleting from datastore
@@ -514,6 +818,16 @@ class BingoIdentityCache(object):
                 lambda: BingoIdentityCache.load_from_datastore(identity_val))
 
     def store_for_identity_if_dirty(self, ident):
+        self.store_for_identity_if_dirty_async(ident).get_result()
+
+    @ndb.tasklet
+    def store_for_identity_if_dirty_async(self, ident):
+        """Set this identity cache in memcache and queue it for persistence.
+
+        Both happen asynchronously, so the end of the request can overlap
+        them w/ its other writes. The task is only added once the memcache
+        set has finished, so the persist can't pick up a stale copy.
+        """
         if not self.dirty:
             return
 
@@ -522,58 +836,100 @@ class BingoIdentityCache(object):
 
         # memcache.set_async isn't exposed; make a Client so we can use it
         client = memcache.Client()
-        future = client.set_multi_async(
-            {BingoIdentityCache.key_for_identity(ident): self})
-
-        # Always fire off a task queue to persist bingo identity cache
-        # since there's no cron job persisting these objects like BingoCache.
-        self.persist_to_datastore(ident)
-        # TODO(alpert): If persist_to_datastore has more than 50 identities and
-        # creates a deferred task AND that task runs before the above memcache
-        # set finishes then we could lose a tiny bit of data for a user, but
-        # that's extremely unlikely to happen.
+        yield client.set_multi_async(
+                {BingoIdentityCache.key_for_identity(ident): self})
 
-        future.get_result()
+        # Always queue up this identity cache to be persisted, since there's
+        # no cron job persisting these objects like BingoCache.
+        yield self.persist_to_datastore_async(ident)
 
     def persist_to_datastore(self, ident):
+        self.persist_to_datastore_async(ident).get_result()
+
+    @ndb.tasklet
+    def persist_to_datastore_async(self, ident):
+        """Queue up ident's memcached identity cache for persistence.
 
-        # Add the memcache value to a memcache bucket which
-        # will be persisted to the datastore when it overflows
-        # or when the periodic cron job is run
+        Each identity is appended to config.IDENTITY_QUEUE_NAME as its own
+        pull task, so concurrent requests can't drop each other's identities.
+        persist_buckets_to_datastore leases them in batches.
+
+        If no identity queue is configured or it hasn't been declared in
+        queue.yaml, identities fall back to the memcache buckets they used
+        to wait in, which are still drained every persist.
+        """
+        queue_name = identity_queue_name()
+        if not queue_name:
+            BingoIdentityCache.add_to_legacy_bucket(ident)
+            return
+
+        task = taskqueue.Task(payload=unicode(ident).encode("utf-8"),
+                              method="PULL")
+        try:
+            yield taskqueue.Queue(queue_name).add_async(task)
+        except taskqueue.UnknownQueueError:
+            forget_undeclared_identity_queue(queue_name)
+            BingoIdentityCache.add_to_legacy_bucket(ident)
+        except taskqueue.Error, e:
+            # The identity cache is still in memcache, it just won't make it
+            # to the datastore unless it's dirtied again.
+            logging.error("Failed to queue gae/bingo identity %s for "
+                          "persistence: %s" % (ident, e))
+
+    @staticmethod
+    def add_to_legacy_bucket(ident):
+        """Add ident to a memcache bucket drained by drain_legacy_buckets.
+
+        Concurrent requests can drop each other's identities from a bucket,
+        so this is only a fallback for when the identity queue can't be used.
+        """
         sig = hashlib.md5(str(ident)).hexdigest()
-        sig_num = int(sig, base=16)
-        bucket = sig_num % NUM_IDENTITY_BUCKETS
+        bucket = int(sig, base=16) % NUM_IDENTITY_BUCKETS
         key = "_gae_bingo_identity_bucket:%s" % bucket
 
         list_identities = memcache.get(key) or []
         list_identities.append(ident)
+        memcache.set(key, list_identities)
 
-        if len(list_identities) > 50:
+    @staticmethod
+    def persist_buckets_to_datastore():
+        """Persist all identity caches waiting for persistence.
 
-            # If over 50 identities are waiting for persistent storage, 
-            # go ahead and kick off a deferred task to do so
-            # in case it'll be a while before the cron job runs.
-            deferred.defer(persist_gae_bingo_identity_records, list_identities, _queue=config.QUEUE_NAME)
+        Returns:
+            A dict of stats, see persist_identity_queue.
+        """
+        started = time.time()
 
-            # There are race conditions here such that we could miss persistence
-            # of some identities, but that's not a big deal as long as
-            # there is no statistical correlation b/w the experiment and those
-            # being lost.
-            memcache.set(key, [])
+        stats = persist_identity_queue()
+        stats["legacy_identities_queued"] = (
+                BingoIdentityCache.drain_legacy_buckets())
 
-        else:
+        persist_telemetry.record_run(persist_telemetry.IDENTITIES, started,
+                                     stats, success=stats["error"] is None)
 
-            memcache.set(key, list_identities)
+        return stats
 
     @staticmethod
-    def persist_buckets_to_datastore():
-        # Persist all memcache buckets to datastore
+    def drain_legacy_buckets():
+        """Persist identities waiting in memcache buckets.
+
+        Identities are only put in buckets by older versions, or when the
+        identity queue can't be used (see persist_to_datastore_async).
+
+        Returns:
+            The # of identities queued for persistence.
+        """
+        identities_queued = 0
+
         dict_buckets = memcache.get_multi(["_gae_bingo_identity_bucket:%s" % bucket for bucket in range(0, NUM_IDENTITY_BUCKETS)])
 
         for key in dict_buckets:
-            if len(dict_buckets[key]) > 0:
+            if dict_buckets[key]:
                 deferred.defer(persist_gae_bingo_identity_records, dict_buckets[key], _queue=config.QUEUE_NAME)
-                memcache.set(key, [])
+                memcache.delete(key)
+                identities_queued += len(dict_buckets[key])
+
+        return identities_queued
 
     @staticmethod
     def load_from_datastore(identity_val=None):
@@ -627,30 +983,204 @@ def store_if_dirty():
     bingo_cache = request_cache.cache.get(BingoCache.CACHE_KEY)
     bingo_identity_cache = request_cache.cache.get(BingoIdentityCache.key_for_identity(identity()))
 
+    # Kick off the identity cache's writes first so they overlap w/ the rest
+    identity_future = None
+    if bingo_identity_cache:
+        identity_future = (bingo_identity_cache
+                .store_for_identity_if_dirty_async(identity()))
+
     if bingo_cache:
         bingo_cache.store_if_dirty()
 
-    if bingo_identity_cache:
-        bingo_identity_cache.store_for_identity_if_dirty(identity())
+    # Append any counter increments from this request to the durable journal
+    journal.flush()
 
+    if identity_future:
+        identity_future.get_result()
 
-def persist_gae_bingo_identity_records(list_identities):
 
-    dict_identity_caches = memcache.get_multi([BingoIdentityCache.key_for_identity(ident) for ident in list_identities])
+def identity_queue_name():
+    """Return the identity queue to use, or None to use memcache buckets."""
+    if config.IDENTITY_QUEUE_NAME in _undeclared_identity_queues:
+        return None
+    return config.IDENTITY_QUEUE_NAME
+
+
+def forget_undeclared_identity_queue(queue_name):
+    """Fall back to memcache buckets for the rest of this instance's life."""
+    if queue_name not in _undeclared_identity_queues:
+        logging.error("gae/bingo identity queue %s isn't declared in "
+                      "queue.yaml, see yaml/queue.yaml. Falling back to "
+                      "memcache buckets." % queue_name)
+        _undeclared_identity_queues.add(queue_name)
+
+
+def persist_identity_queue():
+    """Lease identities from the identity queue and persist their records.
+
+    If the queue is still backed up after MAX_IDENTITY_LEASE_BATCHES, a
+    deferred task picks up where this left off.
+
+    Returns:
+        A dict of stats, including the queue's remaining backlog and the
+        error that stopped it early, if any.
+    """
+    stats = {
+        "tasks_leased": 0,
+        "identities_written": 0,
+        "identities_unchanged": 0,
+        "identities_missing": 0,
+        "continuation_queued": False,
+        "backlog_tasks": None,
+        "oldest_task_age_seconds": None,
+        "error": None,
+    }
+
+    queue_name = identity_queue_name()
+    if not queue_name:
+        # Identities wait in memcache buckets instead
+        return stats
+
+    queue = taskqueue.Queue(queue_name)
+    try:
+        for _ in range(MAX_IDENTITY_LEASE_BATCHES):
+            tasks = queue.lease_tasks(IDENTITY_LEASE_SECONDS,
+                                      IDENTITY_LEASE_BATCH)
+            if not tasks:
+                break
+
+            list_identities = set(task.payload.decode("utf-8")
+                                  for task in tasks)
+            records_stats = persist_gae_bingo_identity_records(
+                    list_identities)
+
+            # Only forget about identities once their records have been put.
+            queue.delete_tasks(tasks)
+
+            stats["tasks_leased"] += len(tasks)
+            stats["identities_written"] += records_stats["written"]
+            stats["identities_unchanged"] += records_stats["unchanged"]
+            stats["identities_missing"] += records_stats["missing"]
+
+            if len(tasks) < IDENTITY_LEASE_BATCH:
+                break
+        else:
+            # We're falling behind, so keep draining in another task.
+            deferred.defer(persist_identity_queue, _queue=config.QUEUE_NAME)
+            stats["continuation_queued"] = True
+
+        backlog = queue.fetch_statistics()
+        stats["backlog_tasks"] = backlog.tasks
+        if backlog.oldest_eta_usec:
+            stats["oldest_task_age_seconds"] = max(0,
+                    time.time() - backlog.oldest_eta_usec / 1e6)
+    except taskqueue.UnknownQueueError, e:
+        forget_undeclared_identity_queue(queue_name)
+        stats["error"] = str(e)
+    except taskqueue.Error, e:
+        logging.error("Failed to persist gae/bingo identity queue: %s" % e)
+        stats["error"] = str(e)
+
+    # Fraction of record puts skipped because nothing had changed
+    persisted = stats["identities_written"] + stats["identities_unchanged"]
+    stats["write_savings_ratio"] = (
+            float(stats["identities_unchanged"]) / persisted
+            if persisted else None)
+
+    if stats["continuation_queued"]:
+        logging.warning("gae/bingo identity queue is backed up: %s" % stats)
 
-    for ident in list_identities:
-        identity_cache = dict_identity_caches.get(BingoIdentityCache.key_for_identity(ident))
+    return stats
 
-        if identity_cache:
-            bingo_identity = _GAEBingoIdentityRecord(
+
+def identity_fingerprint(pickled):
+    """Return a compact fingerprint of a pickled BingoIdentityCache."""
+    return hashlib.md5(pickled).hexdigest()[:16]
+
+
+def persist_gae_bingo_identity_records(list_identities):
+    """Put the records of identities whose caches are still in memcache.
+
+    Records whose content hasn't changed since they were last put are
+    skipped. Recently persisted fingerprints are cached in memcache, and on a
+    miss we fall back to reading the stored record's fingerprint, since a
+    read is much cheaper than a put. Records are put asynchronously in chunks
+    of IDENTITY_PUT_BATCH.
+
+    Returns:
+        A dict w/ the # of records "written", the # skipped as "unchanged",
+        and the # "missing" from memcache.
+    """
+    list_identities = list(set(list_identities))
+    futures = []
+    persisted_fingerprints = {}
+    stats = {"written": 0, "unchanged": 0, "missing": 0}
+
+    for i in range(0, len(list_identities), IDENTITY_PUT_BATCH):
+        chunk = list_identities[i:i + IDENTITY_PUT_BATCH]
+        dict_identity_caches = memcache.get_multi([BingoIdentityCache.key_for_identity(ident) for ident in chunk])
+
+        pickled_by_ident = {}
+        for ident in chunk:
+            identity_cache = dict_identity_caches.get(BingoIdentityCache.key_for_identity(ident))
+
+            if identity_cache:
+                pickled_by_ident[ident] = pickle_util.dump(identity_cache)
+            else:
+                stats["missing"] += 1
+
+        fingerprints = {ident: identity_fingerprint(pickled)
+                        for ident, pickled in pickled_by_ident.iteritems()}
+
+        known_fingerprints = memcache.get_multi(fingerprints.keys(),
+                key_prefix=IDENTITY_FINGERPRINT_PREFIX)
+
+        unknown = [ident for ident in fingerprints
+                   if ident not in known_fingerprints]
+        if unknown:
+            stored_records = _GAEBingoIdentityRecord.get_by_key_name(
+                    [_GAEBingoIdentityRecord.key_for_identity(ident)
+                     for ident in unknown])
+            for ident, record in zip(unknown, stored_records):
+                if record and record.fingerprint:
+                    known_fingerprints[ident] = record.fingerprint
+
+        records = []
+        for ident, fingerprint in fingerprints.iteritems():
+            if known_fingerprints.get(ident) == fingerprint:
+                stats["unchanged"] += 1
+                continue
+
+            records.append(_GAEBingoIdentityRecord(
                         key_name = _GAEBingoIdentityRecord.key_for_identity(ident),
                         identity = ident,
-                        pickled = pickle_util.dump(identity_cache),
-                    )
-            bingo_identity.put()
+                        pickled = pickled_by_ident[ident],
+                        fingerprint = fingerprint,
+                    ))
+            persisted_fingerprints[ident] = fingerprint
+
+        if records:
+            futures.append(db.put_async(records))
+            stats["written"] += len(records)
+
+    for future in futures:
+        future.get_result()
+
+    # Only remember fingerprints once their records have been put
+    if persisted_fingerprints:
+        memcache.set_multi(persisted_fingerprints,
+                key_prefix=IDENTITY_FINGERPRINT_PREFIX,
+                time=IDENTITY_FINGERPRINT_SECONDS)
+
+    return stats
 
 
 class LogSnapshotToDatastore(RequestHandler):
     def get(self):
         BingoCache.get().log_cache_snapshot()
 
+
+class CompactSnapshots(RequestHandler):
+    def get(self):
+        snapshots.compact_snapshots()
+
@@ -1,32 +1,208 @@
 from google.appengine.api import memcache
+import mock
 
 from testutil import gae_model
 
 from . import cache
+from . import models
 
 class CacheTest(gae_model.GAEModelTestCase):
-    def test_bingo_identity_bucket_max(self):
-        # If the number of buckets changes then the magic number for the ident
-        # needs to change. 166 is the lowest number that hashes to bucket 50.
-        #
-        # The magic number is derived from brute force application of the
-        # bucketing hash function:
-        #
-        #  import hashlib
-        #  num_buckets = 51
-        #  next(i for i in xrange(0, 10000)
-        #       if (num_buckets - 1) == (int(hashlib.md5(str(i)).hexdigest(),
-        #                                    base=16) % num_buckets))
-        self.assertEqual(51, cache.NUM_IDENTITY_BUCKETS)
-        max_bucket_key = "_gae_bingo_identity_bucket:50"
-        ident = 166
-
-        ident_cache = cache.BingoIdentityCache()
-        self.assertIsNone(memcache.get(max_bucket_key))
-        # This puts the identity cache in memcache.
-        ident_cache.persist_to_datastore(ident)
-        self.assertEqual(1, len(memcache.get(max_bucket_key)))
-        # This persists buckets in memcache to the datastore then clears them
-        # from memcache.
-        cache.BingoIdentityCache.persist_buckets_to_datastore()
-        self.assertEqual(0, len(memcache.get(max_bucket_key)))
+    def test_persist_identity_records(self):
+        for ident in ["monkey", "gorilla"]:
+            memcache.set(cache.BingoIdentityCache.key_for_identity(ident),
+                         cache.BingoIdentityCache())
+
+        # Duplicates are only put once, and identities whose caches have been
+        # evicted from memcache are skipped.
+        with mock.patch.object(cache, "IDENTITY_PUT_BATCH", 1):
+            stats = cache.persist_gae_bingo_identity_records(
+                    ["monkey", "gorilla", "monkey", "evicted"])
+        self.assertEqual({"written": 2, "unchanged": 0, "missing": 1}, stats)
+        self.assertIsNotNone(models._GAEBingoIdentityRecord.load("monkey"))
+        self.assertIsNotNone(models._GAEBingoIdentityRecord.load("gorilla"))
+        self.assertIsNone(models._GAEBingoIdentityRecord.load("evicted"))
+
+    def test_persist_skips_unchanged_identity_records(self):
+        identity_cache = cache.BingoIdentityCache()
+        memcache.set(cache.BingoIdentityCache.key_for_identity("monkey"),
+                     identity_cache)
+        stats = cache.persist_gae_bingo_identity_records(["monkey"])
+        self.assertEqual(1, stats["written"])
+
+        # Nothing's changed, so nothing's written...
+        stats = cache.persist_gae_bingo_identity_records(["monkey"])
+        self.assertEqual(1, stats["unchanged"])
+
+        # ...even once the cached fingerprint has been evicted...
+        memcache.delete(cache.IDENTITY_FINGERPRINT_PREFIX + "monkey")
+        stats = cache.persist_gae_bingo_identity_records(["monkey"])
+        self.assertEqual(1, stats["unchanged"])
+
+        # ...until the identity's history changes.
+        identity_cache.participate_in("monkeys")
+        memcache.set(cache.BingoIdentityCache.key_for_identity("monkey"),
+                     identity_cache)
+        stats = cache.persist_gae_bingo_identity_records(["monkey"])
+        self.assertEqual(1, stats["written"])
+
+    def test_legacy_identity_buckets_drained(self):
+        bucket_key = "_gae_bingo_identity_bucket:50"
+        memcache.set(bucket_key, [166, 167])
+
+        self.assertEqual(2, cache.BingoIdentityCache.drain_legacy_buckets())
+        self.assertIsNone(memcache.get(bucket_key))
+        self.assertEqual(0, cache.BingoIdentityCache.drain_legacy_buckets())
+
+    def test_identities_fall_back_to_buckets_wout_queue(self):
+        identity_cache = cache.BingoIdentityCache()
+        identity_cache.participate_in("monkeys")
+        with mock.patch.object(cache.config, "IDENTITY_QUEUE_NAME", None):
+            identity_cache.store_for_identity_if_dirty("monkey")
+
+        self.assertIsNotNone(memcache.get(
+                cache.BingoIdentityCache.key_for_identity("monkey")))
+        self.assertEqual(1, cache.BingoIdentityCache.drain_legacy_buckets())
+
+    def test_persist_only_writes_changes(self):
+        bingo_cache = cache.BingoCache()
+        experiment, alternatives = models.create_experiment_and_alternatives(
+                "monkeys", "monkeys")
+        bingo_cache.add_experiment(experiment, alternatives)
+
+        # New experiments are written along with all of their alternatives...
+        stats = bingo_cache.persist_to_datastore()
+        self.assertEqual(1, stats["experiments_written"])
+        self.assertEqual(2, stats["alternatives_written"])
+
+        # ...but nothing's written if nothing has changed since.
+        stats = bingo_cache.persist_to_datastore()
+        self.assertEqual(0, stats["experiments_written"])
+        self.assertEqual(1, stats["experiments_skipped"])
+        self.assertEqual(0, stats["alternatives_written"])
+        self.assertEqual(2, stats["alternatives_skipped"])
+
+        # Only the alternative w/ new participants gets written...
+        alternative = bingo_cache.get_alternatives("monkeys")[1]
+        self.assertTrue(alternative.increment_participants_async().get_result())
+        stats = bingo_cache.persist_to_datastore()
+        self.assertEqual(0, stats["experiments_written"])
+        self.assertEqual(1, stats["alternatives_written"])
+        self.assertEqual(1,
+                bingo_cache.get_alternatives("monkeys")[1].participants)
+
+        # ...and only experiments w/ changed properties get written.
+        experiment = bingo_cache.get_experiment("monkeys")
+        experiment.live = False
+        bingo_cache.update_experiment(experiment)
+        stats = bingo_cache.persist_to_datastore()
+        self.assertEqual(1, stats["experiments_written"])
+        self.assertEqual(2, stats["alternatives_written"])
+        self.assertEqual(set(), bingo_cache.get_unpersisted_experiment_names())
+
+    def test_parallel_persists_merge_counts(self):
+        bingo_cache = cache.BingoCache()
+        for name in ["monkeys", "gorillas"]:
+            bingo_cache.add_experiment(
+                    *models.create_experiment_and_alternatives(name, name))
+        bingo_cache.persist_to_datastore()
+
+        # Two shards each persist their own experiment from the same, soon to
+        # be stale, copy of the shared cache...
+        def load_copy():
+            return cache.CacheLayers.decompress(
+                    memcache.get(cache.BingoCache.CACHE_KEY))
+        monkeys_copy = load_copy()
+        gorillas_copy = load_copy()
+
+        alternative = monkeys_copy.get_alternatives("monkeys")[0]
+        self.assertTrue(alternative.increment_participants_async().get_result())
+        monkeys_copy.persist_to_datastore(experiment_names=["monkeys"])
+
+        alternative = gorillas_copy.get_alternatives("gorillas")[1]
+        self.assertTrue(alternative.increment_conversions_async().get_result())
+        gorillas_copy.persist_to_datastore(experiment_names=["gorillas"])
+
+        # ...and neither one's counts get clobbered by the other.
+        shared = load_copy()
+        self.assertEqual(1, shared.get_alternatives("monkeys")[0].participants)
+        self.assertEqual(1, shared.get_alternatives("gorillas")[1].conversions)
+
+    def test_stale_dirty_copy_merges_into_shared_cache(self):
+        bingo_cache = cache.BingoCache()
+        bingo_cache.add_experiment(*models.create_experiment_and_alternatives(
+                "monkeys", "monkeys"))
+        bingo_cache.persist_to_datastore()
+        stale_copy = cache.CacheLayers.decompress(
+                memcache.get(cache.BingoCache.CACHE_KEY))
+
+        # One shard merges new counts into the shared cache...
+        alternative = bingo_cache.get_alternatives("monkeys")[0]
+        self.assertTrue(alternative.increment_participants_async().get_result())
+        bingo_cache.persist_to_datastore()
+
+        # ...while a stale copy gains an experiment and persists it...
+        stale_copy.add_experiment(*models.create_experiment_and_alternatives(
+                "gorillas", "gorillas"))
+        stale_copy.persist_to_datastore(experiment_names=["gorillas"])
+
+        # ...w/out overwriting the other shard's counts.
+        shared = cache.CacheLayers.decompress(
+                memcache.get(cache.BingoCache.CACHE_KEY))
+        self.assertEqual(1, shared.get_alternatives("monkeys")[0].participants)
+        self.assertIsNotNone(shared.get_experiment("gorillas"))
+
+    def test_persist_conversions_sq(self):
+        bingo_cache = cache.BingoCache()
+        bingo_cache.add_experiment(*models.create_experiment_and_alternatives(
+                "monkeys", "monkeys",
+                conversion_type=models.ConversionTypes.Counting))
+        bingo_cache.persist_to_datastore()
+
+        # One participant converting a 1st and 2nd time adds 1 + 3 = 2^2
+        alternative = bingo_cache.get_alternatives("monkeys")[0]
+        for conversion_count in [1, 2]:
+            self.assertTrue(alternative.increment_conversions_sq_async(
+                    conversion_count).get_result())
+        bingo_cache.persist_to_datastore()
+
+        self.assertEqual(4,
+                bingo_cache.get_alternatives("monkeys")[0].conversions_sq)
+
+        # Binary experiments don't track sums of squares at all
+        _, alternatives = models.create_experiment_and_alternatives(
+                "gorillas", "gorillas")
+        self.assertIsNone(alternatives[0].conversions_sq)
+
+    def test_persist_invalidates_conversions_sq(self):
+        bingo_cache = cache.BingoCache()
+        experiment, alternatives = models.create_experiment_and_alternatives(
+                "monkeys", "monkeys",
+                conversion_type=models.ConversionTypes.Counting)
+        # Alternatives from before sums of squares were tracked have None
+        alternatives[1].conversions_sq = None
+        bingo_cache.add_experiment(experiment, alternatives)
+        bingo_cache.persist_to_datastore()
+
+        # Increments too big for a synchronized counter invalidate the sum...
+        alternative, legacy = bingo_cache.get_alternatives("monkeys")
+        self.assertFalse(alternative.increment_conversions_sq_async(
+                models.MAX_CONVERSIONS_SQ_DELTA).get_result())
+        self.assertIsNone(alternative.latest_conversions_sq_count())
+        # ...and legacy sums aren't started from a partial count.
+        self.assertTrue(legacy.increment_conversions_sq_async(1).get_result())
+        bingo_cache.persist_to_datastore()
+
+        alternative, legacy = bingo_cache.get_alternatives("monkeys")
+        self.assertIsNone(alternative.conversions_sq)
+        self.assertIsNone(legacy.conversions_sq)
+
+    def test_generation_changes_when_shared_cache_does(self):
+        bingo_cache = cache.BingoCache()
+        bingo_cache.add_experiment(*models.create_experiment_and_alternatives(
+                "monkeys", "monkeys"))
+        bingo_cache.store_if_dirty()
+        generation = cache.BingoCache.generation()
+        self.assertIsNotNone(generation)
+
+        bingo_cache.persist_to_datastore()
+        self.assertNotEqual(generation, cache.BingoCache.generation())
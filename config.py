@@ -6,6 +6,37 @@ class _ConfigDefaults(object):
     # if you'd like to use a non-default task queue.
     QUEUE_NAME = "default"
 
+    # CUSTOMIZE set identity_queue_name to a pull queue (e.g.
+    # "gae-bingo-identities") to hold identities waiting for their histories
+    # to be persisted. It must be declared as a pull queue in your app's
+    # queue.yaml (see yaml/queue.yaml). By default identities wait in
+    # memcache buckets instead, which concurrent requests can drop
+    # identities from.
+    IDENTITY_QUEUE_NAME = None
+
+    # CUSTOMIZE set use_durable_journal to True if you want participation and
+    # conversion counts to survive memcache evictions between persists. Every
+    # counter increment will also be appended to journal_queue_name, which
+    # must be declared as a pull queue in your app's queue.yaml (see
+    # yaml/queue.yaml).
+    USE_DURABLE_JOURNAL = False
+    JOURNAL_QUEUE_NAME = "gae-bingo-journal"
+
+    # CUSTOMIZE set persist_shards to split persisting experiments' counters
+    # across this many parallel, independently locked persist task chains.
+    # Raise this if a single persist takes long enough that counters risk
+    # overflowing between persists. At most shards.NUM_PARTITIONS shards are
+    # used.
+    PERSIST_SHARDS = 1
+
+    # CUSTOMIZE persist_lag_alarm_seconds to change how long any part of the
+    # persist pipeline can go without a successful run before
+    # /gae_bingo/api/v1/persist_status raises its alarm. Set
+    # persist_telemetry_to_datastore to True to also put every persist run's
+    # stats in the datastore (one small entity per run).
+    PERSIST_LAG_ALARM_SECONDS = 5 * 60
+    PERSIST_TELEMETRY_TO_DATASTORE = False
+
     # CUSTOMIZE can_see_experiments however you want to specify
     # whether or not the currently-logged-in user has access
     # to the experiment dashboard.
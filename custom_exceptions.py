@@ -1,3 +1,8 @@
 class InvalidRedirectURLError(Exception):
     """Raised when there is a redirect attempt to an absolute url."""
     pass
+
+
+class StalePersistLockError(Exception):
+    """Raised when writing under a PersistLock whose lease has been lost."""
+    pass
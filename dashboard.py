@@ -8,6 +8,8 @@ from google.appengine.ext.webapp import RequestHandler
 from .identity import can_control_experiments
 from .cache import BingoCache
 from .stats import describe_result_in_words
+import bayes
+import export
 
 class Dashboard(RequestHandler):
 
@@ -57,17 +59,20 @@ class Export(RequestHandler):
             writer.writerow([])
             writer.writerow([])
 
-            for experiment, alternatives in zip(experiments, alternatives):
+            summaries = bayes.summarize_experiments(
+                    zip(experiments, alternatives))
+
+            for experiment, alternatives, summary in zip(experiments, alternatives, summaries):
 
                 writer.writerow(["CONVERSION NAME: %s" % experiment.conversion_name])
                 writer.writerow([])
 
-                writer.writerow(["ALTERNATIVE NUMBER", "CONTENT", "PARTICIPANTS", "CONVERSIONS", "CONVERSION RATE"])
-                for alternative in alternatives:
-                    writer.writerow([alternative.number, alternative.content, alternative.participants, alternative.conversions, alternative.conversion_rate])
+                writer.writerow(["ALTERNATIVE NUMBER", "CONTENT", "PARTICIPANTS", "CONVERSIONS", "CONVERSION RATE", "PROBABILITY BEST", "EXPECTED LOSS"])
+                for alternative, bayesian in zip(alternatives, summary):
+                    writer.writerow([alternative.number, alternative.content, alternative.participants, alternative.conversions, alternative.conversion_rate, bayesian["probability_best"], bayesian["expected_loss"]])
 
                 writer.writerow([])
-                writer.writerow(["SIGNIFICANCE TEST RESULTS: %s" % describe_result_in_words(alternatives)])
+                writer.writerow(["SIGNIFICANCE TEST RESULTS: %s" % describe_result_in_words(alternatives, experiment.conversion_type)])
                 writer.writerow([])
 
                 writer.writerow([])
@@ -80,3 +85,56 @@ class Export(RequestHandler):
         finally:
 
             f.close()
+
+
+class ExportAll(RequestHandler):
+    """Export many experiments' results, a batch at a time. See export.py.
+
+    Params:
+        format: "csv" (default) or "ndjson"
+        canonical_name: export experiments w/ this canonical name, can be
+            given more than once. Every experiment is exported if not given.
+        archives: "1" to export archived experiments, "all" to export both
+            archived and unarchived ones
+        snapshots: "1" to include every snapshot sample
+        gzip: "1" to gzip the export
+        cursor: the previous response's export.CURSOR_HEADER, if any
+    """
+
+    def get(self):
+
+        if not can_control_experiments():
+            self.redirect("/")
+            return
+
+        output_format = self.request.get("format") or export.CSV
+        if output_format not in export.FORMATS:
+            self.error(400)
+            return
+
+        archives = {"1": True, "all": None}.get(
+                self.request.get("archives"), False)
+        compress = self.request.get("gzip") == "1"
+
+        filename = "gae_bingo-export.%s" % output_format
+        if compress:
+            filename += ".gz"
+            self.response.headers["Content-Type"] = "application/gzip"
+        else:
+            self.response.headers["Content-Type"] = (
+                    export.CONTENT_TYPES[output_format])
+        self.response.headers["Content-Disposition"] = (
+                "attachment; filename=%s" % filename)
+
+        # The response is buffered until the handler returns, so the cursor
+        # header can still be set after writing the body.
+        cursor = export.export(self.response.out,
+                cursor=self.request.get("cursor") or None,
+                archives=archives,
+                canonical_names=self.request.get_all("canonical_name"),
+                output_format=output_format,
+                include_snapshots=self.request.get("snapshots") == "1",
+                compress=compress)
+
+        if cursor:
+            self.response.headers[export.CURSOR_HEADER] = cursor
@@ -0,0 +1,95 @@
+"""Early, targeted drains of synchronized counters that are nearing overflow.
+
+Synchronized counters roll over (and wipe their entire combination) once any
+single counter passes MAX_COUNTER_VALUE, so the persist chain must pop them
+often enough to keep that from happening. If the persist chain falls behind
+on a hot experiment, the counters warn once they pass
+WARNING_HIGH_COUNTER_VALUE. At that point we queue a drain task that pops and
+persists only that experiment's counters (see persist.DrainExperimentTask)
+instead of waiting for the next full persist.
+
+Drains are rate limited per experiment so a hot experiment whose counters are
+above the warning threshold for many increments in a row only queues one
+drain every MIN_SECONDS_BETWEEN_DRAINS. Tasks are also named by experiment
+and time window so multiple instances can't queue duplicates.
+"""
+import hashlib
+import logging
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+
+from config import config
+import instance_cache
+
+
+DRAIN_URL = "/gae_bingo/persist/drain"
+
+# Each experiment will be drained early at most once per this many seconds
+MIN_SECONDS_BETWEEN_DRAINS = 10
+
+# Memcache counters of drains queued and of near-overflows rescued by drains
+REQUESTED_KEY = "_gae_bingo_early_drain:requested"
+RESCUED_KEY = "_gae_bingo_early_drain:rescued"
+
+
+def _gate_key(experiment_name):
+    return "_gae_bingo_early_drain_gate:%s" % experiment_name
+
+
+def _task_name(experiment_name, window):
+    # Task names are restricted to [a-zA-Z0-9_-], so hash experiment names.
+    if isinstance(experiment_name, unicode):
+        experiment_name = experiment_name.encode("utf-8")
+    sig = hashlib.md5(experiment_name).hexdigest()
+    return "gae-bingo-drain-%s-%s" % (sig, window)
+
+
+def queue_drain(experiment_name):
+    """Queue a drain of experiment_name's counters unless one was just queued.
+
+    Returns:
+        True if a new drain task was queued, False otherwise.
+    """
+    gate_key = _gate_key(experiment_name)
+
+    # Cheap per-instance check first so a hot experiment doesn't hit memcache
+    # on every single increment while we wait for the drain to run...
+    if instance_cache.get(gate_key):
+        return False
+    instance_cache.set(gate_key, True, expiry=MIN_SECONDS_BETWEEN_DRAINS)
+
+    # ...then rate limit across all instances.
+    if not memcache.add(gate_key, True, time=MIN_SECONDS_BETWEEN_DRAINS):
+        return False
+
+    window = int(time.time() / MIN_SECONDS_BETWEEN_DRAINS)
+
+    try:
+        taskqueue.add(url=DRAIN_URL,
+                params={"experiment_name": experiment_name},
+                name=_task_name(experiment_name, window),
+                queue_name=config.QUEUE_NAME)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        return False
+
+    logging.info("Queued early drain of gae/bingo counters for %s" %
+            experiment_name)
+    memcache.incr(REQUESTED_KEY, initial_value=0)
+    return True
+
+
+def record_rescues(count):
+    """Record that a drain popped count counters before they could overflow."""
+    if count:
+        memcache.incr(RESCUED_KEY, delta=count, initial_value=0)
+
+
+def stats():
+    """Return the # of early drains queued and near-overflows rescued."""
+    counts = memcache.get_multi([REQUESTED_KEY, RESCUED_KEY])
+    return {
+        "drains_requested": int(counts.get(REQUESTED_KEY) or 0),
+        "near_overflows_rescued": int(counts.get(RESCUED_KEY) or 0),
+    }
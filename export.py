@@ -0,0 +1,233 @@
+"""Bulk export of experiments' results for offline analysis.
+
+dashboard.ExportAll writes every matching experiment's alternatives' counts,
+and optionally their full snapshot timelines, as CSV or newline-delimited
+JSON. Experiments are read from the datastore a batch at a time w/ a query
+cursor, so archived experiments can be exported too and memory use is
+bounded by a batch no matter how many experiments there are. Each batch is
+written out (and gzipped, if asked for) as soon as it's loaded.
+
+Requests have a deadline, so an export stops after EXPORT_SECONDS and hands
+back a cursor in the CURSOR_HEADER response header. Requesting the export
+again w/ that cursor picks up where the last response left off, and an
+export is complete once a response has no cursor. Concatenating the
+responses gives the full export: CSV headers are only written by the first
+response, and concatenated gzip members are a valid gzip file.
+
+Live experiments' counts include memcache's running counts. Experiments
+created since the latest persist aren't in the datastore yet, so they're
+left out until it runs.
+"""
+import csv
+import datetime
+import StringIO
+import time
+import zlib
+
+from collections import defaultdict
+
+from .models import AlternativeView, _GAEBingoAlternative, _GAEBingoExperiment
+from .jsonify import dumps, jsonify
+import snapshots
+import synchronized_counter
+
+CSV = "csv"
+NDJSON = "ndjson"
+FORMATS = [CSV, NDJSON]
+
+CONTENT_TYPES = {
+    CSV: "text/csv",
+    NDJSON: "application/x-ndjson",
+}
+
+# Experiments are loaded and written this many at a time
+BATCH_SIZE = 50
+
+# An export response stops after working for this long
+EXPORT_SECONDS = 30
+
+CURSOR_HEADER = "X-GAE-Bingo-Export-Cursor"
+
+# Rows of an alternative's latest counts have an empty timestamp, and rows of
+# its snapshot samples have the sample's time.
+CSV_COLUMNS = ["canonical_name", "experiment_name", "conversion_name",
+               "conversion_type", "live", "archived", "dt_started",
+               "alternative_number", "content", "participants",
+               "conversions", "conversions_sq", "conversion_rate",
+               "timestamp"]
+
+
+def query_experiments(archives=False, canonical_name=None):
+    """Query for the experiments to export.
+
+    Args:
+        archives: True for only archived experiments, False for only
+            unarchived ones, or None for both
+        canonical_name: only export experiments w/ this canonical name
+    """
+    query = _GAEBingoExperiment.all()
+    if archives is not None:
+        query.filter("archived =", archives)
+    if canonical_name is not None:
+        query.filter("canonical_name =", canonical_name)
+    return query
+
+
+def load_batch(experiments, include_snapshots=False):
+    """Load a batch of experiments' alternatives and timelines together.
+
+    Returns:
+        A list of each experiment's (alternatives, samples) pair, where
+        alternatives are AlternativeViews and samples are None unless
+        include_snapshots.
+    """
+    # Kick off every experiment's query w/ run() so they'll run in parallel
+    alternative_queries = [_GAEBingoAlternative.all()
+                               .ancestor(experiment).run()
+                           for experiment in experiments]
+
+    samples_list = [None] * len(experiments)
+    if include_snapshots:
+        samples_list = snapshots.load_samples_multi(experiments,
+                                                    max_points=None)
+
+    alternative_lists = [sorted(query, key=lambda alt: alt.number)
+                         for query in alternative_queries]
+
+    # Archived experiments' names can be reused by live ones, so the running
+    # counts under their names belong to someone else.
+    running_counts = synchronized_counter.SynchronizedCounter.get_multi(
+            list(AlternativeView.counter_keys(
+                alternative
+                for experiment, alternatives
+                in zip(experiments, alternative_lists)
+                if not experiment.archived
+                for alternative in alternatives)))
+    no_running_counts = defaultdict(
+            lambda: [0] * synchronized_counter.COUNTERS_PER_COMBINATION)
+
+    return [([AlternativeView(alternative,
+                              no_running_counts if experiment.archived
+                              else running_counts)
+              for alternative in alternatives], samples)
+            for experiment, alternatives, samples
+            in zip(experiments, alternative_lists, samples_list)]
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+
+def _csv_rows(experiment, alternatives, samples):
+    """Rows of an experiment's latest counts and then any samples."""
+    experiment_columns = [experiment.canonical_name, experiment.name,
+                          experiment.conversion_name,
+                          experiment.conversion_type, experiment.live,
+                          experiment.archived,
+                          dumps(experiment.dt_started)]
+
+    contents = {}
+    for alternative in alternatives:
+        contents[alternative.number] = alternative.content
+        yield experiment_columns + [
+                alternative.number, alternative.content,
+                alternative.participants, alternative.conversions,
+                alternative.conversions_sq, alternative.conversion_rate, ""]
+
+    for ts, counts in samples or []:
+        sampled = dumps(datetime.datetime.utcfromtimestamp(ts))
+        for number in sorted(counts):
+            participants, conversions = counts[number]
+            rate = float(conversions) / participants if participants else 0
+            yield experiment_columns + [
+                    number, contents.get(number, ""), participants,
+                    conversions, "", rate, sampled]
+
+
+def _ndjson_record(experiment, alternatives, samples):
+    record = dumps(experiment)
+    record["alternatives"] = dumps(alternatives)
+    if samples is not None:
+        record["timeline"] = samples
+    # jsonify doesn't escape non-ASCII, so this can be unicode
+    return _encode(jsonify(record, compact=True))
+
+
+def export(out, cursor=None, archives=False, canonical_names=None,
+           output_format=CSV, include_snapshots=False, compress=False):
+    """Write experiments' results to out, a batch at a time.
+
+    Args:
+        out: file-like object to write to
+        cursor: cursor returned by the previous response of this export
+        archives: see query_experiments
+        canonical_names: only export experiments w/ these canonical names
+        output_format: CSV or NDJSON
+        include_snapshots: True to include every snapshot sample
+        compress: True to gzip the output
+    Returns:
+        A cursor to continue the export from, or None if it's complete.
+    """
+    deadline = time.time() + EXPORT_SECONDS
+
+    compressor = None
+    if compress:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def write(data):
+        if compressor:
+            data = compressor.compress(data)
+        out.write(data)
+
+    # A single canonical name can be filtered by the datastore. Any more
+    # would need an IN filter, which doesn't support cursors.
+    canonical_names = set(canonical_names or [])
+    single_canonical_name = None
+    if len(canonical_names) == 1:
+        single_canonical_name = iter(canonical_names).next()
+
+    if output_format == CSV and not cursor:
+        buffer = StringIO.StringIO()
+        csv.writer(buffer).writerow(CSV_COLUMNS)
+        write(buffer.getvalue())
+
+    while True:
+        query = query_experiments(archives, single_canonical_name)
+        if cursor:
+            query.with_cursor(cursor)
+        fetched = query.fetch(BATCH_SIZE)
+
+        experiments = [experiment for experiment in fetched
+                       if not canonical_names or
+                          experiment.canonical_name in canonical_names]
+        batch = load_batch(experiments, include_snapshots)
+
+        buffer = StringIO.StringIO()
+        if output_format == CSV:
+            writer = csv.writer(buffer)
+            for experiment, (alternatives, samples) in zip(experiments,
+                                                           batch):
+                for row in _csv_rows(experiment, alternatives, samples):
+                    writer.writerow(map(_encode, row))
+        else:
+            for experiment, (alternatives, samples) in zip(experiments,
+                                                           batch):
+                buffer.write(_ndjson_record(experiment, alternatives,
+                                            samples))
+                buffer.write("\n")
+        write(buffer.getvalue())
+
+        if len(fetched) < BATCH_SIZE:
+            cursor = None
+            break
+
+        cursor = query.cursor()
+        if time.time() > deadline:
+            break
+
+    if compressor:
+        out.write(compressor.flush())
+
+    return cursor
@@ -0,0 +1,79 @@
+import csv
+import gzip
+import json
+import StringIO
+
+from google.appengine.ext import db
+import mock
+
+from testutil import gae_model
+
+from . import export
+from . import models
+
+
+class ExportTest(gae_model.GAEModelTestCase):
+    def setUp(self):
+        super(ExportTest, self).setUp()
+        for name, archived in [("monkeys", False), ("old monkeys", True)]:
+            experiment, alternatives = (
+                    models.create_experiment_and_alternatives(name, name))
+            experiment.archived = archived
+            for alternative in alternatives:
+                alternative.participants = 10
+                alternative.conversions = alternative.number
+            db.put([experiment] + alternatives)
+
+    def test_csv_export(self):
+        out = StringIO.StringIO()
+        self.assertIsNone(export.export(out, archives=None))
+
+        rows = list(csv.reader(StringIO.StringIO(out.getvalue())))
+        self.assertEqual(export.CSV_COLUMNS, rows[0])
+        self.assertEqual(4, len(rows[1:]))
+        self.assertEqual(set(["monkeys", "old monkeys"]),
+                         set(row[0] for row in rows[1:]))
+
+    def test_ndjson_export_of_canonical_names(self):
+        out = StringIO.StringIO()
+        export.export(out, canonical_names=["monkeys", "old monkeys"],
+                      output_format=export.NDJSON)
+
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(["monkeys"], [r["canonical_name"] for r in records])
+        self.assertEqual([0, 1], [a["conversions"]
+                                  for a in records[0]["alternatives"]])
+
+    def test_export_continues_from_cursor_gzipped(self):
+        responses = []
+        cursor = None
+        with mock.patch.object(export, "BATCH_SIZE", 1), \
+                mock.patch.object(export, "EXPORT_SECONDS", -1):
+            while True:
+                out = StringIO.StringIO()
+                cursor = export.export(out, cursor=cursor, archives=None,
+                                       compress=True)
+                responses.append(out.getvalue())
+                if not cursor:
+                    break
+
+        self.assertTrue(len(responses) > 1)
+        exported = gzip.GzipFile(
+                fileobj=StringIO.StringIO("".join(responses))).read()
+        rows = list(csv.reader(StringIO.StringIO(exported)))
+        self.assertEqual(export.CSV_COLUMNS, rows[0])
+        self.assertEqual(4, len(rows[1:]))
+
+    def test_gzipped_ndjson_of_non_ascii_content(self):
+        experiment, alternatives = models.create_experiment_and_alternatives(
+                u"caf\xe9s", u"caf\xe9s",
+                alternative_params=[u"cr\xe8me", u"lait"])
+        db.put([experiment] + alternatives)
+
+        out = StringIO.StringIO()
+        export.export(out, canonical_names=[u"caf\xe9s"],
+                      output_format=export.NDJSON, compress=True)
+
+        exported = gzip.GzipFile(fileobj=StringIO.StringIO(out.getvalue()))
+        record = json.loads(exported.read().decode("utf-8"))
+        self.assertEqual(u"cr\xe8me", record["alternatives"][0]["content"])
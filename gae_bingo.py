@@ -1,4 +1,3 @@
-import datetime
 import hashlib
 import logging
 import re
@@ -8,6 +7,8 @@ import urllib
 from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
+import archives
+import assignments
 import cache
 from .cache import BingoCache, BingoIdentityCache, bingo_and_identity_cache
 from .models import create_experiment_and_alternatives, ConversionTypes
@@ -270,6 +271,10 @@ def score_conversion_async(experiment_name, identity_val=None):
     if (yield alternative.increment_conversions_async()):
         bingo_identity_cache.convert_in(experiment_name)
 
+        if experiment.conversion_type == ConversionTypes.Counting:
+            yield alternative.increment_conversions_sq_async(
+                    bingo_identity_cache.converted_tests[experiment_name])
+
 
 class ExperimentModificationException(Exception):
     """An exception raised when calls to control or modify an experiment
@@ -298,10 +303,14 @@ class ExperimentController(object):
     _lock_set = False
 
     def __enter__(self):
-        self.lock = PersistLock()
-        if not self.lock.spin_and_take():
-            raise ExperimentModificationException(
-                    "Unable to acquire lock to modify experiments")
+        # Every persist shard writes alternatives, so hold all of their locks.
+        self.locks = []
+        for lock in PersistLock.for_all_shards():
+            if not lock.spin_and_take():
+                self._release_locks()
+                raise ExperimentModificationException(
+                        "Unable to acquire lock to modify experiments")
+            self.locks.append(lock)
         ExperimentController._lock_set = True
 
     def __exit__(self, exc_type, exc_value, traceback):
@@ -313,9 +322,14 @@ class ExperimentController(object):
         ExperimentController._lock_set = False
         logging.info(
                 "Exiting monitor from ExperimentController. About to "
-                "release the lock (current value: [%s])" %
-                self.lock.is_active())
-        self.lock.release()
+                "release the locks (current values: [%s])" %
+                [lock.is_active() for lock in self.locks])
+        self._release_locks()
+
+    def _release_locks(self):
+        for lock in self.locks:
+            lock.release()
+        self.locks = []
 
     @staticmethod
     def assert_safe():
@@ -360,7 +374,7 @@ def delete_experiment(canonical_name, retrieve_archives=False):
     ExperimentController.assert_safe()
 
     if retrieve_archives:
-        bingo_cache = BingoCache.load_from_datastore(archives=True)
+        bingo_cache = archives.load_bingo_cache([canonical_name])
     else:
         bingo_cache = BingoCache.get()
 
@@ -376,6 +390,9 @@ def delete_experiment(canonical_name, retrieve_archives=False):
     for experiment in experiments:
         bingo_cache.delete_experiment_and_alternatives(experiment)
 
+    if retrieve_archives:
+        archives.remove_from_index(canonical_name)
+
 def archive_experiment(canonical_name):
     """Archive named experiment permanently, removing it from active cache."""
 
@@ -399,6 +416,8 @@ def archive_experiment(canonical_name):
             logging.info("Archiving %s" % experiment.name)
         bingo_cache.archive_experiment_and_alternatives(experiment)
 
+    archives.add_to_index(experiments, alternative_lists)
+
 def resume_experiment(canonical_name):
     ExperimentController.assert_safe()
     bingo_cache = BingoCache.get()
@@ -435,7 +454,8 @@ def get_experiment_participation(identity_val=None):
         expts.add(t if i == -1 else t[0:i])
 
     # now get the alternative this user is participating in, as long as it is
-    # actually a canonical name (just skip the ones that are not)
+    # actually a canonical name (just skip the ones that are not). These all
+    # share one assignments.for_identity pass.
     return {e: find_alternative_for_user(e, identity_val) for e in expts
             if e in bingo_cache.experiment_names_by_canonical_name}
 
@@ -473,9 +493,21 @@ def find_alternative_for_user(canonical_name, identity_val):
         # Experiment has ended - return result that was selected.
         return experiment.short_circuit_content
 
-    return _find_alternative_for_user(experiment,
-                bingo_cache.get_alternatives(experiment_name),
-                identity_val).content
+    cookie_alternative = _find_cookie_alternative_for_user(experiment,
+            bingo_cache.get_alternatives(experiment_name))
+    if cookie_alternative:
+        return cookie_alternative.content
+
+    # Every experiment's alternative for this identity is picked at once
+    identity_val = identity(identity_val)
+    assigned = assignments.for_identity(identity_val, bingo_cache)
+    if canonical_name in assigned:
+        return assigned[canonical_name]
+
+    # Experiments missing from the plan are chosen for directly
+    alternative = modulo_choose(experiment,
+            bingo_cache.get_alternatives(experiment_name), identity_val)
+    return alternative.content if alternative else None
 
 
 def find_cookie_val_for_user(experiment_name):
@@ -521,26 +553,10 @@ def _find_alternative_for_user(experiment,
 
 def modulo_choose(experiment, alternatives, identity):
 
-    alternatives_weight = sum(map(lambda alt: alt.weight, alternatives))
-
-    sig = hashlib.md5(experiment.hashable_name + str(identity)).hexdigest()
-    sig_num = int(sig, base=16)
-    index_weight = sig_num % alternatives_weight
-    current_weight = alternatives_weight
-
-    # TODO(eliana) remove once current expts end
-    if experiment.dt_started > datetime.datetime(2013, 3, 26, 18, 0, 0, 0):
-        sorter = lambda alt: (alt.weight, alt.number)
-    else:
-        sorter = lambda alt: alt.weight
-
-    for alternative in sorted(alternatives,
-                              key=sorter,
-                              reverse=True):
-
-        current_weight -= alternative.weight
-        if index_weight >= current_weight:
-            return alternative
+    total_weight, thresholds = assignments.weight_thresholds(experiment,
+                                                             alternatives)
+    signature = hashlib.md5(experiment.hashable_name + str(identity))
+    return assignments.choose(signature, total_weight, thresholds)
 
 def create_redirect_url(destination, conversion_names):
     """ Create a URL that redirects to destination after scoring conversions
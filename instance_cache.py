@@ -30,8 +30,10 @@ Not everything are upsides. You can not use it on every case because:
 
 # TODO(chris): implement an LRU cache. currently we store all sorts of
 # things in instance memory by default via layer_cache, and these
-# things might never be reaped.
+# things might never be reaped. LRUCache below is a bounded alternative
+# for callers that can opt in.
 
+import collections
 import time
 import logging
 import os
@@ -170,3 +172,54 @@ def flush():
     global _CACHE
     with _CACHE_LOCK:
         _CACHE = {}
+
+
+class LRUCache(object):
+    """A bounded per-instance cache, separate from the module's cache.
+
+    Holds at most max_size entries, evicting the least recently used, and
+    entries expire expiry seconds after they're set. Unlike the module's
+    cache, flush() doesn't clear it, so it's meant for values that can't go
+    stale, like results memoized by their inputs.
+    """
+
+    def __init__(self, max_size, expiry=DEFAULT_CACHING_TIME):
+        self.max_size = max_size
+        self.expiry = expiry
+        self._entries = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key):
+        """ Gets the data associated to the key or a None """
+        if ACTIVE is False:
+            return None
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+
+            value, expiry = entry
+            if expiry is not None and time.time() >= expiry:
+                return None
+
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value):
+        if ACTIVE is False:
+            return None
+
+        expiry = None
+        if self.expiry is not None:
+            expiry = time.time() + int(self.expiry)
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expiry)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
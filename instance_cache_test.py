@@ -19,3 +19,20 @@ class InstanceCacheTest(gae_model.GAEModelTestCase):
         self.adjust_time(delta_in_seconds=61)
         self.assertEquals(None, instance_cache.get('foo'))
 
+
+    def test_lru_cache_is_bounded(self):
+        lru = instance_cache.LRUCache(2, expiry=60)
+        lru.set('foo', 1)
+        lru.set('bar', 2)
+        self.assertEquals(1, lru.get('foo'))
+        lru.set('baz', 3)
+        # bar was the least recently used
+        self.assertEquals(None, lru.get('bar'))
+        self.assertEquals(1, lru.get('foo'))
+
+        # The module's cache being flushed doesn't affect LRUCaches
+        instance_cache.flush()
+        self.assertEquals(3, lru.get('baz'))
+
+        self.adjust_time(delta_in_seconds=61)
+        self.assertEquals(None, lru.get('baz'))
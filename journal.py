@@ -0,0 +1,238 @@
+"""Durable journal of participation and conversion counter increments.
+
+Synchronized counters only live in memcache between persists, so a memcache
+eviction silently loses any participants and conversions that accumulated
+since the last persist. When config.USE_DURABLE_JOURNAL is enabled, every
+successful counter increment is also recorded in this journal.
+
+Increments are buffered in the request cache for the length of a request and
+appended to a pull queue as a single batched task at the end of the request
+(see cache.store_if_dirty), one task per experiment partition tagged w/
+that partition's tag (see shards.py). Each persist shard leases the tasks
+of its own partitions, folds the journaled
+deltas into each _GAEBingoAlternative's counts, and only deletes the tasks
+once the alternatives have been put.
+
+Memcache counters remain the fast read view used by the dashboard and
+latest_participants_count()/latest_conversions_count(). While the journal is
+enabled, the counts popped from memcache during a persist are only used to
+reset that read view, and they're accumulated alongside the journaled totals
+in a reconciliation report so we can see how much memcache would've lost.
+"""
+import datetime
+import json
+import logging
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+
+from config import config
+import request_cache
+import shards
+import synchronized_counter
+
+
+# Request cache key for increments buffered during the current request
+BUFFER_KEY = "_gae_bingo_journal_buffer"
+
+# Memcache key for the memcache vs. journal reconciliation report
+RECONCILIATION_KEY = "_gae_bingo_journal_reconciliation"
+
+# How long persist leases journal tasks for before they become available to
+# be leased again (if the persist never got around to deleting them)
+LEASE_SECONDS = 5 * 60
+
+# Max # of tasks that can be leased or deleted in a single call
+TASKS_PER_BATCH = 1000
+
+# Max # of lease batches folded in by a single persist
+MAX_LEASE_BATCHES = 10
+
+
+def is_enabled():
+    return bool(config.USE_DURABLE_JOURNAL)
+
+
+def partition_tag(partition):
+    """Tag of the journal tasks holding increments for an experiment
+    partition."""
+    return "partition-%s" % partition
+
+
+def _empty_deltas():
+    return [0] * synchronized_counter.COUNTERS_PER_COMBINATION
+
+
+def record(counter_key, number, delta=1):
+    """Buffer an increment of the n'th counter in counter_key's combination.
+
+    Buffered increments are appended to the journal by flush() at the end of
+    the request.
+    """
+    if not is_enabled():
+        return
+
+    buffered = request_cache.cache.get(BUFFER_KEY)
+    if buffered is None:
+        buffered = {}
+        request_cache.cache[BUFFER_KEY] = buffered
+
+    if counter_key not in buffered:
+        buffered[counter_key] = _empty_deltas()
+    buffered[counter_key][number] += delta
+
+
+def flush():
+    """Append all of this request's buffered increments to the journal."""
+    buffered = request_cache.cache.pop(BUFFER_KEY, None)
+    if not buffered:
+        return
+
+    entries_by_partition = {}
+    for counter_key, counts in buffered.iteritems():
+        partition = shards.partition_for_counter_key(counter_key)
+        entries_by_partition.setdefault(partition, {})[counter_key] = counts
+
+    tasks = [taskqueue.Task(payload=json.dumps(entry), method="PULL",
+                            tag=partition_tag(partition))
+             for partition, entry in entries_by_partition.iteritems()]
+    try:
+        taskqueue.Queue(config.JOURNAL_QUEUE_NAME).add(tasks)
+    except taskqueue.Error, e:
+        # Memcache counters were still incremented, so these increments are
+        # only lost if memcache is evicted before the next persist.
+        logging.error("Failed to append gae/bingo journal entry: %s" % e)
+
+
+class JournalLease(object):
+    """A batch of leased journal tasks and the sum of their deltas.
+
+    Once the deltas have been folded into alternatives and put, call delete()
+    so the tasks aren't folded in again. If delete() is never called, the
+    tasks become available to the next persist when their lease expires.
+    """
+
+    def __init__(self, tasks, deltas):
+        self.tasks = tasks
+        self.deltas = deltas
+
+    def delete(self):
+        queue = taskqueue.Queue(config.JOURNAL_QUEUE_NAME)
+        for i in range(0, len(self.tasks), TASKS_PER_BATCH):
+            queue.delete_tasks(self.tasks[i:i + TASKS_PER_BATCH])
+        self.tasks = []
+
+
+def lease(tags=None):
+    """Lease pending journal tasks and sum their deltas by counter key.
+
+    Args:
+        tags: if given, only lease tasks w/ these tags (see partition_tag).
+            Each tag's tasks are leased in parallel.
+    Returns:
+        A JournalLease whose deltas are in the same form as
+        SynchronizedCounter.pop_counters' return value.
+    """
+    queue = taskqueue.Queue(config.JOURNAL_QUEUE_NAME)
+
+    tasks = []
+    deltas = {}
+
+    pending_tags = [None] if tags is None else list(tags)
+    for _ in range(MAX_LEASE_BATCHES):
+        if not pending_tags:
+            break
+
+        rpcs = []
+        for tag in pending_tags:
+            if tag is None:
+                rpcs.append((tag, queue.lease_tasks_async(LEASE_SECONDS,
+                                                          TASKS_PER_BATCH)))
+            else:
+                rpcs.append((tag, queue.lease_tasks_by_tag_async(
+                        LEASE_SECONDS, TASKS_PER_BATCH, tag)))
+
+        # Only keep leasing tags that may have more tasks waiting
+        pending_tags = []
+        for tag, rpc in rpcs:
+            leased = rpc.get_result()
+            tasks.extend(leased)
+            if len(leased) == TASKS_PER_BATCH:
+                pending_tags.append(tag)
+
+            for task in leased:
+                try:
+                    entry = json.loads(task.payload)
+                except ValueError:
+                    logging.error("Skipping corrupt gae/bingo journal task %s"
+                            % task.name)
+                    continue
+
+                for counter_key, counts in entry.iteritems():
+                    if counter_key not in deltas:
+                        deltas[counter_key] = _empty_deltas()
+                    for i, count in enumerate(counts):
+                        deltas[counter_key][i] += count
+
+    return JournalLease(tasks, deltas)
+
+
+def record_reconciliation(popped_counts, journal_deltas):
+    """Accumulate memcache and journal totals into the reconciliation report.
+
+    Only called from inside the persist task, so a plain get/set is safe.
+
+    Args:
+        popped_counts: counts popped from memcache, keyed by counter key
+        journal_deltas: journaled deltas folded in, keyed by counter key
+    """
+    report = memcache.get(RECONCILIATION_KEY) or {
+        "since": datetime.datetime.utcnow(),
+        "counters": {},
+    }
+
+    for counter_key in set(popped_counts) | set(journal_deltas):
+        if counter_key not in report["counters"]:
+            report["counters"][counter_key] = {
+                "memcache": _empty_deltas(),
+                "journal": _empty_deltas(),
+            }
+        totals = report["counters"][counter_key]
+
+        for i, count in enumerate(popped_counts.get(counter_key) or []):
+            totals["memcache"][i] += count
+        for i, count in enumerate(journal_deltas.get(counter_key) or []):
+            totals["journal"][i] += count
+
+    report["updated"] = datetime.datetime.utcnow()
+    memcache.set(RECONCILIATION_KEY, report)
+
+
+def reconciliation_report():
+    """Return memcache vs. journal totals for every journaled counter.
+
+    The returned "counters" list is sorted by how many increments memcache is
+    missing relative to the journal, worst first.
+    """
+    report = memcache.get(RECONCILIATION_KEY)
+    if not report:
+        return {"since": None, "updated": None, "counters": []}
+
+    counters = []
+    for counter_key, totals in report["counters"].iteritems():
+        memcache_total = sum(totals["memcache"])
+        journal_total = sum(totals["journal"])
+        counters.append({
+            "counter_key": counter_key,
+            "memcache": totals["memcache"],
+            "journal": totals["journal"],
+            "missing_from_memcache": journal_total - memcache_total,
+        })
+
+    counters.sort(key=lambda c: c["missing_from_memcache"], reverse=True)
+
+    return {
+        "since": report["since"],
+        "updated": report["updated"],
+        "counters": counters,
+    }
@@ -0,0 +1,45 @@
+import mock
+
+from testutil import gae_model
+
+from . import journal
+from . import request_cache
+
+
+class JournalTest(gae_model.GAEModelTestCase):
+    def test_record_is_noop_when_disabled(self):
+        with mock.patch.object(journal, "is_enabled", return_value=False):
+            journal.record("monkeys:participants", 0)
+
+        self.assertIsNone(request_cache.cache.get(journal.BUFFER_KEY))
+
+    def test_record_buffers_increments_for_request(self):
+        with mock.patch.object(journal, "is_enabled", return_value=True):
+            journal.record("monkeys:participants", 0)
+            journal.record("monkeys:participants", 0)
+            journal.record("monkeys:participants", 3)
+            journal.record("monkeys:conversions", 1, delta=2)
+
+        self.assertEqual({
+                "monkeys:participants": [2, 0, 0, 1],
+                "monkeys:conversions": [0, 2, 0, 0],
+            }, request_cache.cache.get(journal.BUFFER_KEY))
+
+    def test_reconciliation_report(self):
+        journal.record_reconciliation(
+                {"monkeys:participants": [5, 5, 0, 0],
+                 "gorillas:participants": [1, 0, 0, 0]},
+                {"monkeys:participants": [6, 7, 0, 0],
+                 "gorillas:participants": [1, 0, 0, 0]})
+        journal.record_reconciliation(
+                {"monkeys:participants": [1, 0, 0, 0]},
+                {"monkeys:participants": [1, 1, 0, 0]})
+
+        counters = journal.reconciliation_report()["counters"]
+
+        self.assertEqual(["monkeys:participants", "gorillas:participants"],
+                [c["counter_key"] for c in counters])
+        self.assertEqual([6, 5, 0, 0], counters[0]["memcache"])
+        self.assertEqual([7, 8, 0, 0], counters[0]["journal"])
+        self.assertEqual(4, counters[0]["missing_from_memcache"])
+        self.assertEqual(0, counters[1]["missing_from_memcache"])
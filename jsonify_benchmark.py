@@ -0,0 +1,74 @@
+"""Benchmark registered serializers against jsonify's reflective path.
+
+Serializes a list of experiments, w/ their alternatives attached the way
+summary.experiments_from_cache does, w/ and w/out the serializers registered
+in models.py.
+
+Run from the directory containing gae_bingo, w/ the App Engine SDK on your
+PYTHONPATH:
+
+    python -m gae_bingo.jsonify_benchmark [# of experiments]
+"""
+import sys
+import timeit
+
+from google.appengine.ext import testbed
+
+TRIALS = 5
+
+
+def make_experiments(count):
+    from gae_bingo import models
+
+    experiments = []
+    for i in xrange(count):
+        name = "benchmark experiment %s" % i
+        experiment, alternatives = models.create_experiment_and_alternatives(
+                name, name, alternative_params=["a", "b", "c", "d"])
+        for alternative in alternatives:
+            alternative.participants = 1000
+            alternative.conversions = 100 + alternative.number
+        experiment.alternatives = alternatives
+        experiments.append(experiment)
+    return experiments
+
+
+def main(count):
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_memcache_stub()
+    bed.init_datastore_v3_stub()
+
+    try:
+        # Importing models registers its serializers
+        from gae_bingo import jsonify, models
+        experiments = make_experiments(count)
+        context = {"experiment_results": experiments}
+
+        def run(compact):
+            return lambda: jsonify.jsonify(context, compact=compact)
+
+        serializers = dict(jsonify._SERIALIZERS)
+        results = []
+        for label, registered in [("reflective", {}),
+                                  ("registered", serializers)]:
+            jsonify._SERIALIZERS.clear()
+            jsonify._SERIALIZERS.update(registered)
+            for compact in [False, True]:
+                seconds = min(timeit.repeat(run(compact), number=1,
+                                            repeat=TRIALS))
+                size = len(run(compact)())
+                results.append((label, compact, seconds, size))
+
+        print "%d experiments w/ 4 alternatives each, best of %d" % (
+                count, TRIALS)
+        for label, compact, seconds, size in results:
+            print "%-10s %-8s %8.1f ms %9d bytes" % (
+                    label, "compact" if compact else "indented",
+                    seconds * 1000, size)
+    finally:
+        bed.deactivate()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
@@ -0,0 +1,50 @@
+import json
+
+from testutil import gae_model
+
+from . import api
+from . import jsonify
+from . import models
+
+
+class JsonifyTest(gae_model.GAEModelTestCase):
+    def test_registered_serializer(self):
+        experiment, alternatives = models.create_experiment_and_alternatives(
+                "monkeys", "monkeys")
+        self.assertNotIn("alternatives", jsonify.dumps(experiment))
+
+        experiment.alternatives = alternatives
+        data = jsonify.dumps(experiment)
+        self.assertEqual("monkeys", data["canonical_name"])
+        self.assertEqual([0, 1], [a["number"] for a in data["alternatives"]])
+        self.assertNotIn("participants_key", data)
+
+        data = jsonify.dumps(experiment, camel_cased=True)
+        self.assertEqual("monkeys", data["canonicalName"])
+
+    def test_compact(self):
+        data = {"monkeys": [1, (2, 3)]}
+        compact = jsonify.jsonify(data, compact=True)
+        self.assertEqual('{"monkeys":[1,[2,3]]}', compact)
+        self.assertEqual(json.loads(compact),
+                         json.loads(jsonify.jsonify(data)))
+
+    def test_alternative_view_matches_alternative(self):
+        experiment, alternatives = models.create_experiment_and_alternatives(
+                "monkeys", "monkeys",
+                conversion_type=models.ConversionTypes.Counting)
+        alternative = alternatives[1]
+        alternative.participants = 10
+        alternative.conversions = 3
+
+        running_counts = dict((key, [0, 2, 0, 0]) for key
+                in models.AlternativeView.counter_keys([alternative]))
+        running_counts[alternative.conversions_sq_invalid_key] = [0, 0, 0, 0]
+        view = models.AlternativeView(alternative, running_counts)
+
+        alternative.participants += 2
+        alternative.conversions += 2
+        alternative.conversions_sq += 2
+        expected = jsonify.dumps(alternative)
+        del expected["kind"]
+        self.assertEqual(expected, jsonify.dumps(view))
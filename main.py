@@ -10,7 +10,9 @@ from gae_bingo.config import config
 
 application = webapp2.WSGIApplication([
     ("/gae_bingo/persist", persist.GuaranteePersistTask),
+    ("/gae_bingo/persist/drain", persist.DrainExperimentTask),
     ("/gae_bingo/log_snapshot", cache.LogSnapshotToDatastore),
+    ("/gae_bingo/compact_snapshots", cache.CompactSnapshots),
     ("/gae_bingo/blotter/ab_test", blotter.AB_Test),
     ("/gae_bingo/blotter/bingo", blotter.Bingo),
 
@@ -20,13 +22,17 @@ application = webapp2.WSGIApplication([
     RedirectRoute('/gae_bingo/dashboard', redirect_to='/gae_bingo'),
     ("/gae_bingo/dashboard/archives", dashboard.Dashboard),
     ("/gae_bingo/dashboard/export", dashboard.Export),
+    ("/gae_bingo/dashboard/export_all", dashboard.ExportAll),
 
     ("/gae_bingo/api/v1/experiments", api.Experiments),
     ("/gae_bingo/api/v1/experiments/summary", api.ExperimentSummary),
     ("/gae_bingo/api/v1/experiments/conversions", api.ExperimentConversions),
+    ("/gae_bingo/api/v1/experiments/conversions/batch", api.ExperimentConversionsBatch),
     ("/gae_bingo/api/v1/experiments/control", api.ControlExperiment),
     ("/gae_bingo/api/v1/experiments/notes", api.NoteExperiment),
     ("/gae_bingo/api/v1/alternatives", api.Alternatives),
+    ("/gae_bingo/api/v1/journal/reconciliation", api.JournalReconciliation),
+    ("/gae_bingo/api/v1/persist_status", api.PersistStatus),
 
 ])
 application = middleware.GAEBingoWSGIMiddleware(application)
@@ -1,9 +1,13 @@
 from collections import defaultdict
 import datetime
+import logging
 
 from google.appengine.ext import db
 from google.appengine.ext import ndb
 
+import early_drain
+import journal
+from jsonify import register_serializer
 import pickle_util
 import synchronized_counter
 
@@ -130,10 +134,25 @@ class _GAEBingoExperiment(db.Model):
     def conversions_key(self):
         return "%s:conversions" % self.name
 
+    @property
+    def conversions_sq_key(self):
+        return "%s:conversions_sq" % self.name
+
+    @property
+    def conversions_sq_invalid_key(self):
+        return "%s:conversions_sq_invalid" % self.name
+
     def reset_counters(self):
         """Reset the participants and conversions accumulating counters."""
         synchronized_counter.SynchronizedCounter.delete_multi(
-                [self.participants_key, self.conversions_key])
+                [self.participants_key, self.conversions_key,
+                 self.conversions_sq_key, self.conversions_sq_invalid_key])
+
+
+# Above this, a conversion's increment of the sum of squared conversions
+# (2k - 1 for a participant's k'th conversion) is too big for a synchronized
+# counter, so the sum is invalidated instead.
+MAX_CONVERSIONS_SQ_DELTA = synchronized_counter.WARNING_HIGH_COUNTER_VALUE / 4
 
 
 class _GAEBingoAlternative(db.Model):
@@ -142,6 +161,13 @@ class _GAEBingoAlternative(db.Model):
     pickled_content = db.BlobProperty(indexed=False)
     conversions = db.IntegerProperty(indexed=False, default=0)
     participants = db.IntegerProperty(indexed=False, default=0)
+    # Sum over participants of the square of their # of conversions, which
+    # gives Counting experiments' variance. None if the sum isn't known:
+    # alternatives created before this existed, and alternatives that have
+    # missed an increment of it (see invalidate_conversions_sq_async).
+    # New Counting experiments' alternatives start at 0, and other
+    # experiments' stay None, see create_experiment_and_alternatives.
+    conversions_sq = db.IntegerProperty(indexed=False, default=None)
     live = db.BooleanProperty(indexed=False, default=True)
     # This is used for a db-query in cache.py:load_from_datastore()
     archived = db.BooleanProperty(indexed=True, default=False)
@@ -191,7 +217,10 @@ class _GAEBingoAlternative(db.Model):
         """
         incremented = (yield
                 synchronized_counter.SynchronizedCounter.incr_async(
-                    self.participants_key, self.number))
+                    self.participants_key, self.number,
+                    on_high_value=self._queue_early_drain))
+        if incremented:
+            journal.record(self.participants_key, self.number)
         raise ndb.Return(incremented)
 
     @ndb.tasklet
@@ -208,9 +237,67 @@ class _GAEBingoAlternative(db.Model):
         """
         incremented = (yield
             synchronized_counter.SynchronizedCounter.incr_async(
-                self.conversions_key, self.number))
+                self.conversions_key, self.number,
+                on_high_value=self._queue_early_drain))
+        if incremented:
+            journal.record(self.conversions_key, self.number)
+        raise ndb.Return(incremented)
+
+    @property
+    def conversions_sq_key(self):
+        return "%s:conversions_sq" % self.experiment_name
+
+    @property
+    def conversions_sq_invalid_key(self):
+        return "%s:conversions_sq_invalid" % self.experiment_name
+
+    @ndb.tasklet
+    def increment_conversions_sq_async(self, conversion_count):
+        """Account for a participant's conversion_count'th conversion in the
+        sum of squared conversions per participant.
+
+        Going from k - 1 to k conversions adds k^2 - (k - 1)^2 = 2k - 1.
+        Increments bigger than MAX_CONVERSIONS_SQ_DELTA would risk rolling
+        the synchronized counter over, so they aren't made. Instead, as when
+        an increment fails, the sum is invalidated.
+
+        Returns:
+            True if the sum was successfully incremented, False otherwise.
+        """
+        delta = 2 * conversion_count - 1
+        incremented = False
+        if delta <= MAX_CONVERSIONS_SQ_DELTA:
+            incremented = (yield
+                synchronized_counter.SynchronizedCounter.incr_async(
+                    self.conversions_sq_key, self.number, delta=delta,
+                    on_high_value=self._queue_early_drain))
+
+        if incremented:
+            journal.record(self.conversions_sq_key, self.number, delta)
+        else:
+            yield self.invalidate_conversions_sq_async()
         raise ndb.Return(incremented)
 
+    @ndb.tasklet
+    def invalidate_conversions_sq_async(self):
+        """Record that the sum of squared conversions missed an increment.
+
+        The next persist sets conversions_sq to None, which leaves this
+        alternative out of Welch's t-test for good.
+        """
+        incremented = (yield
+            synchronized_counter.SynchronizedCounter.incr_async(
+                self.conversions_sq_invalid_key, self.number))
+        if incremented:
+            journal.record(self.conversions_sq_invalid_key, self.number)
+        else:
+            logging.error("Failed to invalidate conversions_sq of %s:%s" %
+                          (self.experiment_name, self.number))
+
+    def _queue_early_drain(self, counter_key):
+        """Drain this experiment's counters before they can roll over."""
+        early_drain.queue_drain(self.experiment_name)
+
     def latest_participants_count(self):
         running_count = synchronized_counter.SynchronizedCounter.get(
                 self.participants_key, self.number)
@@ -221,11 +308,87 @@ class _GAEBingoAlternative(db.Model):
                 self.conversions_key, self.number)
         return self.conversions + running_count
 
+    def latest_conversions_sq_count(self):
+        """The latest sum of squared conversions, or None if it's unknown."""
+        invalidations = synchronized_counter.SynchronizedCounter.get(
+                self.conversions_sq_invalid_key, self.number)
+        if self.conversions_sq is None or invalidations:
+            return None
+        running_count = synchronized_counter.SynchronizedCounter.get(
+                self.conversions_sq_key, self.number)
+        return self.conversions_sq + running_count
+
+
+class AlternativeView(object):
+    """A read-only view of a cached _GAEBingoAlternative w/ its latest counts.
+
+    The dashboard overlays memcache's running counts on cached alternatives.
+    Views do that w/out deep copying the cached entities, and unpickle the
+    alternative's content once instead of on every access.
+    """
+    __slots__ = ["number", "experiment_name", "content", "participants",
+                 "conversions", "conversions_sq", "live", "archived",
+                 "weight"]
+
+    def __init__(self, alternative, running_counts):
+        """Build a view of alternative.
+
+        Args:
+            alternative: the cached _GAEBingoAlternative
+            running_counts: dict of counter combination keys to their
+                counters' values, as returned by SynchronizedCounter.get_multi
+        """
+        number = alternative.number
+        self.number = number
+        self.experiment_name = alternative.experiment_name
+        self.content = alternative.content
+        self.participants = (alternative.participants +
+                running_counts[alternative.participants_key][number])
+        self.conversions = (alternative.conversions +
+                running_counts[alternative.conversions_key][number])
+        self.conversions_sq = None
+        if (alternative.conversions_sq is not None and not
+                running_counts[alternative.conversions_sq_invalid_key][number]):
+            self.conversions_sq = (alternative.conversions_sq +
+                    running_counts[alternative.conversions_sq_key][number])
+        self.live = alternative.live
+        self.archived = alternative.archived
+        self.weight = alternative.weight
+
+    @staticmethod
+    def counter_keys(alternatives):
+        """The counter combination keys views of alternatives need."""
+        keys = set()
+        for alternative in alternatives:
+            keys.update([alternative.participants_key,
+                         alternative.conversions_key,
+                         alternative.conversions_sq_key,
+                         alternative.conversions_sq_invalid_key])
+        return keys
+
+    @property
+    def pretty_content(self):
+        return str(self.content).capitalize()
+
+    @property
+    def conversion_rate(self):
+        if self.participants > 0:
+            return float(self.conversions) / float(self.participants)
+        return 0
+
+    @property
+    def pretty_conversion_rate(self):
+        return "%4.2f%%" % (self.conversion_rate * 100)
+
 
 class _GAEBingoSnapshotLog(db.Model):
     """A snapshot of bingo metrics for a given experiment alternative.
 
     This is always created with the _GAEBingoExperiment as the entity parent.
+
+    These are no longer written. Snapshots are now packed into
+    _GAEBingoSnapshotChunks, and existing rows are migrated into chunks by
+    snapshots.migrate_legacy_snapshots.
     """
     alternative_number = db.IntegerProperty(indexed=False)
     conversions = db.IntegerProperty(indexed=False, default=0)
@@ -260,6 +423,70 @@ class _GAEBingoSnapshotLog(db.Model):
         return groups
 
 
+class _GAEBingoSnapshotChunk(db.Model):
+    """A period's worth of bingo metric snapshots for a given experiment.
+
+    This is always created with the _GAEBingoExperiment as the entity parent.
+    Key names sort chronologically within each resolution, so a period's
+    chunks can be queried by key range. See snapshots.py.
+    """
+    # A pickled, time-ordered list of (timestamp, counts) samples, where counts
+    # maps alternative number to a (participants, conversions) tuple.
+    pickled_samples = db.BlobProperty(indexed=False)
+    updated = db.DateTimeProperty(indexed=False, auto_now=True)
+
+    @staticmethod
+    def key_name_for(resolution, period):
+        return "_gae_bingo_snapshot_chunk:%s:%s" % (resolution, period)
+
+    @property
+    def samples(self):
+        if self.pickled_samples:
+            return pickle_util.load(self.pickled_samples)
+        return []
+
+    def set_samples(self, samples):
+        self.pickled_samples = pickle_util.dump(samples)
+
+    def add_samples(self, new_samples):
+        """Merge samples into this chunk, keeping it ordered by time.
+
+        Counts for alternatives already sampled at the same timestamp are
+        overwritten, others are kept.
+        """
+        samples_by_time = dict(self.samples)
+        for timestamp, counts in new_samples:
+            samples_by_time.setdefault(timestamp, {}).update(counts)
+        self.set_samples(sorted(samples_by_time.items()))
+
+
+class _GAEBingoSequentialTest(db.Model):
+    """Running state of an experiment's sequential test. See sequential.py.
+
+    This is always created with the _GAEBingoExperiment as the entity parent,
+    and is updated alongside the experiment's snapshot chunks.
+    """
+    # A pickled dict w/ the counts the test has seen so far and the running
+    # always-valid p-value of each alternative.
+    pickled_state = db.BlobProperty(indexed=False)
+    updated = db.DateTimeProperty(indexed=False, auto_now=True)
+
+    @staticmethod
+    def key_for_experiment(experiment_key):
+        return db.Key.from_path(_GAEBingoSequentialTest.kind(),
+                                "_gae_bingo_sequential_test",
+                                parent=experiment_key)
+
+    @property
+    def state(self):
+        if self.pickled_state:
+            return pickle_util.load(self.pickled_state)
+        return {"counts": {}, "p_values": {}}
+
+    def set_state(self, state):
+        self.pickled_state = pickle_util.dump(state)
+
+
 class _GAEBingoExperimentNotes(db.Model):
     """Notes and list of emotions associated w/ results of an experiment."""
 
@@ -300,12 +527,89 @@ class _GAEBingoExperimentNotes(db.Model):
             return None
 
 
+class _GAEBingoDashboardSummary(db.Model):
+    """The dashboard's materialized summary document. See summary.py."""
+
+    # zlib compressed, pickled summary document
+    compressed = db.BlobProperty(indexed=False)
+    updated = db.DateTimeProperty(indexed=False, auto_now=True)
+
+
+class _GAEBingoArchivedExperiment(db.Model):
+    """An archived canonical experiment's entry in the archive index.
+
+    Key names are canonical names. Entries hold just enough to list an
+    archived experiment, see archives.py.
+    """
+    canonical_name = db.StringProperty(indexed=False)
+    experiment_names = db.StringListProperty(indexed=False)
+    # This is used for a db-query in archives.list_archived()
+    dt_started = db.DateTimeProperty(indexed=True)
+    dt_archived = db.DateTimeProperty(indexed=False, auto_now_add=True)
+    total_participants = db.IntegerProperty(indexed=False, default=0)
+    total_conversions = db.IntegerProperty(indexed=False, default=0)
+
+    live = False
+    archived = True
+    stopped = False
+
+    @property
+    def pretty_canonical_name(self):
+        return self.canonical_name.capitalize().replace("_", " ")
+
+    @property
+    def age_desc(self):
+        return "Ran %s UTC" % self.dt_started.strftime('%Y-%m-%d at %H:%M:%S')
+
+
+class _GAEBingoArchiveIndexState(db.Model):
+    """Marks the archive index complete. See archives.py.
+
+    It's only put once rebuild_index has indexed every experiment archived
+    before the index existed.
+    """
+    dt_completed = db.DateTimeProperty(indexed=False, auto_now_add=True)
+
+
+class _GAEBingoPersistRun(db.Model):
+    """Stats from a single persist run. See persist_telemetry.py."""
+    kind = db.StringProperty(indexed=False)
+    started = db.FloatProperty(indexed=False)
+    duration_seconds = db.FloatProperty(indexed=False)
+    success = db.BooleanProperty(indexed=False, default=True)
+    pickled_stats = db.BlobProperty(indexed=False)
+    # This is used for a db-query in persist_telemetry.recent_runs()
+    time_recorded = db.DateTimeProperty(indexed=True, auto_now_add=True)
+
+    @staticmethod
+    def from_run(run):
+        return _GAEBingoPersistRun(
+            kind = run["kind"],
+            started = run["started"],
+            duration_seconds = run["duration_seconds"],
+            success = run["success"],
+            pickled_stats = pickle_util.dump(run["stats"]))
+
+    def to_run(self):
+        return {
+            "kind": self.kind,
+            "started": self.started,
+            "duration_seconds": self.duration_seconds,
+            "success": self.success,
+            "stats": pickle_util.load(self.pickled_stats) or {},
+        }
+
+
 class _GAEBingoIdentityRecord(db.Model):
     identity = db.StringProperty(indexed=False)
 
     # Stores a pickled BingoIdentityCache object.
     pickled = db.BlobProperty(indexed=False)
 
+    # Fingerprint of pickled, used to skip puts that wouldn't change anything.
+    # See cache.persist_gae_bingo_identity_records.
+    fingerprint = db.StringProperty(indexed=False)
+
     # A timestamp for keeping track when this record was last updated.
     # Used (well, potentially used) by analytics.git:src/fetch_entities.py.
     backup_timestamp = db.DateTimeProperty(indexed=True, auto_now=True)
@@ -351,6 +655,12 @@ def create_experiment_and_alternatives(experiment_name, canonical_name, alternat
 
     alternatives = []
 
+    # Only Counting experiments track sums of squared conversions, other
+    # experiments' alternatives leave them None rather than report a 0.
+    conversions_sq = None
+    if conversion_type == ConversionTypes.Counting:
+        conversions_sq = 0
+
     is_dict = type(alternative_params) == dict
     for i, content in enumerate(alternative_params):
 
@@ -363,7 +673,33 @@ def create_experiment_and_alternatives(experiment_name, canonical_name, alternat
                         pickled_content = pickle_util.dump(content),
                         live = True,
                         weight = alternative_params[content] if is_dict else 1,
+                        conversions_sq = conversions_sq,
                     )
                 )
 
     return experiment, alternatives
+
+
+# How experiments and alternatives are serialized by the API
+register_serializer(_GAEBingoExperiment,
+        ["name", "canonical_name", "family_name", "conversion_name",
+         "conversion_type", "live", "archived", "dt_started", "stopped",
+         "pretty_name", "pretty_conversion_name", "pretty_canonical_name",
+         "conversion_group", "hashable_name", "age_desc", "y_axis_title"],
+        # Set by summary.experiments_from_cache
+        optional_fields=["alternatives", "analysis", "bayesian"])
+
+register_serializer(_GAEBingoAlternative,
+        ["number", "experiment_name", "content", "pretty_content",
+         "participants", "conversions", "conversions_sq", "conversion_rate",
+         "pretty_conversion_rate", "live", "archived", "weight"])
+
+register_serializer(AlternativeView,
+        ["number", "experiment_name", "content", "pretty_content",
+         "participants", "conversions", "conversions_sq", "conversion_rate",
+         "pretty_conversion_rate", "live", "archived", "weight"])
+
+register_serializer(_GAEBingoArchivedExperiment,
+        ["canonical_name", "pretty_canonical_name", "experiment_names",
+         "dt_started", "dt_archived", "age_desc", "total_participants",
+         "total_conversions", "live", "archived", "stopped"])
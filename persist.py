@@ -5,6 +5,16 @@ Each task loads all current memcached gae/bingo data and stores it in the
 datastore. At the end of each persist task, a new task is queued up. In this
 way, persistence should be happening 'round the clock.
 
+Experiments are partitioned into config.PERSIST_SHARDS shards by a hash of
+their names (see shards.py). Each shard has its own lock and its own chain of
+persist_shard_task tasks, which pop and persist only that shard's
+experiments' counters. The coordinating persist_task chain rebuilds the
+shared BingoCache in memcache once per cycle if it's gone, persists identity
+buckets, and makes sure every shard's chain is running. Each shard run reads
+its view from that shared copy, and every write shards make to it goes
+through compare-and-set (see BingoCache.update_shared), so shards can't
+overwrite each other's counts.
+
 In the event that the persist chain has broken down at some point due to a
 problem we didn't foresee (gasp!), a one-per-minute cron job will be hitting
 GuaranteePersistTask and attempting to re-insert any missing persist task.
@@ -12,9 +22,11 @@ GuaranteePersistTask and attempting to re-insert any missing persist task.
 import datetime
 import logging
 import os
+import random
 import time
 
 from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 from google.appengine.ext import deferred
 from google.appengine.ext import ndb
@@ -22,8 +34,15 @@ from google.appengine.ext.webapp import RequestHandler
 
 import cache
 from config import config
+import custom_exceptions
+import early_drain
 import instance_cache
+import journal
+import persist_telemetry
 import request_cache
+import shards
+import summary
+import synchronized_counter
 
 
 class _GAEBingoPersistLockEntry(ndb.Model):
@@ -39,20 +58,58 @@ class _GAEBingoPersistLockEntry(ndb.Model):
     # this means the lock has been taken and will expire at the specified time.
     expiry = ndb.DateTimeProperty(indexed=False)
 
+    # Fencing token, incremented every time the lock is taken. Holders whose
+    # token no longer matches have lost their lease to someone else.
+    token = ndb.IntegerProperty(indexed=False, default=0)
+
 
 class PersistLock(object):
     """PersistLock makes sure we're only running one persist task at a time.
 
     It can also be acquired to temporarily prevent persist tasks from running.
+
+    The lock is a lease: it expires on its own after a timeout, and every
+    successful take() is handed a new, monotonically increasing fencing token.
+    Before writing, holders can call assert_current() to make sure their
+    lease hasn't expired and been taken by someone else in the meantime.
+
+    The datastore entity is the only source of truth for the lock. Memcache
+    just holds the holder's hint of when its lease expires so that contenders
+    can usually skip the datastore transaction while the lock is held. If the
+    hint is evicted we simply fall back to the transaction.
     """
 
     KEY = "_gae_bingo_persist_lock"
 
+    # spin_and_take's backoff between attempts starts here and doubles up to
+    # MAX_BACKOFF_SECONDS. Each sleep is a random fraction of the backoff.
+    INITIAL_BACKOFF_SECONDS = 0.05
+    MAX_BACKOFF_SECONDS = 2.0
+
     def __init__(self, key=KEY):
-        self._entity = None
         self._key = key
+        self._token = None
+
+    @staticmethod
+    def for_shard(shard):
+        """Return the lock held while persisting one shard's experiments."""
+        return PersistLock("%s:shard:%s" % (PersistLock.KEY, shard))
+
+    @staticmethod
+    def for_all_shards():
+        """Return every shard's lock, in the order they should be taken."""
+        return [PersistLock.for_shard(shard)
+                for shard in range(shards.num_shards())]
 
-    def take(self, lock_timeout=60):
+    @property
+    def token(self):
+        """Fencing token of the currently held lease, or None."""
+        return self._token
+
+    def _hint_key(self):
+        return "%s:expiry_hint" % self._key
+
+    def take(self, lock_timeout=60, use_memcache_hint=True):
         """Take the gae/bingo persist lock.
 
         This is only a quick, one-time attempt to take the lock. This doesn't
@@ -66,34 +123,57 @@ class PersistLock(object):
         Arguments:
             lock_timeout -- how long in seconds the lock should be valid for
                 after being successful in taking it
+            use_memcache_hint -- if True, don't bother trying the datastore
+                transaction while memcache says the lock is still held
         Returns:
             True if lock successfully taken, False otherwise.
         """
+        if use_memcache_hint:
+            hint_expiry = memcache.get(self._hint_key())
+            if hint_expiry and hint_expiry > time.time():
+                return False
+
         def txn():
             entity = _GAEBingoPersistLockEntry.get_or_insert(
                     self._key,
                     expiry=None)
 
-            if entity.expiry and entity.expiry > datetime.datetime.utcnow():
-                return None
-            entity.expiry = (datetime.datetime.utcnow() +
-                             datetime.timedelta(seconds=lock_timeout))
+            now = datetime.datetime.utcnow()
+            if entity.expiry and entity.expiry > now:
+                return False, entity.expiry
+
+            entity.expiry = now + datetime.timedelta(seconds=lock_timeout)
+            entity.token = (entity.token or 0) + 1
             entity.put()
-            return entity
+            return True, entity
 
         try:
-            self._entity = ndb.transaction(txn, retries=0)
+            taken, result = ndb.transaction(txn, retries=0)
         except datastore_errors.TransactionFailedError, e:
             # If there was a transaction collision, it probably means someone
             # else acquired the lock. Just wipe out any old values and move on.
-            self._entity = None
-        return self._entity is not None
+            self._token = None
+            return False
+
+        if not taken:
+            # Only the holder writes the hint. A contender's write could land
+            # after the holder's release() deleted it, and keep everyone
+            # waiting on a lock that's free.
+            self._token = None
+            return False
+
+        self._token = result.token
+        memcache.set(self._hint_key(), time.time() + lock_timeout,
+                     time=lock_timeout)
+        return True
 
     def spin_and_take(self, attempt_timeout=60, lock_timeout=60):
-        """Take the gae/bingo persist lock, hard spinning until success.
+        """Take the gae/bingo persist lock, backing off until success.
 
         This is essentially used for clients interested in altering bingo
-        data without colliding with the persist tasks.
+        data without colliding with the persist tasks. Attempts are spaced out
+        with exponential backoff and full jitter so we don't hammer the
+        datastore (or contend with ourselves) while a persist is running.
 
         Arguments:
             attempt_timeout -- how long in seconds to try to take the
@@ -108,84 +188,416 @@ class PersistLock(object):
         start = time.time()
 
         attempts = 0
+        backoff = PersistLock.INITIAL_BACKOFF_SECONDS
         while time.time() - start < attempt_timeout:
             attempts += 1
             if self.take(lock_timeout):
                 logging.info("took PersistLock after %s attempts" % attempts)
                 return True
+
+            seconds_left = attempt_timeout - (time.time() - start)
+            time.sleep(max(0, min(random.uniform(0, backoff), seconds_left)))
+            backoff = min(backoff * 2, PersistLock.MAX_BACKOFF_SECONDS)
+
         logging.error("Failed to take PersistLock after %s attempts" %
                       attempts)
         return False
 
     def is_active(self):
-        return self._entity is not None
+        return self._token is not None
+
+    def is_current(self):
+        """True if our lease hasn't expired or been taken by someone else."""
+        if not self.is_active():
+            return False
+
+        # Skip ndb's caches, we need the entity as it is in the datastore.
+        entity = _GAEBingoPersistLockEntry.get_by_id(self._key,
+                use_cache=False, use_memcache=False)
+
+        return bool(entity and
+                    entity.token == self._token and
+                    entity.expiry and
+                    entity.expiry > datetime.datetime.utcnow())
+
+    def assert_current(self):
+        """Raise StalePersistLockError if our fencing token is stale."""
+        if not self.is_current():
+            raise custom_exceptions.StalePersistLockError(
+                    "PersistLock %s with token %s is no longer held" %
+                    (self._key, self._token))
 
     def release(self):
-        """Release the gae/bingo persist lock."""
-        if self.is_active():
-            self._entity.expiry = None
-            self._entity.put()
-            self._entity = None
+        """Release the gae/bingo persist lock.
+
+        This won't release a lease that has since been taken by someone else.
+        """
+        if not self.is_active():
+            return
+
+        token = self._token
+        self._token = None
+
+        def txn():
+            entity = _GAEBingoPersistLockEntry.get_by_id(self._key)
+            if entity and entity.token == token:
+                entity.expiry = None
+                entity.put()
+                return True
+            return False
+
+        if ndb.transaction(txn):
+            memcache.delete(self._hint_key())
+        else:
+            logging.warning("PersistLock %s with token %s expired before "
+                            "release" % (self._key, token))
 
 
-def persist_task():
-    """Persist all gae/bingo cache entities to the datastore.
+# Shards' chains are re-queued by persist_task at most once per this many
+# seconds if they appear to have broken
+SHARD_GUARANTEE_SECONDS = 60
 
-    After persisting, this task should queue itself up for another run quickly
-    thereafter.
+# Each chain waits between MIN_ and MAX_PERSIST_COUNTDOWN_SECONDS before its
+# next run, depending on how quickly its counters are filling up.
+MIN_PERSIST_COUNTDOWN_SECONDS = 1
+MAX_PERSIST_COUNTDOWN_SECONDS = 120
 
-    This function uses a lock to make sure that only one persist task
+# The next run is scheduled for when the fastest counter is projected to
+# reach this fraction of WARNING_HIGH_COUNTER_VALUE.
+COUNTER_SAFETY_FRACTION = 0.25
+
+# A chain whose last success is older than its longest countdown plus this
+# grace period is considered broken and gets re-queued.
+CHAIN_LAG_GRACE_SECONDS = 60
+
+# A run that finds its lock already taken tries again after this long, so
+# its chain isn't broken by whoever holds the lock (say, an early drain).
+LOCK_RETRY_COUNTDOWN_SECONDS = 5
+
+
+def estimate_increment_rate(popped_counts, elapsed_seconds):
+    """Estimate the fastest single counter's rate, in increments per second.
+
+    Args:
+        popped_counts: SynchronizedCounter.pop_counters' results
+        elapsed_seconds: seconds over which the popped counts accumulated,
+            or None if unknown
+    Returns:
+        The rate, or None if it can't be estimated.
+    """
+    if not elapsed_seconds or elapsed_seconds <= 0:
+        return None
+
+    max_delta = max([max(counts) for counts in popped_counts.itervalues()]
+                    or [0])
+    return max_delta / float(elapsed_seconds)
+
+
+def choose_countdown(increment_rate):
+    """Choose how many seconds to wait before the next persist run.
+
+    Runs are spaced out so the fastest counter is only projected to reach
+    COUNTER_SAFETY_FRACTION of WARNING_HIGH_COUNTER_VALUE between them. Idle
+    chains wait the longest, and chains whose rate is unknown the shortest.
+    """
+    if increment_rate is None:
+        return MIN_PERSIST_COUNTDOWN_SECONDS
+
+    if increment_rate <= 0:
+        return MAX_PERSIST_COUNTDOWN_SECONDS
+
+    safe_count = (synchronized_counter.WARNING_HIGH_COUNTER_VALUE *
+                  COUNTER_SAFETY_FRACTION)
+    return max(MIN_PERSIST_COUNTDOWN_SECONDS,
+               min(MAX_PERSIST_COUNTDOWN_SECONDS,
+                   int(safe_count / increment_rate)))
+
+
+def is_duplicate_chain(kind, queued_at):
+    """True if another run of kind has succeeded since this one was queued.
+
+    That means a second chain has been started (say, by a guarantee task
+    queued while this chain was waiting out its countdown), so this chain
+    should stop rather than keep running alongside it.
+    """
+    if queued_at is None:
+        return False
+    last_success = persist_telemetry.last_success(kind)
+    return last_success is not None and last_success > queued_at
+
+
+def is_chain_lagging(kind):
+    """True if the persist chain of this telemetry kind looks broken."""
+    last_success = persist_telemetry.last_success(kind)
+    if last_success is None:
+        return True
+    return (time.time() - last_success >
+            MAX_PERSIST_COUNTDOWN_SECONDS + CHAIN_LAG_GRACE_SECONDS)
+
+
+def persist_task(queued_at=None):
+    """Coordinate a cycle of persisting gae/bingo caches to the datastore.
+
+    This rebuilds the shared BingoCache view, persists identity buckets, and
+    makes sure each shard's persist chain is running (see persist_shard_task).
+    After coordinating, this task queues itself up for another run: soon if
+    identities are backing up, otherwise after MAX_PERSIST_COUNTDOWN_SECONDS.
+
+    This function uses a lock to make sure that only one coordinator
     is running at a time.
+
+    Arguments:
+        queued_at -- time.time() when the previous run in this chain queued
+            this one, or None if this isn't part of a chain
     """
+    if is_duplicate_chain(persist_telemetry.COORDINATOR, queued_at):
+        logging.info("Ending duplicate gae/bingo persist chain.")
+        return
+
     lock = PersistLock()
+    started = time.time()
 
-    # Take the lock (only one persist should be running at a time)
+    # Take the lock (only one coordinator should be running at a time)
     if not lock.take():
         logging.info("Skipping gae/bingo persist, persist lock already owned.")
+        persist_telemetry.record_lock_contention(
+                persist_telemetry.COORDINATOR)
+        # If the lock's owner is another run of this chain, this chain ends
+        # as a duplicate once that run succeeds.
+        if not os.environ["SERVER_SOFTWARE"].startswith('Development'):
+            queue_new_persist_task(countdown=LOCK_RETRY_COUNTDOWN_SECONDS)
         return
 
     logging.info("Persisting gae/bingo state from memcache to datastore")
 
+    run_stats = None
     try:
         # Make sure request and instance caches are flushed, because this task
         # doesn't go through the normal gae/bingo WSGI app which is wrapped in
-        # middleware. Regardless, we want to flush instance cache so that we're
-        # persisting the current shared memcache state of all exercises to the
-        # datastore.
+        # middleware. Regardless, we want to flush instance cache so that
+        # this cycle starts from the current shared memcache state of all
+        # experiments (or reloads it from the datastore if it's gone).
         request_cache.flush_request_cache()
         instance_cache.flush()
+        bingo_cache = cache.BingoCache.get()
 
-        cache.BingoCache.get().persist_to_datastore()
-        cache.BingoIdentityCache.persist_buckets_to_datastore()
+        identity_stats = cache.BingoIdentityCache.persist_buckets_to_datastore()
+        if identity_stats["backlog_tasks"]:
+            countdown = MIN_PERSIST_COUNTDOWN_SECONDS
+        else:
+            countdown = MAX_PERSIST_COUNTDOWN_SECONDS
+        run_stats = {"countdown_seconds": countdown}
+
+        try:
+            summary.refresh(bingo_cache)
+        except Exception, e:
+            # The dashboard falls back to building its summaries on demand
+            logging.warning("Failed to refresh gae/bingo summary: %s" % e)
     finally:
         # Always release the persist lock
         lock.release()
+        persist_telemetry.record_run(persist_telemetry.COORDINATOR, started,
+                                     run_stats, success=run_stats is not None)
+
+    if os.environ["SERVER_SOFTWARE"].startswith('Development'):
+        # There are no chains in development, so persist every shard now.
+        for shard in range(shards.num_shards()):
+            persist_shard_task(shard)
+    else:
+        for shard in range(shards.num_shards()):
+            if is_chain_lagging(persist_telemetry.shard_kind(shard)):
+                guarantee_persist_shard_task(shard)
+
+        # In production, at the end of every persist task, queue up the next
+        # one. An unbroken chain of persists should always be running.
+        queue_new_persist_task(countdown=run_stats["countdown_seconds"])
+
+
+def persist_shard(shard, lock):
+    """Pop and persist the counters of every experiment in shard.
+
+    The caller must hold shard's PersistLock.
+
+    Returns:
+        The stats returned by BingoCache.persist_to_datastore.
+    """
+    bingo_cache = cache.BingoCache.get()
+    experiment_names = shards.experiment_names_for_shard(
+            bingo_cache.experiments.keys(), shard)
+
+    if journal.is_enabled():
+        journal_lease = journal.lease(tags=[
+                journal.partition_tag(partition)
+                for partition in shards.partitions_for_shard(shard)])
+        stats = bingo_cache.persist_to_datastore(
+                experiment_names=experiment_names,
+                journal_deltas=journal_lease.deltas, lock=lock)
+        # Only forget journaled increments once they've been put.
+        journal_lease.delete()
+    else:
+        stats = bingo_cache.persist_to_datastore(
+                experiment_names=experiment_names, lock=lock)
+
+    return stats
+
+
+def persist_shard_task(shard, queued_at=None):
+    """Persist one shard's experiments, then queue up the shard's next run.
+
+    This function uses the shard's lock to make sure that only one persist
+    task per shard is running at a time.
+
+    Arguments:
+        shard -- which shard to persist
+        queued_at -- time.time() when the previous run in this shard's chain
+            queued this one, or None if this isn't part of a chain
+    """
+    kind = persist_telemetry.shard_kind(shard)
+    if is_duplicate_chain(kind, queued_at):
+        logging.info("Ending duplicate gae/bingo persist chain for shard %s." %
+                     shard)
+        return
+
+    lock = PersistLock.for_shard(shard)
+    started = time.time()
+    previous_success = persist_telemetry.last_success(kind)
+
+    if not lock.take():
+        logging.info("Skipping gae/bingo persist of shard %s, lock already "
+                     "owned." % shard)
+        persist_telemetry.record_lock_contention(kind)
+        # If the lock's owner is another run of this chain, this chain ends
+        # as a duplicate once that run succeeds.
+        if not os.environ["SERVER_SOFTWARE"].startswith('Development'):
+            queue_new_persist_shard_task(shard,
+                    countdown=LOCK_RETRY_COUNTDOWN_SECONDS)
+        return
+
+    run_stats = None
+    countdown = MIN_PERSIST_COUNTDOWN_SECONDS
+    try:
+        # Read the shared BingoCache from memcache rather than this
+        # instance's copy, which could be missing experiments created since
+        # it was cached. Only BingoCache is dropped from the instance cache.
+        request_cache.flush_request_cache()
+        instance_cache.delete(cache.BingoCache.CACHE_KEY)
+        stats = persist_shard(shard, lock)
+
+        # The popped counts accumulated since the last successful persist
+        elapsed = (time.time() - previous_success
+                   if previous_success is not None else None)
+        increment_rate = estimate_increment_rate(stats["popped_counts"],
+                                                 elapsed)
+        countdown = choose_countdown(increment_rate)
+
+        run_stats = {
+            "experiments_written": stats["experiments_written"],
+            "alternatives_written": stats["alternatives_written"],
+            "alternatives_skipped": stats["alternatives_skipped"],
+            "counter_deltas_drained":
+                persist_telemetry.counter_deltas_drained(
+                    stats["popped_counts"]),
+            "increment_rate": increment_rate,
+            "countdown_seconds": countdown,
+        }
+    except custom_exceptions.StalePersistLockError, e:
+        logging.error("Aborted gae/bingo persist of shard %s: %s" % (shard, e))
+    finally:
+        lock.release()
+        persist_telemetry.record_run(kind, started, run_stats,
+                                     success=run_stats is not None)
 
-    # In production, at the end of every persist task, queue up the next one.
-    # An unbroken chain of persists should always be running.
     if not os.environ["SERVER_SOFTWARE"].startswith('Development'):
-        queue_new_persist_task()
+        queue_new_persist_shard_task(shard, countdown=countdown)
+
 
+def drain_experiment(experiment_name):
+    """Pop and persist a single experiment's counters ahead of the next persist.
 
-def queue_new_persist_task():
+    This is queued by early_drain when one of the experiment's counters is
+    approaching overflow. See early_drain.py.
+    """
+    lock = PersistLock.for_shard(shards.shard_for_experiment(experiment_name))
+
+    if not lock.take():
+        # The experiment's shard is already being persisted, and that'll drain
+        # this experiment's counters itself.
+        logging.info("Skipping gae/bingo drain of %s, persist lock already "
+                     "owned." % experiment_name)
+        return
+
+    logging.info("Draining gae/bingo counters for %s" % experiment_name)
+
+    try:
+        request_cache.flush_request_cache()
+        instance_cache.flush()
+
+        # When the durable journal is in use, its deltas are folded in by the
+        # regular persist. Here we only need to reset the memcache counters.
+        journal_deltas = {} if journal.is_enabled() else None
+
+        stats = cache.BingoCache.get().persist_to_datastore(
+                experiment_names=[experiment_name],
+                journal_deltas=journal_deltas,
+                lock=lock)
+    except custom_exceptions.StalePersistLockError, e:
+        logging.error("Aborted gae/bingo drain of %s: %s" %
+                      (experiment_name, e))
+        return
+    finally:
+        lock.release()
+
+    rescued = 0
+    for counts in stats["popped_counts"].itervalues():
+        rescued += len([count for count in counts
+            if count > synchronized_counter.WARNING_HIGH_COUNTER_VALUE])
+    early_drain.record_rescues(rescued)
+
+
+def queue_new_persist_task(countdown=0):
     """Queue up a new persist task on the task queue via deferred library.
 
-    These tasks should fire off immediately. If they're being backed off by GAE
-    due to errors, they shouldn't try less frequently than once every 60
-    seconds."""
+    These tasks fire off after countdown seconds. If they're being backed off
+    by GAE due to errors, they shouldn't try less frequently than once every
+    60 seconds."""
     try:
-        deferred.defer(persist_task, _queue=config.QUEUE_NAME,
+        deferred.defer(persist_task, queued_at=time.time(),
+            _queue=config.QUEUE_NAME, _countdown=countdown,
             _retry_options=taskqueue.TaskRetryOptions(max_backoff_seconds=60))
     except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
         logging.info("Task for gae/bingo persist already exists.")
 
 
+def queue_new_persist_shard_task(shard, countdown=0):
+    """Queue up the next persist task in shard's chain."""
+    deferred.defer(persist_shard_task, shard, queued_at=time.time(),
+        _queue=config.QUEUE_NAME, _countdown=countdown,
+        _retry_options=taskqueue.TaskRetryOptions(max_backoff_seconds=60))
+
+
+def guarantee_persist_shard_task(shard):
+    """Queue up a persist task for shard in case its chain has broken.
+
+    Tasks are named by shard and time window so at most one is queued per
+    shard every SHARD_GUARANTEE_SECONDS. Callers should only do this once
+    the shard's chain is lagging (see is_chain_lagging), since a task queued
+    while the chain waits out its countdown would start a second chain.
+    """
+    window = int(time.time() / SHARD_GUARANTEE_SECONDS)
+    try:
+        deferred.defer(persist_shard_task, shard, _queue=config.QUEUE_NAME,
+            _name="gae-bingo-persist-shard-%s-%s" % (shard, window))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
 class GuaranteePersistTask(RequestHandler):
     """Triggered by cron, this GET handler makes sure a persist task exists.
 
-    This should be triggered once every minute. We expect the vast majority of
-    this handler's attempts to queue up a new persist task to be unable to grab
-    the PersistLock, which is expected.
+    This should be triggered once every minute. It only queues up a new
+    persist task if the coordinating chain hasn't succeeded in longer than
+    its longest countdown, since queueing one while the chain is waiting out
+    a countdown would start a second chain.
 
     Since persist tasks always queue up another task at the end of their job,
     there should be an unbroken chain of tasks always running.
@@ -194,4 +606,20 @@ class GuaranteePersistTask(RequestHandler):
     broken.
     """
     def get(self):
-        queue_new_persist_task()
+        if is_chain_lagging(persist_telemetry.COORDINATOR):
+            queue_new_persist_task()
+
+
+class DrainExperimentTask(RequestHandler):
+    """Task queue handler that drains one experiment's counters early.
+
+    Queued by early_drain.queue_drain. See early_drain.py.
+    """
+    def post(self):
+        # App Engine strips this header from external requests, so only the
+        # task queue can trigger drains.
+        if "X-AppEngine-QueueName" not in self.request.headers:
+            self.error(403)
+            return
+
+        drain_experiment(self.request.get("experiment_name"))
@@ -0,0 +1,187 @@
+"""Telemetry for keeping an eye on whether the persist pipeline keeps up.
+
+Each persist run (the coordinating persist_task, every shard's
+persist_shard_task, and BingoIdentityCache.persist_buckets_to_datastore)
+records how long it took, what it wrote, and how many counter increments it
+drained. Runs are kept in a ring buffer of RING_SIZE memcache slots, indexed by
+memcache.incr so concurrent runs never overwrite each other's slot. If
+config.PERSIST_TELEMETRY_TO_DATASTORE is enabled, each run is also put as a
+_GAEBingoPersistRun so history survives memcache evictions.
+
+status() summarizes all of this for the /gae_bingo/api/v1/persist_status
+endpoint, including how long it's been since each kind of run last succeeded
+and whether that lag is over config.PERSIST_LAG_ALARM_SECONDS. A kind that
+has never succeeded lags from when status() first expected it (or its
+earliest recorded run), so a shard whose chain never starts still raises the
+alarm once that grace period is up.
+"""
+import datetime
+import logging
+import math
+import time
+
+from google.appengine.api import memcache
+
+from .models import _GAEBingoPersistRun
+from config import config
+import early_drain
+import shards
+
+
+# Number of most recent runs kept in memcache
+RING_SIZE = 200
+
+RING_INDEX_KEY = "_gae_bingo_persist_telemetry:index"
+RING_SLOT_KEY = "_gae_bingo_persist_telemetry:slot:%s"
+LAST_SUCCESS_KEY = "_gae_bingo_persist_telemetry:last_success:%s"
+CONTENTION_KEY = "_gae_bingo_persist_telemetry:contention:%s"
+EXPECTED_SINCE_KEY = "_gae_bingo_persist_telemetry:expected_since:%s"
+
+# Kinds of persist runs
+COORDINATOR = "coordinator"
+IDENTITIES = "identities"
+
+
+def shard_kind(shard):
+    return "shard:%s" % shard
+
+
+def expected_kinds():
+    """Kinds of runs that should be succeeding continuously."""
+    return ([COORDINATOR, IDENTITIES] +
+            [shard_kind(shard) for shard in range(shards.num_shards())])
+
+
+def counter_deltas_drained(popped_counts):
+    """Total # of increments in SynchronizedCounter.pop_counters' results."""
+    return sum(sum(counts) for counts in popped_counts.itervalues())
+
+
+def record_run(kind, started, stats=None, success=True):
+    """Record the stats of a finished persist run.
+
+    Args:
+        kind: which kind of persist run this was, e.g. shard_kind(0)
+        started: time.time() when the run started
+        stats: dict of counts describing what the run did
+        success: False if the run was aborted or failed
+    """
+    now = time.time()
+    run = {
+        "kind": kind,
+        "started": started,
+        "duration_seconds": now - started,
+        "success": success,
+        "stats": stats or {},
+    }
+
+    index = memcache.incr(RING_INDEX_KEY, initial_value=0)
+    if index is not None:
+        memcache.set(RING_SLOT_KEY % (index % RING_SIZE), run)
+
+    if success:
+        memcache.set(LAST_SUCCESS_KEY % kind, now)
+
+    if config.PERSIST_TELEMETRY_TO_DATASTORE:
+        try:
+            _GAEBingoPersistRun.from_run(run).put()
+        except Exception, e:
+            # Telemetry should never break a persist
+            logging.warning("Failed to put gae/bingo persist run: %s" % e)
+
+
+def last_success(kind):
+    """Return time.time() of kind's last successful run, or None if unknown."""
+    return memcache.get(LAST_SUCCESS_KEY % kind)
+
+
+def record_lock_contention(kind):
+    """Record that a persist run couldn't take its lock."""
+    memcache.incr(CONTENTION_KEY % kind, initial_value=0)
+
+
+def recent_runs():
+    """Return recently recorded runs, oldest first."""
+    slots = memcache.get_multi(
+            [RING_SLOT_KEY % slot for slot in range(RING_SIZE)])
+    runs = slots.values()
+
+    if not runs and config.PERSIST_TELEMETRY_TO_DATASTORE:
+        runs = [entity.to_run() for entity in
+                _GAEBingoPersistRun.all()
+                    .order("-time_recorded")
+                    .fetch(RING_SIZE)]
+
+    return sorted(runs, key=lambda run: run["started"])
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list of values."""
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(fraction * len(sorted_values))) - 1
+    return sorted_values[max(0, min(rank, len(sorted_values) - 1))]
+
+
+def status():
+    """Summarize recent persist runs, per kind, and whether we're lagging."""
+    now = time.time()
+    runs = recent_runs()
+    kinds = expected_kinds()
+
+    last_successes = memcache.get_multi(
+            [LAST_SUCCESS_KEY % kind for kind in kinds])
+    contention = memcache.get_multi(
+            [CONTENTION_KEY % kind for kind in kinds])
+
+    # Start the clock on kinds we've never seen succeed. add() keeps the
+    # first time we expected them.
+    memcache.add_multi(dict((EXPECTED_SINCE_KEY % kind, now)
+                            for kind in kinds))
+    expected_since = memcache.get_multi(
+            [EXPECTED_SINCE_KEY % kind for kind in kinds])
+
+    summaries = {}
+    for kind in kinds:
+        kind_runs = [run for run in runs if run["kind"] == kind]
+        durations = sorted(run["duration_seconds"] for run in kind_runs)
+
+        last_success = last_successes.get(LAST_SUCCESS_KEY % kind)
+        if last_success is None:
+            # Memcache may have evicted it, fall back to the ring buffer.
+            succeeded = [run["started"] + run["duration_seconds"]
+                         for run in kind_runs if run["success"]]
+            last_success = max(succeeded) if succeeded else None
+
+        never_succeeded = last_success is None
+        if never_succeeded:
+            lag_since = min([run["started"] for run in kind_runs] +
+                            [expected_since.get(EXPECTED_SINCE_KEY % kind)
+                             or now])
+        else:
+            lag_since = last_success
+
+        summaries[kind] = {
+            "runs": len(kind_runs),
+            "failures": len([run for run in kind_runs if not run["success"]]),
+            "p50_seconds": percentile(durations, 0.5),
+            "p99_seconds": percentile(durations, 0.99),
+            "lag_seconds": now - lag_since,
+            "never_succeeded": never_succeeded,
+            "lock_contention": int(
+                    contention.get(CONTENTION_KEY % kind) or 0),
+            "last_run": kind_runs[-1] if kind_runs else None,
+        }
+
+    lagging = sorted(kind for kind, summary in summaries.iteritems()
+                     if summary["lag_seconds"] >
+                        config.PERSIST_LAG_ALARM_SECONDS)
+
+    return {
+        "now": datetime.datetime.utcfromtimestamp(now),
+        "alarm": bool(lagging),
+        "lagging": lagging,
+        "lag_alarm_seconds": config.PERSIST_LAG_ALARM_SECONDS,
+        "kinds": summaries,
+        "early_drains": early_drain.stats(),
+    }
@@ -0,0 +1,50 @@
+import time
+
+from google.appengine.api import memcache
+
+from testutil import gae_model
+
+from . import persist_telemetry
+
+
+class PersistTelemetryTest(gae_model.GAEModelTestCase):
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(50, persist_telemetry.percentile(values, 0.5))
+        self.assertEqual(99, persist_telemetry.percentile(values, 0.99))
+        self.assertEqual(7, persist_telemetry.percentile([7], 0.99))
+        self.assertIsNone(persist_telemetry.percentile([], 0.5))
+
+    def test_status(self):
+        kind = persist_telemetry.shard_kind(0)
+        now = time.time()
+        persist_telemetry.record_run(kind, now - 2, {"alternatives_written": 3})
+        persist_telemetry.record_run(kind, now - 1, success=False)
+        persist_telemetry.record_lock_contention(kind)
+
+        summary = persist_telemetry.status()["kinds"][kind]
+        self.assertEqual(2, summary["runs"])
+        self.assertEqual(1, summary["failures"])
+        self.assertEqual(1, summary["lock_contention"])
+        self.assertFalse(summary["last_run"]["success"])
+        self.assertTrue(summary["lag_seconds"] < 60)
+
+    def test_lag_alarm(self):
+        persist_telemetry.record_run(persist_telemetry.COORDINATOR, time.time())
+        self.assertFalse(persist_telemetry.status()["alarm"])
+
+        memcache.set(persist_telemetry.LAST_SUCCESS_KEY %
+                     persist_telemetry.COORDINATOR, time.time() - 24 * 60 * 60)
+        status = persist_telemetry.status()
+        self.assertTrue(status["alarm"])
+        self.assertEqual([persist_telemetry.COORDINATOR], status["lagging"])
+
+    def test_never_succeeded_lags_after_grace_period(self):
+        kind = persist_telemetry.shard_kind(0)
+        status = persist_telemetry.status()
+        self.assertTrue(status["kinds"][kind]["never_succeeded"])
+        self.assertNotIn(kind, status["lagging"])
+
+        memcache.set(persist_telemetry.EXPECTED_SINCE_KEY % kind,
+                     time.time() - 24 * 60 * 60)
+        self.assertIn(kind, persist_telemetry.status()["lagging"])
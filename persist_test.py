@@ -0,0 +1,58 @@
+import os
+import time
+
+import mock
+
+from testutil import gae_model
+
+from . import persist
+from . import persist_telemetry
+from . import synchronized_counter
+
+
+class PersistCadenceTest(gae_model.GAEModelTestCase):
+    def test_estimate_increment_rate(self):
+        popped_counts = {
+            "monkeys:participants": [10, 40, 0, 0],
+            "monkeys:conversions": [1, 2, 0, 0],
+        }
+        self.assertEqual(4.0,
+                persist.estimate_increment_rate(popped_counts, 10))
+        self.assertIsNone(persist.estimate_increment_rate(popped_counts, None))
+        self.assertEqual(0, persist.estimate_increment_rate({}, 10))
+
+    def test_choose_countdown(self):
+        self.assertEqual(persist.MAX_PERSIST_COUNTDOWN_SECONDS,
+                persist.choose_countdown(0))
+        self.assertEqual(persist.MIN_PERSIST_COUNTDOWN_SECONDS,
+                persist.choose_countdown(None))
+        self.assertEqual(persist.MIN_PERSIST_COUNTDOWN_SECONDS,
+                persist.choose_countdown(
+                    synchronized_counter.WARNING_HIGH_COUNTER_VALUE))
+
+        # Busier counters get persisted sooner
+        self.assertTrue(persist.choose_countdown(400) <
+                        persist.choose_countdown(100) <
+                        persist.MAX_PERSIST_COUNTDOWN_SECONDS)
+
+    def test_is_duplicate_chain(self):
+        kind = persist_telemetry.shard_kind(0)
+        queued_at = 1000.0
+        self.assertFalse(persist.is_duplicate_chain(kind, queued_at))
+
+        with mock.patch.object(time, "time", return_value=queued_at + 1):
+            persist_telemetry.record_run(kind, queued_at)
+        self.assertTrue(persist.is_duplicate_chain(kind, queued_at))
+        self.assertFalse(persist.is_duplicate_chain(kind, None))
+
+    def test_shard_requeues_when_lock_taken(self):
+        self.assertTrue(persist.PersistLock.for_shard(0).take())
+
+        with mock.patch.dict(os.environ,
+                             {"SERVER_SOFTWARE": "Google App Engine/1.9"}):
+            with mock.patch.object(persist,
+                                   "queue_new_persist_shard_task") as queue:
+                persist.persist_shard_task(0)
+
+        queue.assert_called_once_with(
+                0, countdown=persist.LOCK_RETRY_COUNTDOWN_SECONDS)
@@ -0,0 +1,149 @@
+"""Sequential testing w/ always-valid p-values, so peeking is safe.
+
+The dashboard's z-test assumes results are only looked at once, after a fixed
+# of participants. Checking it every day and stopping as soon as it looks
+significant inflates false positives well past its stated confidence.
+
+This runs a mixture sequential probability ratio test (mSPRT, see Johari et
+al., "Always Valid Inference") of each alternative against the control
+(the lowest-numbered alternative), using the normal approximation of the
+difference in conversion rates. Its p-values stay valid no matter how often
+they're looked at, as long as each one is the minimum over every look so
+far. So each snapshot tick folds its sample into a running state per
+experiment, a _GAEBingoSequentialTest stored alongside its snapshot chunks,
+and reading the current p-values costs one get regardless of how long the
+experiment has been running.
+"""
+import math
+
+from google.appengine.ext import db
+
+from .models import _GAEBingoSequentialTest
+
+# Variance of the normal mixture over true differences in conversion rates.
+# The test is most powerful for differences around its square root.
+MIXTURE_VARIANCE = 0.01 ** 2
+
+# Experiments are safe to stop once any alternative's p-value, Bonferroni
+# corrected for the # of alternatives compared against the control, is
+# below this.
+ALPHA = 0.05
+
+
+def likelihood_ratio(control, treatment, mixture_variance=MIXTURE_VARIANCE):
+    """mSPRT mixture likelihood ratio of treatment's rate vs. control's.
+
+    Args:
+        control, treatment: (participants, conversions) tuples
+    """
+    (n0, c0), (n1, c1) = control, treatment
+    if not n0 or not n1:
+        return 1.0
+
+    rate0, rate1 = float(c0) / n0, float(c1) / n1
+    variance = rate0 * (1 - rate0) / n0 + rate1 * (1 - rate1) / n1
+    if variance <= 0:
+        return 1.0
+
+    difference = rate1 - rate0
+    total_variance = variance + mixture_variance
+    exponent = (mixture_variance * difference ** 2 /
+                (2 * variance * total_variance))
+    # Past this, the p-value would be 0 anyway
+    return math.sqrt(variance / total_variance) * math.exp(min(exponent, 700))
+
+
+def update_state(state, counts):
+    """Fold an experiment's latest counts into its sequential test state.
+
+    The test's statistics only depend on cumulative counts, so folding in a
+    snapshot's deltas comes down to taking its counts and lowering each
+    alternative's running p-value if this look's is lower.
+
+    Args:
+        state: dict from _GAEBingoSequentialTest.state
+        counts: dict of alternative number -> (participants, conversions)
+    Returns:
+        The updated state.
+    """
+    seen = dict(state["counts"])
+    seen.update(counts)
+
+    p_values = dict(state["p_values"])
+    if seen:
+        control = min(seen)
+        for number in seen:
+            if number == control:
+                continue
+            ratio = likelihood_ratio(seen[control], seen[number])
+            p_values[number] = min(p_values.get(number, 1.0), 1.0 / ratio)
+
+    return {"counts": seen, "p_values": p_values}
+
+
+def update_tests(samples_by_experiment):
+    """Fold samples into their experiments' sequential tests.
+
+    All of the tests involved are fetched in a single batch.
+
+    Args:
+        samples_by_experiment: list of (experiment_key, samples) pairs, where
+            samples are time-ordered (timestamp, counts) tuples
+    Returns:
+        The updated _GAEBingoSequentialTests, which the caller is responsible
+        for putting.
+    """
+    keys = [_GAEBingoSequentialTest.key_for_experiment(experiment_key)
+            for experiment_key, _ in samples_by_experiment]
+
+    tests = []
+    for key, test, (_, samples) in zip(keys, db.get(keys),
+                                       samples_by_experiment):
+        if not test:
+            test = _GAEBingoSequentialTest(key_name=key.name(),
+                                           parent=key.parent())
+
+        state = test.state
+        for _, counts in samples:
+            state = update_state(state, counts)
+        test.set_state(state)
+        tests.append(test)
+
+    return tests
+
+
+def summarize(experiment, alternatives):
+    """Always-valid p-values of each alternative vs. the control.
+
+    Alternatives' current counts count as one more look on top of the stored
+    state, but aren't stored.
+    """
+    return summarize_experiments([(experiment, alternatives)])[0]
+
+
+def summarize_experiments(experiments_and_alternatives):
+    """summarize for (experiment, alternatives) pairs, w/ a single get."""
+    keys = [_GAEBingoSequentialTest.key_for_experiment(experiment.key())
+            for experiment, _ in experiments_and_alternatives]
+
+    summaries = []
+    for test, (_, alternatives) in zip(db.get(keys),
+                                       experiments_and_alternatives):
+        state = test.state if test else {"counts": {}, "p_values": {}}
+
+        state = update_state(state, dict(
+                (alternative.number,
+                 (alternative.participants, alternative.conversions))
+                for alternative in alternatives))
+
+        p_values = state["p_values"]
+        comparisons = max(1, len(p_values))
+        summaries.append({
+            "control_number": (min(state["counts"]) if state["counts"]
+                               else None),
+            "always_valid_p_values": p_values,
+            "alpha": ALPHA,
+            "safe_to_stop": any(p * comparisons <= ALPHA
+                                for p in p_values.itervalues()),
+        })
+    return summaries
@@ -0,0 +1,43 @@
+import datetime
+
+from google.appengine.ext import db
+
+from testutil import gae_model
+
+from . import models
+from . import sequential
+from . import snapshots
+
+
+class SequentialTest(gae_model.GAEModelTestCase):
+    def test_p_values_never_increase(self):
+        state = {"counts": {}, "p_values": {}}
+        state = sequential.update_state(state, {0: (5000, 500), 1: (5000, 650)})
+        strong = state["p_values"][1]
+        self.assertTrue(strong < sequential.ALPHA)
+
+        # Later looks that regress toward no difference can't undo it
+        state = sequential.update_state(state,
+                                        {0: (10000, 1000), 1: (10000, 1010)})
+        self.assertEqual(strong, state["p_values"][1])
+
+    def test_no_difference_isnt_safe_to_stop(self):
+        state = sequential.update_state({"counts": {}, "p_values": {}},
+                                        {0: (1000, 100), 1: (1000, 100)})
+        self.assertEqual(1.0, state["p_values"][1])
+
+    def test_snapshots_update_the_test(self):
+        experiment, alternatives = models.create_experiment_and_alternatives(
+                "monkeys", "monkeys")
+        db.put([experiment] + alternatives)
+
+        snapshots.record_snapshots([(experiment, alternatives)],
+                                   now=datetime.datetime.utcnow())
+        test = models._GAEBingoSequentialTest.get(
+                models._GAEBingoSequentialTest.key_for_experiment(
+                    experiment.key()))
+        self.assertEqual({0: (0, 0), 1: (0, 0)}, test.state["counts"])
+
+        summary = sequential.summarize(experiment, alternatives)
+        self.assertFalse(summary["safe_to_stop"])
+        self.assertEqual(0, summary["control_number"])
@@ -0,0 +1,51 @@
+"""Partitioning of experiments into persist shards.
+
+Experiments are hashed by name into NUM_PARTITIONS fixed partitions, and
+each persist shard persists whole partitions. Each experiment's counters are
+popped and persisted by exactly one persist shard. See persist.py.
+
+Durable journal entries are tagged by partition rather than by shard (see
+journal.py), so changing config.PERSIST_SHARDS only changes which shard
+leases a partition's entries and never leaves any behind.
+"""
+import hashlib
+
+from config import config
+
+# More persist shards than this would have no partitions to persist
+NUM_PARTITIONS = 16
+
+
+def num_shards():
+    return max(1, min(NUM_PARTITIONS, int(config.PERSIST_SHARDS)))
+
+
+def partition_for_experiment(experiment_name):
+    """Return the fixed partition experiment_name is hashed into."""
+    if isinstance(experiment_name, unicode):
+        experiment_name = experiment_name.encode("utf-8")
+    sig = hashlib.md5(experiment_name).hexdigest()
+    return int(sig, base=16) % NUM_PARTITIONS
+
+
+def partition_for_counter_key(counter_key):
+    """Return the partition of a counter combination's experiment.
+
+    Counter keys look like "<experiment name>:participants".
+    """
+    return partition_for_experiment(counter_key.rsplit(":", 1)[0])
+
+
+def partitions_for_shard(shard):
+    return [partition for partition in range(NUM_PARTITIONS)
+            if partition % num_shards() == shard]
+
+
+def shard_for_experiment(experiment_name):
+    """Return the persist shard responsible for experiment_name."""
+    return partition_for_experiment(experiment_name) % num_shards()
+
+
+def experiment_names_for_shard(experiment_names, shard):
+    return [name for name in experiment_names
+            if shard_for_experiment(name) == shard]
@@ -0,0 +1,666 @@
+"""Snapshots of experiments' participant and conversion counts over time.
+
+Every 30 minutes the log_snapshot cron samples the latest counts of each live
+experiment's alternatives. Samples are packed into one _GAEBingoSnapshotChunk
+per experiment per day, so each tick costs one put per experiment (instead of
+one per alternative) and a dashboard timeline only reads a handful of chunks.
+
+The cron also maintains two rollups of each experiment's samples: an hourly
+rollup w/ a chunk per month and a daily rollup w/ a chunk per year. Each
+rollup keeps the earliest sample in every hour or day. Since counts are
+cumulative, that's all a timeline needs. Timelines are built from daily
+samples for old history, hourly samples for recent history and raw samples
+for the last couple of days, then downsampled w/ largest-triangle-three-
+buckets so they cover an experiment's whole lifetime at a bounded size.
+
+Built timelines are cached in memcache under the time of the latest snapshot
+tick, and each tick appends its samples to the cached timelines rather than
+invalidating them, so the dashboard only reads chunks once a timeline has
+been evicted or has expired.
+
+A daily compact_snapshots cron applies a retention policy, deleting raw
+chunks after RAW_RETENTION_DAYS and hourly rollups after
+HOURLY_RETENTION_DAYS, which keeps the chunks under each experiment (archived
+or not) from growing forever.
+
+Experiments that were snapshotted before chunks existed have
+_GAEBingoSnapshotLog rows, one per alternative per tick. load_samples still
+reads them, and queues migrate_legacy_snapshots to fold them into chunks.
+"""
+import calendar
+import datetime
+import hashlib
+import logging
+import math
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+
+from .models import _GAEBingoExperiment, _GAEBingoSnapshotChunk
+from .models import _GAEBingoSnapshotLog
+from config import config
+import sequential
+
+
+# Resolution of chunks holding every sample, one chunk per day
+RAW = "raw"
+
+# Resolutions of rollup chunks, keeping the earliest sample in every hour
+# (one chunk per month) or day (one chunk per year)
+HOUR = "hour"
+DAY = "day"
+
+# Timelines use raw samples for this many days and hourly samples for this
+# many days, and daily samples for anything older.
+RAW_TIMELINE_DAYS = 2
+HOURLY_TIMELINE_DAYS = 60
+
+# Timelines are downsampled to at most this many points
+MAX_TIMELINE_POINTS = 400
+
+# Compaction deletes raw chunks once they're this many days old and hourly
+# rollups once they're this many days old, after making sure their samples
+# made it into the coarser rollups.
+RAW_RETENTION_DAYS = 7
+HOURLY_RETENTION_DAYS = 90
+
+# Compaction walks experiments this many at a time, and re-queues itself
+# after working for this long
+COMPACTION_BATCH_SIZE = 20
+COMPACTION_SECONDS = 5 * 60
+
+# Snapshots of this many experiments are recorded per cross-group
+# transaction, the most entity groups one can span
+RECORD_BATCH_SIZE = 25
+
+# Legacy rows are read and migrated this many at a time
+LEGACY_BATCH_SIZE = 500
+
+# A migration task re-queues itself after working for this long
+MIGRATION_SECONDS = 5 * 60
+
+# Memcache key set once an experiment has no legacy rows left
+MIGRATED_KEY = "_gae_bingo_snapshots_migrated:%s"
+
+# Memcache keys of the latest snapshot tick's timestamp and of timelines,
+# by experiment key and the tick they're up to date with
+LAST_TICK_KEY = "_gae_bingo_snapshots_last_tick"
+TIMELINE_KEY = "_gae_bingo_timeline:%s:%s"
+
+# Cached timelines are rebuilt from chunks at least this often, so that
+# appended raw samples get replaced by their rollups
+TIMELINE_CACHE_SECONDS = 24 * 60 * 60
+
+
+def timestamp(dt):
+    """Seconds since the epoch of a naive UTC datetime."""
+    return calendar.timegm(dt.timetuple())
+
+
+def day_period(ts):
+    return datetime.datetime.utcfromtimestamp(ts).strftime("%Y-%m-%d")
+
+
+def month_period(ts):
+    return datetime.datetime.utcfromtimestamp(ts).strftime("%Y-%m")
+
+
+def year_period(ts):
+    return datetime.datetime.utcfromtimestamp(ts).strftime("%Y")
+
+
+# (resolution, seconds per rollup bucket, period of chunk holding a sample)
+ROLLUPS = [
+    (HOUR, 60 * 60, month_period),
+    (DAY, 24 * 60 * 60, year_period),
+]
+
+
+def _chunk_key(experiment_key, resolution, period):
+    return db.Key.from_path(_GAEBingoSnapshotChunk.kind(),
+            _GAEBingoSnapshotChunk.key_name_for(resolution, period),
+            parent=experiment_key)
+
+
+def _chunks_query(experiment_key, resolution, start_period=""):
+    """Query for experiment's chunks of resolution from start_period on.
+
+    Chunk key names sort chronologically, so this is a key range query that
+    only needs the built-in indexes.
+    """
+    return (_GAEBingoSnapshotChunk.all()
+                .ancestor(experiment_key)
+                .filter("__key__ >=",
+                    _chunk_key(experiment_key, resolution, start_period))
+                .filter("__key__ <",
+                    _chunk_key(experiment_key, resolution, u"\ufffd"))
+                .order("__key__"))
+
+
+def fetch_chunks(experiment_key, resolution, start_period=""):
+    """Return experiment's chunks of resolution from start_period on, in order.
+    """
+    return list(_chunks_query(experiment_key, resolution, start_period))
+
+
+def rollup_samples(chunk, samples, bucket_seconds):
+    """Merge samples into a rollup chunk, keeping each bucket's earliest.
+
+    Returns:
+        True if the chunk changed.
+    """
+    samples_by_bucket = dict((ts // bucket_seconds, (ts, counts))
+                             for ts, counts in chunk.samples)
+    changed = False
+
+    for ts, counts in samples:
+        bucket = ts // bucket_seconds
+        existing = samples_by_bucket.get(bucket)
+
+        if existing is None or ts < existing[0]:
+            samples_by_bucket[bucket] = (ts, dict(counts))
+            changed = True
+        elif ts == existing[0] and any(
+                existing[1].get(n) != count for n, count in counts.items()):
+            # Same sample, e.g. a legacy tick migrated in separate batches
+            existing[1].update(counts)
+            changed = True
+
+    if changed:
+        chunk.set_samples(sorted(samples_by_bucket.values()))
+    return changed
+
+
+def merge_samples(samples_by_experiment, include_raw=True):
+    """Merge samples into experiments' raw chunks and rollups.
+
+    All of the chunks involved are fetched in a single batch.
+
+    Args:
+        samples_by_experiment: list of (experiment_key, samples) pairs, where
+            samples are (timestamp, counts) tuples
+        include_raw: False to only merge samples into rollups
+    Returns:
+        The changed chunks, which the caller is responsible for putting. To
+        avoid losing a concurrent writer's samples, call this and put the
+        chunks in the same transaction (see record_snapshots).
+    """
+    pending = {}  # chunk key -> (resolution, samples)
+    for experiment_key, samples in samples_by_experiment:
+        for sample in samples:
+            ts = sample[0]
+            if include_raw:
+                key = _chunk_key(experiment_key, RAW, day_period(ts))
+                pending.setdefault(key, (RAW, []))[1].append(sample)
+
+            for resolution, _, fxn_period in ROLLUPS:
+                key = _chunk_key(experiment_key, resolution, fxn_period(ts))
+                pending.setdefault(key, (resolution, []))[1].append(sample)
+
+    keys = pending.keys()
+    bucket_seconds = dict((resolution, seconds)
+                          for resolution, seconds, _ in ROLLUPS)
+
+    changed = []
+    for key, chunk in zip(keys, db.get(keys)):
+        if not chunk:
+            chunk = _GAEBingoSnapshotChunk(key_name=key.name(),
+                                           parent=key.parent())
+
+        resolution, samples = pending[key]
+        if resolution == RAW:
+            chunk.add_samples(samples)
+            changed.append(chunk)
+        elif rollup_samples(chunk, samples, bucket_seconds[resolution]):
+            changed.append(chunk)
+
+    return changed
+
+
+def record_snapshots(experiments_and_alternatives, now=None):
+    """Append a sample of each experiment's latest counts to its chunks.
+
+    Args:
+        experiments_and_alternatives: list of (experiment, alternatives) pairs
+        now: when the sample is being taken, defaults to utcnow
+    """
+    ts = timestamp(now or datetime.datetime.utcnow())
+
+    samples_by_experiment = []
+    for experiment, alternatives in experiments_and_alternatives:
+        # When logging, we want to store the most recent value we've got
+        counts = dict((alternative.number,
+                       (alternative.latest_participants_count(),
+                        alternative.latest_conversions_count()))
+                      for alternative in alternatives)
+        samples_by_experiment.append((experiment.key(), [(ts, counts)]))
+
+    # An experiment's chunks and sequential test are all in its entity
+    # group, so a batch of experiments' are updated in one cross-group
+    # transaction w/ a single get and put.
+    @db.transactional(xg=True)
+    def txn(batch):
+        chunks = merge_samples(batch)
+        db.put(chunks + sequential.update_tests(batch))
+        return chunks
+
+    chunks = []
+    for i in range(0, len(samples_by_experiment), RECORD_BATCH_SIZE):
+        chunks.extend(txn(samples_by_experiment[i:i + RECORD_BATCH_SIZE]))
+
+    append_to_cached_timelines(samples_by_experiment, ts)
+    return chunks
+
+
+def samples_from_legacy_logs(logs):
+    """Pack _GAEBingoSnapshotLog rows into (timestamp, counts) samples.
+
+    All of a tick's rows were created together, so rows are grouped into
+    samples by the minute they were recorded in.
+    """
+    samples_by_time = {}
+    for log in logs:
+        ts = timestamp(log.time_recorded) // 60 * 60
+        samples_by_time.setdefault(ts, {})[log.alternative_number] = (
+                log.participants, log.conversions)
+    return sorted(samples_by_time.items())
+
+
+def _legacy_query(experiment_key):
+    return (_GAEBingoSnapshotLog.all()
+                .ancestor(experiment_key)
+                .order("-time_recorded"))
+
+
+def _legacy_samples(experiment_key, logs):
+    """Return samples from any of experiment's unmigrated legacy rows."""
+    if not logs:
+        memcache.set(MIGRATED_KEY % experiment_key, True)
+        return []
+
+    queue_legacy_migration(experiment_key)
+    return samples_from_legacy_logs(logs)
+
+
+def _timeline_value(counts):
+    """The value LTTB downsamples by: the sum of alternatives' rates."""
+    return sum(float(conversions) / participants
+               for participants, conversions in counts.itervalues()
+               if participants)
+
+
+def lttb_indices(xs, ys, threshold):
+    """Pick which points to keep w/ largest-triangle-three-buckets.
+
+    The first and last points are always kept. The rest are split into
+    threshold - 2 buckets, and from each bucket we keep the point forming the
+    largest triangle w/ the previously kept point and the next bucket's
+    average, which preserves the visual shape of the series.
+
+    Returns:
+        Sorted indices of the points to keep.
+    """
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return range(n)
+
+    every = float(n - 2) / (threshold - 2)
+    selected = [0]
+    a = 0
+
+    for i in range(threshold - 2):
+        avg_start = int(math.floor((i + 1) * every)) + 1
+        avg_end = min(int(math.floor((i + 2) * every)) + 1, n)
+        avg_x = sum(xs[avg_start:avg_end]) / float(avg_end - avg_start)
+        avg_y = sum(ys[avg_start:avg_end]) / float(avg_end - avg_start)
+
+        range_start = int(math.floor(i * every)) + 1
+        range_end = int(math.floor((i + 1) * every)) + 1
+
+        max_area = -1
+        next_a = range_start
+        for j in range(range_start, range_end):
+            area = abs((xs[a] - avg_x) * (ys[j] - ys[a]) -
+                       (xs[a] - xs[j]) * (avg_y - ys[a]))
+            if area > max_area:
+                max_area = area
+                next_a = j
+
+        selected.append(next_a)
+        a = next_a
+
+    selected.append(n - 1)
+    return selected
+
+
+def downsample(samples, max_points=MAX_TIMELINE_POINTS):
+    """Downsample time-ordered samples to at most max_points w/ LTTB.
+
+    Every alternative shares the same kept timestamps, so per-alternative
+    series built from the result stay aligned.
+    """
+    xs = [ts for ts, _ in samples]
+    ys = [_timeline_value(counts) for _, counts in samples]
+    return [samples[i] for i in lttb_indices(xs, ys, max_points)]
+
+
+def load_samples(experiment, max_points=MAX_TIMELINE_POINTS):
+    """Return samples covering experiment's whole lifetime, oldest first.
+
+    Daily rollups cover old history, hourly rollups recent history, and raw
+    samples the last RAW_TIMELINE_DAYS. The result is downsampled to at most
+    max_points.
+    """
+    return load_samples_multi([experiment], max_points)[0]
+
+
+def load_samples_multi(experiments, max_points=MAX_TIMELINE_POINTS):
+    """load_samples for many experiments, w/ all of their queries in flight
+    at once.
+
+    Query.run starts each query asynchronously, so every experiment's chunk
+    queries (and legacy row queries, for experiments that may still have
+    some) are started before any of their results are read. Pass
+    max_points=None for timelines that aren't downsampled.
+    """
+    now = datetime.datetime.utcnow()
+    raw_since = timestamp(now - datetime.timedelta(days=RAW_TIMELINE_DAYS))
+    hourly_since = timestamp(
+            now - datetime.timedelta(days=HOURLY_TIMELINE_DAYS))
+
+    experiment_keys = [experiment.key() for experiment in experiments]
+    migrated = memcache.get_multi([MIGRATED_KEY % experiment_key
+                                   for experiment_key in experiment_keys])
+
+    pending = []
+    for experiment_key in experiment_keys:
+        legacy_logs = None
+        if not migrated.get(MIGRATED_KEY % experiment_key):
+            legacy_logs = _legacy_query(experiment_key).run(limit=1000)
+
+        # (chunks, earliest and latest-exclusive timestamps taken from them)
+        chunk_ranges = [
+            (_chunks_query(experiment_key, DAY).run(),
+             None, hourly_since),
+            (_chunks_query(experiment_key, HOUR,
+                           month_period(hourly_since)).run(),
+             hourly_since, raw_since),
+            (_chunks_query(experiment_key, RAW, day_period(raw_since)).run(),
+             raw_since, None),
+        ]
+        pending.append((experiment_key, legacy_logs, chunk_ranges))
+
+    results = []
+    for experiment_key, legacy_logs, chunk_ranges in pending:
+        samples_by_time = {}
+        if legacy_logs is not None:
+            samples_by_time.update(
+                    _legacy_samples(experiment_key, list(legacy_logs)))
+
+        for chunks, since, until in chunk_ranges:
+            for chunk in chunks:
+                samples_by_time.update(
+                        (ts, counts) for ts, counts in chunk.samples
+                        if (since is None or ts >= since) and
+                           (until is None or ts < until))
+
+        samples = sorted(samples_by_time.items())
+        if max_points is not None:
+            samples = downsample(samples, max_points)
+        results.append(samples)
+
+    return results
+
+
+def _fetch_expired_chunks(experiment_key, resolution, before_period):
+    """Return experiment's chunks of resolution older than before_period."""
+    query = (_GAEBingoSnapshotChunk.all()
+                .ancestor(experiment_key)
+                .filter("__key__ >=", _chunk_key(experiment_key, resolution, ""))
+                .filter("__key__ <",
+                    _chunk_key(experiment_key, resolution, before_period)))
+    return list(query)
+
+
+def _chunk_bytes(chunks):
+    return sum(len(chunk.pickled_samples or "") for chunk in chunks)
+
+
+def compact_experiment(experiment_key, now=None):
+    """Apply the retention policy to one experiment's snapshot chunks.
+
+    Expired chunks' samples are merged into the coarser rollups before the
+    chunks are deleted, which also rebuilds rollups for raw chunks that were
+    written before rollups existed.
+
+    Returns:
+        dict of counts describing what was compacted. bytes_reclaimed is net
+        of what rollups grew by.
+    """
+    now = now or datetime.datetime.utcnow()
+    raw_before = day_period(timestamp(
+            now - datetime.timedelta(days=RAW_RETENTION_DAYS)))
+    hourly_before = month_period(timestamp(
+            now - datetime.timedelta(days=HOURLY_RETENTION_DAYS)))
+
+    stats = {"chunks_deleted": 0, "rollups_written": 0, "bytes_reclaimed": 0}
+
+    # Raw chunks go first, since rolling them up can touch hourly rollups
+    # that are about to expire too.
+    for resolution, before_period in [(RAW, raw_before),
+                                      (HOUR, hourly_before)]:
+        def txn():
+            chunks = _fetch_expired_chunks(experiment_key, resolution,
+                                           before_period)
+            if not chunks:
+                return [], [], 0
+
+            samples = []
+            for chunk in chunks:
+                samples.extend(chunk.samples)
+
+            # Expired hourly rollups are rolled into themselves too, but
+            # they're about to be deleted.
+            expired_keys = set(chunk.key() for chunk in chunks)
+            rollups = [rollup for rollup in
+                       merge_samples([(experiment_key, samples)],
+                                     include_raw=False)
+                       if rollup.key() not in expired_keys]
+
+            # Rollups grow as samples are merged in, which eats into what
+            # deleting the expired chunks reclaims.
+            previous = db.get([rollup.key() for rollup in rollups])
+            bytes_grown = (_chunk_bytes(rollups) -
+                           _chunk_bytes(filter(None, previous)))
+
+            db.put(rollups)
+            db.delete(chunks)
+            return chunks, rollups, _chunk_bytes(chunks) - bytes_grown
+
+        # Rollups are merged and expired chunks deleted together, so a
+        # concurrent snapshot tick can't be lost or roll up a deleted chunk.
+        chunks, rollups, bytes_reclaimed = db.run_in_transaction(txn)
+
+        stats["rollups_written"] += len(rollups)
+        stats["chunks_deleted"] += len(chunks)
+        stats["bytes_reclaimed"] += bytes_reclaimed
+
+    # Fold in any legacy rows of experiments nobody's looked at since
+    if (_GAEBingoSnapshotLog.all(keys_only=True)
+            .ancestor(experiment_key).get()):
+        queue_legacy_migration(experiment_key)
+
+    return stats
+
+
+def compact_snapshots(cursor=None, totals=None):
+    """Compact every experiment's snapshot chunks, a batch at a time.
+
+    Experiments are walked w/ a query cursor. If this runs out of time, it
+    defers itself to pick up where it left off w/ the totals so far.
+
+    Returns:
+        dict of counts describing what was compacted so far.
+    """
+    deadline = time.time() + COMPACTION_SECONDS
+    totals = totals or {"experiments": 0, "chunks_deleted": 0,
+                        "rollups_written": 0, "bytes_reclaimed": 0}
+
+    while True:
+        query = _GAEBingoExperiment.all(keys_only=True)
+        if cursor:
+            query.with_cursor(cursor)
+        experiment_keys = query.fetch(COMPACTION_BATCH_SIZE)
+
+        for experiment_key in experiment_keys:
+            stats = compact_experiment(experiment_key)
+            for key, value in stats.iteritems():
+                totals[key] += value
+            totals["experiments"] += 1
+
+        if len(experiment_keys) < COMPACTION_BATCH_SIZE:
+            break
+
+        cursor = query.cursor()
+        if time.time() > deadline:
+            deferred.defer(compact_snapshots, cursor, totals,
+                           _queue=config.QUEUE_NAME)
+            return totals
+
+    logging.info("Compacted gae/bingo snapshots of %(experiments)s "
+                 "experiments: deleted %(chunks_deleted)s chunks, "
+                 "reclaimed %(bytes_reclaimed)s bytes, wrote "
+                 "%(rollups_written)s rollups" % totals)
+    return totals
+
+
+def last_tick():
+    """Timestamp of the latest snapshot tick, or None if unknown."""
+    return memcache.get(LAST_TICK_KEY)
+
+
+def cached_samples(experiment):
+    """Return load_samples(experiment), cached until the next snapshot tick.
+
+    The next tick appends its sample to the cached timeline and re-caches it
+    under that tick, so readers never see a timeline missing a tick's sample
+    once its chunks have been put.
+    """
+    return cached_samples_multi([experiment])[0]
+
+
+def cached_samples_multi(experiments):
+    """cached_samples for many experiments, w/ one memcache get.
+
+    Timelines that aren't cached are loaded together by load_samples_multi.
+    """
+    tick = last_tick()
+    if tick is None:
+        # No way to tell whether a cached timeline is up to date
+        return load_samples_multi(experiments)
+
+    keys = [TIMELINE_KEY % (experiment.key(), tick)
+            for experiment in experiments]
+    cached = memcache.get_multi(keys)
+
+    missing = [index for index, key in enumerate(keys) if key not in cached]
+    if missing:
+        loaded = load_samples_multi([experiments[index]
+                                     for index in missing])
+        mapping = dict((keys[index], samples)
+                       for index, samples in zip(missing, loaded))
+        memcache.add_multi(mapping, time=TIMELINE_CACHE_SECONDS)
+        cached.update(mapping)
+
+    return [cached[key] for key in keys]
+
+
+def append_to_cached_timelines(samples_by_experiment, ts):
+    """Append a snapshot tick's samples to experiments' cached timelines.
+
+    Timelines cached as of the previous tick are re-cached under this tick
+    w/ its samples appended, and then this tick becomes the latest one.
+    Experiments w/out a cached timeline are left to be loaded on demand.
+    """
+    previous_tick = last_tick()
+    if previous_tick is not None and previous_tick >= ts:
+        return
+
+    if previous_tick is not None:
+        previous_keys = dict((TIMELINE_KEY % (experiment_key, previous_tick),
+                              (experiment_key, samples))
+                             for experiment_key, samples
+                             in samples_by_experiment)
+        cached = memcache.get_multi(previous_keys.keys())
+
+        mapping = {}
+        for previous_key, timeline in cached.iteritems():
+            experiment_key, samples = previous_keys[previous_key]
+            timeline = timeline + samples
+            if len(timeline) > 2 * MAX_TIMELINE_POINTS:
+                timeline = downsample(timeline)
+            mapping[TIMELINE_KEY % (experiment_key, ts)] = timeline
+
+        if mapping:
+            memcache.set_multi(mapping, time=TIMELINE_CACHE_SECONDS)
+
+    memcache.set(LAST_TICK_KEY, ts)
+
+
+def queue_legacy_migration(experiment_key):
+    """Queue up migrate_legacy_snapshots, at most once per 10 minutes."""
+    window = int(time.time() / 600)
+    sig = hashlib.md5(str(experiment_key)).hexdigest()
+    try:
+        deferred.defer(migrate_legacy_snapshots, experiment_key,
+                _queue=config.QUEUE_NAME,
+                _name="gae-bingo-snapshot-migration-%s-%s" % (sig, window))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def migrate_legacy_snapshots(experiment_key):
+    """Fold an experiment's _GAEBingoSnapshotLog rows into snapshot chunks.
+
+    Rows are only deleted once their chunks have been put. Re-migrating rows
+    merges the same counts into the same samples, so this is safe to retry.
+
+    Returns:
+        The # of legacy rows migrated.
+    """
+    deadline = time.time() + MIGRATION_SECONDS
+    migrated = 0
+
+    def txn():
+        logs = (_GAEBingoSnapshotLog.all()
+                    .ancestor(experiment_key)
+                    .fetch(LEGACY_BATCH_SIZE))
+        if logs:
+            db.put(merge_samples(
+                    [(experiment_key, samples_from_legacy_logs(logs))]))
+            db.delete(logs)
+        return len(logs)
+
+    while True:
+        # Rows and chunks are all in the experiment's entity group, so each
+        # batch is folded in and deleted in one transaction.
+        batch_size = db.run_in_transaction(txn)
+        if not batch_size:
+            memcache.set(MIGRATED_KEY % experiment_key, True)
+            memcache.delete(TIMELINE_KEY %
+                            (experiment_key, last_tick()))
+            break
+
+        migrated += batch_size
+
+        if time.time() > deadline:
+            deferred.defer(migrate_legacy_snapshots, experiment_key,
+                           _queue=config.QUEUE_NAME)
+            break
+
+    logging.info("Migrated %s gae/bingo snapshot rows of %s into chunks" %
+                 (migrated, experiment_key))
+    return migrated
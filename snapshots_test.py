@@ -0,0 +1,141 @@
+import datetime
+
+from google.appengine.ext import db
+import mock
+
+from testutil import gae_model
+
+from . import models
+from . import snapshots
+
+
+class SnapshotsTest(gae_model.GAEModelTestCase):
+    def setUp(self):
+        super(SnapshotsTest, self).setUp()
+        self.experiment, self.alternatives = (
+                models.create_experiment_and_alternatives(
+                    "monkeys", "monkeys"))
+        db.put([self.experiment] + self.alternatives)
+
+    def test_record_snapshots_packs_a_day_into_one_chunk(self):
+        now = datetime.datetime.utcnow()
+        experiments_and_alternatives = [(self.experiment, self.alternatives)]
+        snapshots.record_snapshots(experiments_and_alternatives, now=now)
+        snapshots.record_snapshots(experiments_and_alternatives,
+                now=now + datetime.timedelta(seconds=1))
+
+        chunks = snapshots.fetch_chunks(self.experiment.key(), snapshots.RAW)
+        self.assertEqual(1, len(chunks))
+        self.assertEqual(2, len(chunks[0].samples))
+        self.assertEqual({0: (0, 0), 1: (0, 0)}, chunks[0].samples[0][1])
+
+    def test_legacy_snapshots_are_read_and_migrated(self):
+        db.put([models._GAEBingoSnapshotLog(parent=self.experiment,
+                                            alternative_number=n,
+                                            participants=10 + n,
+                                            conversions=n)
+                for n in range(2)])
+
+        samples = snapshots.load_samples(self.experiment)
+        self.assertEqual(1, len(samples))
+        self.assertEqual({0: (10, 0), 1: (11, 1)}, samples[0][1])
+
+        self.assertEqual(2, snapshots.migrate_legacy_snapshots(
+                self.experiment.key()))
+        self.assertEqual(0, models._GAEBingoSnapshotLog.all().count())
+        self.assertEqual(samples, snapshots.load_samples(self.experiment))
+
+    def test_rollups_keep_each_buckets_earliest_sample(self):
+        start = datetime.datetime(2012, 3, 1)
+        experiments_and_alternatives = [(self.experiment, self.alternatives)]
+        for minutes in [0, 30, 60, 90]:
+            snapshots.record_snapshots(experiments_and_alternatives,
+                    now=start + datetime.timedelta(minutes=minutes))
+
+        key = self.experiment.key()
+        hourly = snapshots.fetch_chunks(key, snapshots.HOUR)
+        self.assertEqual(["2012-03"],
+                         [chunk.key().name().split(":")[-1]
+                          for chunk in hourly])
+        self.assertEqual(
+                [snapshots.timestamp(start),
+                 snapshots.timestamp(start + datetime.timedelta(hours=1))],
+                [ts for ts, _ in hourly[0].samples])
+
+        daily = snapshots.fetch_chunks(key, snapshots.DAY)
+        self.assertEqual([snapshots.timestamp(start)],
+                         [ts for ts, _ in daily[0].samples])
+
+    def test_downsample_keeps_endpoints_and_spikes(self):
+        samples = [(ts, {0: (100, 10)}) for ts in range(100)]
+        samples[50] = (50, {0: (100, 90)})
+
+        downsampled = snapshots.downsample(samples, max_points=10)
+        self.assertEqual(10, len(downsampled))
+        self.assertEqual(samples[0], downsampled[0])
+        self.assertEqual(samples[-1], downsampled[-1])
+        self.assertIn(samples[50], downsampled)
+
+        self.assertEqual(samples, snapshots.downsample(samples,
+                                                       max_points=1000))
+
+    def test_snapshot_ticks_append_to_cached_timelines(self):
+        now = datetime.datetime.utcnow()
+        experiments_and_alternatives = [(self.experiment, self.alternatives)]
+        snapshots.record_snapshots(experiments_and_alternatives, now=now)
+        self.assertEqual(1, len(snapshots.cached_samples(self.experiment)))
+
+        # The next tick appends to the cached timeline w/out reloading it
+        with mock.patch.object(snapshots,
+                               "load_samples_multi") as load_samples_multi:
+            snapshots.record_snapshots(experiments_and_alternatives,
+                    now=now + datetime.timedelta(minutes=30))
+            samples = snapshots.cached_samples(self.experiment)
+            self.assertFalse(load_samples_multi.called)
+        self.assertEqual(2, len(samples))
+
+    def test_cached_samples_multi_loads_uncached_timelines_together(self):
+        other, other_alternatives = models.create_experiment_and_alternatives(
+                "monkeys (bananas)", "monkeys", conversion_name="bananas")
+        db.put([other] + other_alternatives)
+
+        now = datetime.datetime.utcnow()
+        snapshots.record_snapshots([(self.experiment, self.alternatives),
+                                    (other, other_alternatives)], now=now)
+
+        expected = [snapshots.load_samples(self.experiment),
+                    snapshots.load_samples(other)]
+        self.assertEqual(expected, snapshots.cached_samples_multi(
+                [self.experiment, other]))
+
+        # Both are cached now
+        with mock.patch.object(snapshots,
+                               "load_samples_multi") as load_samples_multi:
+            self.assertEqual(expected, snapshots.cached_samples_multi(
+                    [self.experiment, other]))
+            self.assertFalse(load_samples_multi.called)
+
+    def test_compaction_keeps_rollups_of_expired_chunks(self):
+        now = datetime.datetime(2012, 12, 1)
+        old = now - datetime.timedelta(days=120)
+        key = self.experiment.key()
+
+        # A raw chunk written before rollups existed...
+        chunk = models._GAEBingoSnapshotChunk(
+                key_name=models._GAEBingoSnapshotChunk.key_name_for(
+                    snapshots.RAW, snapshots.day_period(
+                        snapshots.timestamp(old))),
+                parent=key)
+        chunk.set_samples([(snapshots.timestamp(old), {0: (1, 0)})])
+        chunk.put()
+
+        # ...is rolled all the way up to daily before it's deleted.
+        stats = snapshots.compact_experiment(key, now=now)
+        self.assertEqual(2, stats["chunks_deleted"])
+        # Its only sample moved to the daily rollup, so nothing's reclaimed
+        self.assertEqual(0, stats["bytes_reclaimed"])
+        self.assertEqual([], snapshots.fetch_chunks(key, snapshots.RAW))
+        self.assertEqual([], snapshots.fetch_chunks(key, snapshots.HOUR))
+        daily = snapshots.fetch_chunks(key, snapshots.DAY)
+        self.assertEqual([(snapshots.timestamp(old), {0: (1, 0)})],
+                         daily[0].samples)
@@ -63,7 +63,7 @@ var GAEDashboard = {
      */
     loadExperiments: function() {
 
-        $.ajax({
+        this.ajaxIfModified({
             url: "/gae_bingo/api/v1/experiments",
             dataType: "json",
             type: "GET",
@@ -76,6 +76,7 @@ var GAEDashboard = {
 
                 $("#main").append($("#tmpl-experiments").handlebars(data));
                 GAEDashboard.updateControls();
+                GAEDashboard.renderLoadMore(data.cursor);
 
                 // Attach click handlers for expanding individual experiments
                 $("#main").on("click", ".experiment-container-minimized", function(e) {
@@ -91,12 +92,14 @@ var GAEDashboard = {
                             .end()
                         .find(".refresh-conversion")
                             .click(function(e) {
-                                var expt = $(this)
-                                    .closest("div.experiment-container")
-                                        .find(".active .conversions-link")
-                                        .data("experiment-name");
-                                GAEDashboard
-                                    .loadConversionsContent(expt, true);
+                                var container = $(this)
+                                    .closest("div.experiment-container");
+                                var expt = container
+                                    .find(".active .conversions-link")
+                                    .data("experiment-name");
+                                GAEDashboard.loadConversionsContent(
+                                    container.data("canonical-name"), expt,
+                                    true);
                             })
                             .end()
                         .find(".control-experiment")
@@ -216,6 +219,47 @@ var GAEDashboard = {
         });
     },
 
+    /**
+     * Archived experiments are listed a page at a time. Show a button that
+     * appends the page at cursor, if there is one. The click handlers
+     * attached by loadExperiments are delegated, so they cover new pages.
+     */
+    renderLoadMore: function(cursor) {
+        $("#load-more").remove();
+        if (!cursor) {
+            return;
+        }
+
+        $("<div id=\"load-more\" class=\"btn btn-large\">Load more archived experiments</div>")
+            .appendTo("#main")
+            .click(function(e) {
+                if ($(this).is(".disabled")) {
+                    return;
+                }
+                $(this).addClass("disabled").text("Loading...");
+                GAEDashboard.loadMoreExperiments(cursor);
+            });
+    },
+
+    loadMoreExperiments: function(cursor) {
+
+        this.ajaxIfModified({
+            url: "/gae_bingo/api/v1/experiments",
+            dataType: "json",
+            type: "GET",
+            data: {
+                archives: this.archives ? 1 : 0,
+                cursor: cursor
+            },
+            success: function(data) {
+                $("#load-more").remove();
+                $("#main").append($("#tmpl-experiments").handlebars(data));
+                GAEDashboard.updateControls();
+                GAEDashboard.renderLoadMore(data.cursor);
+            }
+        });
+    },
+
     /**
      * Load summary information for an individual experiment. Summaries contain
      * the names of all metrics/experiments included in the canonical
@@ -223,7 +267,7 @@ var GAEDashboard = {
      */
     loadExperimentSummary: function(canonicalName) {
 
-        $.ajax({
+        this.ajaxIfModified({
             url: "/gae_bingo/api/v1/experiments/summary",
             data: {
                 canonical_name: canonicalName,
@@ -290,7 +334,7 @@ var GAEDashboard = {
                                     .addClass("active")
                                     .end();
 
-                            GAEDashboard.loadConversionsContent($(this).data("experiment-name"));
+                            GAEDashboard.loadConversionsContent(canonicalName, $(this).data("experiment-name"));
 
                         })
                         .first()
@@ -558,23 +602,30 @@ var GAEDashboard = {
 
     /**
      * Load historical participation/conversion data for a specific experiment
-     * or metric.
+     * or metric. Data for every experiment/metric of its canonical experiment
+     * is loaded in the same request, so switching between them doesn't hit
+     * the API again.
      */
-    loadConversionsContent: function(experimentName, force) {
+    loadConversionsContent: function(canonicalName, experimentName, force) {
         if (!force && this.conversionData[experimentName]) {
             this.renderConversions(experimentName);
             return;
         }
 
-        $.ajax({
+        this.ajaxIfModified({
             type: "GET",
-            url: "/gae_bingo/api/v1/experiments/conversions",
+            url: "/gae_bingo/api/v1/experiments/conversions/batch",
             data: {
-                experiment_name: experimentName,
+                canonical_name: canonicalName,
                 archives: this.archives ? 1 : 0
             },
             dataType: "json",
-        }).then(_.bind(this.receivedConversionsData, this, experimentName));
+        }).then(_.bind(function(dataBatch) {
+            _.each(dataBatch[canonicalName], function(data) {
+                this.receivedConversionsData(data.experiment_name, data);
+            }, this);
+            this.renderConversions(experimentName);
+        }, this));
     },
 
     receivedConversionsData: function(experimentName, data) {
@@ -592,8 +643,6 @@ var GAEDashboard = {
                 return x[0];
             });
         });
-
-        this.renderConversions(experimentName);
     },
 
     showThrobber: function() {
@@ -604,6 +653,38 @@ var GAEDashboard = {
         $(".throbber").hide();
     },
 
+    /**
+     * Map of API url + params to the last response received for it.
+     */
+    responseCache: {},
+
+    /**
+     * $.ajax for GETs from the API that only transfer data that's changed.
+     * jQuery sends each url's last ETag, and when the API answers 304 Not
+     * Modified the last response is passed to success/then instead.
+     */
+    ajaxIfModified: function(options) {
+        var cache = this.responseCache,
+            key = options.url + "?" + $.param(options.data || {}),
+            success = options.success;
+
+        return $.ajax($.extend({}, options, {
+            ifModified: true,
+            success: function(data, status, xhr) {
+                if (status === "notmodified") {
+                    data = cache[key];
+                } else {
+                    cache[key] = data;
+                }
+                if (success) {
+                    success.call(this, data, status, xhr);
+                }
+            }
+        })).then(function(data, status) {
+            return status === "notmodified" ? cache[key] : data;
+        });
+    },
+
     /**
      * Map of canonical name to HighCharts instance. Used to destroy charts.
      * @type {Object}
@@ -1,4 +1,13 @@
 import logging
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .models import ConversionTypes
+import instance_cache
 
 # This file in particular is almost a direct port from Patrick McKenzie's A/Bingo's abingo/lib/abingo/statistics.rb
 
@@ -53,7 +62,13 @@ def p_value(alternatives):
 def is_statistically_significant(p = 0.05):
     return p_value <= p
 
-def describe_result_in_words(alternatives):
+def describe_result_in_words(alternatives, conversion_type=None):
+
+    if conversion_type == ConversionTypes.Counting:
+        return describe_counting_result_in_words(alternatives)
+
+    if len(alternatives) > 2:
+        return describe_multiple_results_in_words(alternatives)
 
     try:
         z = zscore(alternatives)
@@ -99,3 +114,486 @@ def describe_result_in_words(alternatives):
 
     return words
 
+
+# Everything below computes statistics across any # of alternatives, for
+# every experiment the dashboard shows in one batch. It uses NumPy when the
+# app has it enabled (see app.yaml's libraries section), and falls back to
+# plain Python otherwise.
+
+# z for two-sided 95% confidence intervals
+CONFIDENCE_Z = 1.959963984540054
+
+# Results are cached in instance memory by their counts for this long, in an
+# LRU of at most this many
+ANALYSIS_CACHE_SECONDS = 60 * 60
+ANALYSIS_CACHE_MAX_ENTRIES = 1000
+
+_analyses = instance_cache.LRUCache(ANALYSIS_CACHE_MAX_ENTRIES,
+                                    expiry=ANALYSIS_CACHE_SECONDS)
+
+
+def _gammaincc(a, x):
+    """Regularized upper incomplete gamma function Q(a, x).
+
+    Uses the series expansion below a + 1 and Lentz's continued fraction
+    above it, as in Numerical Recipes.
+    """
+    if x <= 0:
+        return 1.0
+
+    log_prefix = -x + a * math.log(x) - math.lgamma(a)
+
+    if x < a + 1:
+        term = total = 1.0 / a
+        ap = a
+        for _ in xrange(1000):
+            ap += 1
+            term *= x / ap
+            total += term
+            if abs(term) < abs(total) * 1e-14:
+                break
+        return max(0.0, 1.0 - total * math.exp(log_prefix))
+
+    tiny = 1e-300
+    b = x + 1 - a
+    c = 1.0 / tiny
+    d = 1.0 / b
+    h = d
+    for i in xrange(1, 1000):
+        an = -i * (i - a)
+        b += 2
+        d = an * d + b
+        if abs(d) < tiny:
+            d = tiny
+        c = b + an / c
+        if abs(c) < tiny:
+            c = tiny
+        d = 1.0 / d
+        delta = d * c
+        h *= delta
+        if abs(delta - 1) < 1e-14:
+            break
+    return math.exp(log_prefix) * h
+
+
+def chi_square_p_value(statistic, degrees_of_freedom):
+    """P(X >= statistic) for X chi-square distributed w/ the given df."""
+    if degrees_of_freedom < 1:
+        return None
+    return _gammaincc(degrees_of_freedom / 2.0, statistic / 2.0)
+
+
+def normal_p_value(z):
+    """Two-sided p-value of a standard normal z score."""
+    return math.erfc(abs(z) / math.sqrt(2))
+
+
+def holm_adjust(p_values):
+    """Holm-Bonferroni adjusted p-values, in the same order as p_values."""
+    m = len(p_values)
+    adjusted = [None] * m
+    running_max = 0.0
+    for rank, index in enumerate(sorted(range(m), key=lambda i: p_values[i])):
+        running_max = max(running_max, min(1.0, (m - rank) * p_values[index]))
+        adjusted[index] = running_max
+    return adjusted
+
+
+def _statistics_python(counts):
+    """Test statistics of one experiment's (participants, conversions)."""
+    total = sum(participants for participants, _ in counts)
+    total_conversions = sum(conversions for _, conversions in counts)
+    pooled_rate = float(total_conversions) / total if total else 0.0
+
+    chi_square = g_test = 0.0
+    rates, intervals = [], []
+    for participants, conversions in counts:
+        for observed, expected in [
+                (conversions, participants * pooled_rate),
+                (participants - conversions,
+                    participants * (1 - pooled_rate))]:
+            if expected > 0:
+                chi_square += (observed - expected) ** 2 / expected
+                if observed > 0:
+                    g_test += 2 * observed * math.log(observed / expected)
+
+        if participants:
+            rate = float(conversions) / participants
+            z2_n = CONFIDENCE_Z ** 2 / participants
+            center = (rate + z2_n / 2) / (1 + z2_n)
+            half = (CONFIDENCE_Z *
+                    math.sqrt(rate * (1 - rate) / participants +
+                              z2_n / (4 * participants)) / (1 + z2_n))
+            rates.append(rate)
+            intervals.append((center - half, center + half))
+        else:
+            rates.append(0.0)
+            intervals.append((0.0, 1.0))
+
+    z_scores = []
+    for i in range(len(counts)):
+        for j in range(i + 1, len(counts)):
+            n1, n2 = counts[i][0], counts[j][0]
+            variance = 0.0
+            if n1 and n2:
+                variance = (rates[i] * (1 - rates[i]) / n1 +
+                            rates[j] * (1 - rates[j]) / n2)
+            z = (rates[i] - rates[j]) / math.sqrt(variance) if variance else 0.0
+            z_scores.append((i, j, z))
+
+    return chi_square, g_test, rates, intervals, z_scores
+
+
+def _statistics_numpy(counts_list):
+    """_statistics_python for many experiments at once, w/ NumPy.
+
+    Experiments are padded w/ empty alternatives up to the largest # of
+    alternatives, which don't contribute to any statistic.
+    """
+    width = max(len(counts) for counts in counts_list)
+    table = numpy.zeros((len(counts_list), width, 2))
+    for row, counts in enumerate(counts_list):
+        table[row, :len(counts)] = counts
+
+    participants, conversions = table[:, :, 0], table[:, :, 1]
+    total = participants.sum(axis=1)
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        pooled_rate = numpy.where(total > 0,
+                                  conversions.sum(axis=1) / total, 0.0)
+
+        chi_square = numpy.zeros(len(counts_list))
+        g_test = numpy.zeros(len(counts_list))
+        for observed, expected in [
+                (conversions, participants * pooled_rate[:, None]),
+                (participants - conversions,
+                    participants * (1 - pooled_rate[:, None]))]:
+            chi_square += numpy.where(expected > 0,
+                    (observed - expected) ** 2 / expected, 0.0).sum(axis=1)
+            g_test += numpy.where((expected > 0) & (observed > 0),
+                    2 * observed * numpy.log(observed / expected),
+                    0.0).sum(axis=1)
+
+        rates = numpy.where(participants > 0, conversions / participants, 0.0)
+        z2_n = CONFIDENCE_Z ** 2 / participants
+        center = (rates + z2_n / 2) / (1 + z2_n)
+        half = (CONFIDENCE_Z *
+                numpy.sqrt(rates * (1 - rates) / participants +
+                           z2_n / (4 * participants)) / (1 + z2_n))
+        lower = numpy.where(participants > 0, center - half, 0.0)
+        upper = numpy.where(participants > 0, center + half, 1.0)
+
+        first, second = numpy.triu_indices(width, 1)
+        variance = (rates[:, first] * (1 - rates[:, first]) /
+                        participants[:, first] +
+                    rates[:, second] * (1 - rates[:, second]) /
+                        participants[:, second])
+        z_scores = numpy.where(variance > 0,
+                (rates[:, first] - rates[:, second]) / numpy.sqrt(variance),
+                0.0)
+
+    results = []
+    for row, counts in enumerate(counts_list):
+        k = len(counts)
+        pairs = [(i, j, float(z)) for i, j, z
+                 in zip(first, second, z_scores[row]) if j < k]
+        results.append((float(chi_square[row]), float(g_test[row]),
+                        rates[row, :k].tolist(),
+                        zip(lower[row, :k].tolist(), upper[row, :k].tolist()),
+                        [(int(i), int(j), z) for i, j, z in pairs]))
+    return results
+
+
+def _analysis(counts, statistics):
+    """Turn an experiment's test statistics into its analysis."""
+    chi_square, g_test, rates, intervals, z_scores = statistics
+    active = len([participants for participants, _ in counts if participants])
+    degrees_of_freedom = active - 1
+
+    p_values = [normal_p_value(z) for _, _, z in z_scores]
+    return {
+        "degrees_of_freedom": degrees_of_freedom,
+        "chi_square": chi_square,
+        "chi_square_p_value": chi_square_p_value(chi_square,
+                                                 degrees_of_freedom),
+        "g_test": g_test,
+        "g_test_p_value": chi_square_p_value(g_test, degrees_of_freedom),
+        "conversion_rates": rates,
+        "confidence_intervals": intervals,
+        "pairwise": [{
+                "alternatives": (i, j),
+                "z_score": z,
+                "p_value": p,
+                "adjusted_p_value": adjusted,
+            } for (i, j, z), p, adjusted
+            in zip(z_scores, p_values, holm_adjust(p_values))],
+    }
+
+
+def analyze_counts(counts_list):
+    """Analyze many experiments' alternatives in one batch.
+
+    For each experiment, this runs chi-square and G-tests of whether any
+    alternative converts differently, z-tests between every pair of
+    alternatives w/ Holm-corrected p-values, and Wilson score confidence
+    intervals of each alternative's conversion rate.
+
+    Results are cached by counts in a bounded per-instance LRU that request
+    handlers' instance cache flushes don't clear, so only experiments whose
+    counts changed get recomputed.
+
+    Args:
+        counts_list: list of each experiment's alternatives' counts, as lists
+            of (participants, conversions) tuples
+    Returns:
+        A list of analysis dicts, in the same order as counts_list. Pairwise
+        comparisons refer to alternatives by their index in counts.
+    """
+    keys = [tuple(map(tuple, counts)) for counts in counts_list]
+    results = [_analyses.get(key) for key in keys]
+
+    for index, counts in enumerate(counts_list):
+        if any(conversions > participants
+               for participants, conversions in counts):
+            results[index] = {"error": "These tests only apply to "
+                    "experiments w/ at most one conversion per participant."}
+
+    missing = [index for index, result in enumerate(results)
+               if result is None]
+    if missing:
+        missing_counts = [[tuple(count) for count in counts_list[index]]
+                          for index in missing]
+        if numpy:
+            statistics = _statistics_numpy(missing_counts)
+        else:
+            statistics = [_statistics_python(counts)
+                          for counts in missing_counts]
+
+        for index, counts, stats in zip(missing, missing_counts, statistics):
+            results[index] = _analysis(counts, stats)
+            _analyses.set(keys[index], results[index])
+
+    return results
+
+
+def analyze_alternatives(alternative_lists, conversion_types=None):
+    """analyze_counts for lists of alternatives.
+
+    Pairwise comparisons refer to alternatives by their numbers. Counting
+    experiments' alternatives can convert more than once per participant,
+    so they get Welch's t-test (see analyze_counting) instead.
+
+    Args:
+        alternative_lists: each experiment's alternatives
+        conversion_types: each experiment's conversion type, if known
+    """
+    conversion_types = conversion_types or [None] * len(alternative_lists)
+    binomial = [index for index, conversion_type
+                in enumerate(conversion_types)
+                if conversion_type != ConversionTypes.Counting]
+
+    analyses = dict(zip(binomial, analyze_counts([
+            [(alternative.participants, alternative.conversions)
+             for alternative in alternative_lists[index]]
+            for index in binomial])))
+
+    results = []
+    for index, alternatives in enumerate(alternative_lists):
+        if index not in analyses:
+            results.append(analyze_counting(alternatives))
+            continue
+
+        analysis = analyses[index]
+        if "error" in analysis:
+            results.append(analysis)
+            continue
+
+        analysis = dict(analysis)
+        analysis["pairwise"] = [
+                dict(pair, alternatives=tuple(alternatives[i].number
+                                              for i in pair["alternatives"]))
+                for pair in analysis["pairwise"]]
+        results.append(analysis)
+    return results
+
+
+def describe_multiple_results_in_words(alternatives):
+    """describe_result_in_words for experiments w/ > 2 alternatives."""
+
+    analysis = analyze_alternatives([alternatives])[0]
+    if "error" in analysis:
+        return analysis["error"]
+
+    p = analysis["chi_square_p_value"]
+    if p is None:
+        return "Can't calculate statistics until at least two alternatives have participants."
+
+    words = ""
+
+    if min(alternative.participants for alternative in alternatives) < 10:
+        words += "Take these results with a grain of salt since your samples are so small: "
+
+    best_alternative = max(alternatives, key=lambda alternative: alternative.conversion_rate)
+    words += """The best of your %(count)s alternatives is [%(content)s], which had %(conversions)s conversions from 
+    %(participants)s participants (%(pretty_conversion_rate)s).  """ % {
+                "count": len(alternatives),
+                "content": best_alternative.content,
+                "conversions": best_alternative.conversions,
+                "participants": best_alternative.participants,
+                "pretty_conversion_rate": best_alternative.pretty_conversion_rate,
+            }
+
+    if p > 0.05:
+        words += "However, the differences between alternatives are not statistically significant (p = %.3f)." % p
+        return words
+
+    words += "The differences between alternatives are statistically significant (p = %.3g).  " % p
+
+    contents = dict((alternative.number, alternative.content) for alternative in alternatives)
+    significant = ["[%s] vs. [%s]" % (contents[pair["alternatives"][0]], contents[pair["alternatives"][1]])
+                   for pair in analysis["pairwise"] if pair["adjusted_p_value"] <= 0.05]
+    if significant:
+        words += "After correcting for multiple comparisons, these pairs differ significantly: %s." % ", ".join(significant)
+    else:
+        words += "However, no single pair of alternatives differs significantly after correcting for multiple comparisons."
+
+    return words
+
+
+def _betacf(a, b, x):
+    """Continued fraction for the incomplete beta function, as in Numerical
+    Recipes."""
+    tiny = 1e-300
+    c = 1.0
+    d = 1 - (a + b) * x / (a + 1)
+    d = 1.0 / (d if abs(d) > tiny else tiny)
+    h = d
+    for m in xrange(1, 1000):
+        m2 = 2 * m
+        for numerator in [m * (b - m) * x / ((a + m2 - 1) * (a + m2)),
+                          -(a + m) * (a + b + m) * x / ((a + m2) * (a + m2 + 1))]:
+            d = 1 + numerator * d
+            d = 1.0 / (d if abs(d) > tiny else tiny)
+            c = 1 + numerator / c
+            c = c if abs(c) > tiny else tiny
+            h *= d * c
+        if abs(d * c - 1) < 1e-14:
+            break
+    return h
+
+
+def _betainc(a, b, x):
+    """Regularized incomplete beta function I_x(a, b)."""
+    if x <= 0:
+        return 0.0
+    if x >= 1:
+        return 1.0
+
+    log_front = (math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) +
+                 a * math.log(x) + b * math.log(1 - x))
+    if x < (a + 1) / (a + b + 2):
+        return math.exp(log_front) * _betacf(a, b, x) / a
+    return 1 - math.exp(log_front) * _betacf(b, a, 1 - x) / b
+
+
+def t_p_value(t, degrees_of_freedom):
+    """Two-sided p-value of Student's t w/ (possibly fractional) df."""
+    return _betainc(degrees_of_freedom / 2.0, 0.5,
+                    degrees_of_freedom / (degrees_of_freedom + t * t))
+
+
+def mean_and_variance(alternative):
+    """Mean and sample variance of conversions per participant.
+
+    Uses the sum of squared conversions per participant, so this works for
+    Counting experiments. Returns None if the variance can't be estimated,
+    including when the sum is unknown (None): alternatives from before it
+    was tracked, or that have missed an increment of it.
+    """
+    n = alternative.participants
+    if n < 2 or alternative.conversions_sq is None:
+        return None
+
+    mean = float(alternative.conversions) / n
+    variance = (alternative.conversions_sq - n * mean * mean) / (n - 1)
+    if variance < 0:
+        # The sum of squares lost increments its conversions didn't, say to
+        # a memcache eviction of just its counters
+        return None
+    return mean, variance
+
+
+def welch_t_test(alternatives):
+    """Welch's t-test of two alternatives' conversions per participant.
+
+    Returns:
+        (t, degrees of freedom, p-value), or None if either alternative's
+        variance can't be estimated.
+    """
+    first, second = [mean_and_variance(alternative)
+                     for alternative in alternatives]
+    if not first or not second:
+        return None
+
+    (mean1, variance1), (mean2, variance2) = first, second
+    n1, n2 = alternatives[0].participants, alternatives[1].participants
+    se1, se2 = variance1 / n1, variance2 / n2
+    if se1 + se2 == 0:
+        return 0.0, n1 + n2 - 2, 1.0
+
+    t = (mean1 - mean2) / math.sqrt(se1 + se2)
+    degrees_of_freedom = ((se1 + se2) ** 2 /
+                          (se1 ** 2 / (n1 - 1) + se2 ** 2 / (n2 - 1)))
+    return t, degrees_of_freedom, t_p_value(t, degrees_of_freedom)
+
+
+def analyze_counting(alternatives):
+    """analyze_alternatives' analysis of a Counting experiment."""
+    if len(alternatives) != 2:
+        return {"error": "Counting experiments w/ > 2 alternatives can't "
+                "be analyzed yet."}
+
+    result = welch_t_test(alternatives)
+    if result is None:
+        return {"error": "Both alternatives need enough participants w/ "
+                "tracked conversion counts."}
+
+    t, degrees_of_freedom, p = result
+    return {"welch_t": t, "degrees_of_freedom": degrees_of_freedom,
+            "p_value": p}
+
+
+def describe_counting_result_in_words(alternatives):
+    """describe_result_in_words for Counting experiments."""
+
+    if len(alternatives) != 2:
+        return "Sorry, can't currently automatically calculate statistics for Counting experiments with > 2 alternatives."
+
+    result = welch_t_test(alternatives)
+    if result is None:
+        return "Can't calculate statistics until both alternatives have enough participants with tracked conversion counts."
+
+    t, degrees_of_freedom, p = result
+
+    words = ""
+
+    if alternatives[0].participants < 10 or alternatives[1].participants < 10:
+        words += "Take these results with a grain of salt since your samples are so small: "
+
+    best_alternative = max(alternatives, key=lambda alternative: alternative.conversion_rate)
+    worst_alternative = min(alternatives, key=lambda alternative: alternative.conversion_rate)
+
+    words += """The best alternative you have is:[%(best_content)s], which averaged %(best_rate).3f conversions per 
+    participant.  The other alternative was [%(worst_content)s], which averaged %(worst_rate).3f.  """ % {
+                "best_content": best_alternative.content,
+                "best_rate": best_alternative.conversion_rate,
+                "worst_content": worst_alternative.content,
+                "worst_rate": worst_alternative.conversion_rate,
+            }
+
+    if p > 0.05:
+        words += "However, this difference is not statistically significant (Welch's t-test, p = %.3f)." % p
+    else:
+        words += "This difference is statistically significant (Welch's t-test, t = %.2f, p = %.3g)." % (t, p)
+
+    return words
@@ -0,0 +1,90 @@
+import mock
+
+from testutil import gae_model
+
+from . import models
+from . import stats
+
+
+class StatsTest(gae_model.GAEModelTestCase):
+    COUNTS = [[(1000, 100), (1000, 130), (1000, 90)],
+              [(10, 1), (0, 0)],
+              [(5, 7), (5, 1)]]
+
+    def test_chi_square_p_value(self):
+        self.assertAlmostEqual(0.05004, stats.chi_square_p_value(3.84, 1), 4)
+        self.assertAlmostEqual(0.00125, stats.chi_square_p_value(20, 5), 4)
+        self.assertIsNone(stats.chi_square_p_value(1, 0))
+
+    def test_holm_adjust(self):
+        for expected, p_values in [([0.03, 0.04, 0.5], [0.01, 0.02, 0.5]),
+                                   ([0.04, 0.04], [0.02, 0.03])]:
+            for e, adjusted in zip(expected, stats.holm_adjust(p_values)):
+                self.assertAlmostEqual(e, adjusted)
+
+    def test_analyze_counts(self):
+        analysis, no_test, multiple_conversions = stats.analyze_counts(
+                self.COUNTS)
+
+        self.assertAlmostEqual(9.0951, analysis["chi_square"], 4)
+        self.assertAlmostEqual(0.0106, analysis["chi_square_p_value"], 4)
+        self.assertEqual(2, analysis["degrees_of_freedom"])
+        self.assertEqual([(0, 1), (0, 2), (1, 2)],
+                         [pair["alternatives"]
+                          for pair in analysis["pairwise"]])
+        self.assertAlmostEqual(0.0125,
+                               analysis["pairwise"][2]["adjusted_p_value"], 4)
+
+        self.assertIsNone(no_test["chi_square_p_value"])
+        self.assertIn("error", multiple_conversions)
+
+    def test_counting_experiments_get_welch_t_test(self):
+        def alternative(number, conversions, conversions_sq):
+            return mock.Mock(number=number, participants=100,
+                             conversions=conversions,
+                             conversions_sq=conversions_sq)
+
+        # Never more conversions than participants, but still Counting
+        alternatives = [alternative(0, 50, 90), alternative(1, 60, 110)]
+        binomial, counting = stats.analyze_alternatives(
+                [alternatives, alternatives],
+                [models.ConversionTypes.Binary,
+                 models.ConversionTypes.Counting])
+
+        self.assertIn("chi_square", binomial)
+        self.assertNotIn("chi_square", counting)
+        self.assertEqual(stats.welch_t_test(alternatives)[2],
+                         counting["p_value"])
+
+    def test_numpy_and_python_agree(self):
+        if not stats.numpy:
+            self.skipTest("numpy isn't installed")
+
+        with mock.patch.object(stats, "_analyses") as analyses:
+            analyses.get.return_value = None
+            with_numpy = stats.analyze_counts(self.COUNTS)
+            with mock.patch.object(stats, "numpy", None):
+                without_numpy = stats.analyze_counts(self.COUNTS)
+
+        for expected, actual in zip(without_numpy, with_numpy):
+            self.assertEqual(sorted(expected), sorted(actual))
+            for key in ["chi_square", "g_test"]:
+                self.assertAlmostEqual(expected.get(key), actual.get(key))
+
+    def test_welch_t_test(self):
+        def alternative(participants, conversions, conversions_sq):
+            return mock.Mock(participants=participants,
+                             conversions=conversions,
+                             conversions_sq=conversions_sq)
+
+        # 100 participants w/ 0-4 conversions each vs. 100 w/ 1-5 each
+        t, degrees_of_freedom, p = stats.welch_t_test([
+                alternative(100, 200, 20 * (0 + 1 + 4 + 9 + 16)),
+                alternative(100, 300, 20 * (1 + 4 + 9 + 16 + 25))])
+        self.assertAlmostEqual(-5.0, t, 1)
+        self.assertAlmostEqual(198, degrees_of_freedom, 0)
+        self.assertTrue(p < 0.001)
+
+        # Sums of squares that predate tracking them can't be used
+        self.assertIsNone(stats.welch_t_test([alternative(100, 200, 0),
+                                              alternative(100, 300, None)]))
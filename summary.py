@@ -0,0 +1,250 @@
+"""A materialized summary of the dashboard's live experiments.
+
+Building the dashboard's experiment list from the BingoCache means
+deserializing every experiment and alternative, analyzing them, and sorting
+them, and each experiment's summary needs its notes from the datastore. The
+persist coordinator instead builds all of this once per run into a single
+summary document. It's stored in memcache, w/ a copy in the datastore to
+survive evictions, and the experiments and summary API endpoints serve live
+experiments straight from it.
+
+Changes made through the dashboard (controlling experiments, saving notes)
+refresh the summary right away. Counts, including memcache's running counts
+read in one batch, are as of the latest refresh. Until the persist
+coordinator picks up experiments created, deleted or archived since the
+summary was built (see is_current), the experiment list and their summaries
+are built on the spot.
+"""
+import datetime
+import itertools
+import logging
+import zlib
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+from .cache import BingoCache
+from .jsonify import dumps
+from .models import AlternativeView, _GAEBingoDashboardSummary
+from .models import _GAEBingoExperimentNotes
+from .stats import analyze_alternatives
+import bayes
+import pickle_util
+import synchronized_counter
+
+SUMMARY_KEY = "_gae_bingo_dashboard_summary"
+
+# Length of the notes excerpts in the experiment list
+NOTES_EXCERPT_LENGTH = 140
+
+
+def experiments_from_cache(bingo_cache, requesting_archives,
+                           include_running_counts=False):
+    """Retrieve experiments data for consumption via the API.
+
+    Arguments:
+        bingo_cache - the cache where the data is to be retrieved from
+        requesting_archives - whether or not archived experiments should be
+            returned or non-archived experiments
+        include_running_counts - whether experiments' alternatives, and their
+            analyses, should include memcache's running counts. They're all
+            read in one batch, so every count in the results is from the
+            same moment.
+    """
+    experiment_results = {}
+
+    for canonical_name in bingo_cache.experiment_names_by_canonical_name:
+        experiments, alternative_lists = bingo_cache.experiments_and_alternatives_from_canonical_name(canonical_name)
+
+        if not experiments or not alternative_lists:
+            continue
+
+        for experiment, alternatives in itertools.izip(
+                experiments, alternative_lists):
+
+            # Combine related experiments and alternatives into a single
+            # canonical experiment for response
+            if experiment.canonical_name not in experiment_results:
+                experiment.alternatives = alternatives
+                experiment_results[experiment.canonical_name] = experiment
+
+    # Sort by status primarily, then name or date
+    results = experiment_results.values()
+
+    if include_running_counts:
+        counter_keys = AlternativeView.counter_keys(
+                alternative for ex in results
+                for alternative in ex.alternatives)
+        running_counts = synchronized_counter.SynchronizedCounter.get_multi(
+                list(counter_keys))
+        for experiment in results:
+            experiment.alternatives = [
+                    AlternativeView(alternative, running_counts)
+                    for alternative in experiment.alternatives]
+
+    # Analyze every experiment in one batch
+    analyses = analyze_alternatives([ex.alternatives for ex in results],
+                                    [ex.conversion_type for ex in results])
+    summaries = bayes.summarize_experiments(
+            [(ex, ex.alternatives) for ex in results])
+    for experiment, analysis, summary in itertools.izip(
+            results, analyses, summaries):
+        experiment.analysis = analysis
+        experiment.bayesian = summary
+
+    if requesting_archives:
+        results.sort(key=lambda ex: ex.dt_started, reverse=True)
+    else:
+        results.sort(key=lambda ex: ex.pretty_canonical_name)
+
+    results.sort(key=lambda ex: ex.live, reverse=True)
+    return results
+
+
+def summary_context(experiments, experiment_notes):
+    """Summarize the experiments sharing a canonical name, w/ their notes.
+
+    Arguments:
+        experiments - the experiments sharing a canonical name
+        experiment_notes - their _GAEBingoExperimentNotes, or None
+    """
+    context = {}
+    prev = None
+    prev_dict = {}
+
+    if experiment_notes:
+        context["notes"] = experiment_notes.notes
+        context["emotions"] = experiment_notes.emotions
+
+    experiments = sorted(experiments, key=lambda experiment: experiment.conversion_name)
+    for experiment in experiments:
+        if "canonical_name" not in context:
+            context["canonical_name"] = experiment.canonical_name
+
+        if "live" not in context:
+            context["live"] = experiment.live
+
+        if "multiple_experiments" not in context:
+            context["multiple_experiments"] = len(experiments) > 1
+
+        if "experiments" not in context:
+            context["experiments"] = []
+
+        exp_dict = {
+            "conversion_name": experiment.conversion_name,
+            "experiment_name": experiment.name,
+            "pretty_conversion_name": experiment.pretty_conversion_name,
+            "archived": experiment.archived,
+        }
+
+        if prev and prev.conversion_group == experiment.conversion_group:
+            if "conversion_group" not in prev_dict:
+                prev_dict["start_conversion_group"] = True
+                prev_dict["conversion_group"] = prev.conversion_group
+            exp_dict["conversion_group"] = experiment.conversion_group
+        else:
+            if "conversion_group" in prev_dict:
+                prev_dict["end_conversion_group"] = True
+
+        context["experiments"].append(exp_dict)
+        prev_dict = exp_dict
+        prev = experiment
+
+    if "conversion_group" in prev_dict:
+        prev_dict["end_conversion_group"] = True
+
+    return context
+
+
+def build(bingo_cache):
+    """Build the summary document of bingo_cache's live experiments."""
+    results = experiments_from_cache(bingo_cache, False,
+                                     include_running_counts=True)
+
+    experiments_by_canonical_name = dict(
+            (ex.canonical_name, bingo_cache
+                .experiments_and_alternatives_from_canonical_name(
+                    ex.canonical_name)[0])
+            for ex in results)
+
+    # Fetch every canonical experiment's notes in one batch
+    canonical_names = experiments_by_canonical_name.keys()
+    notes_keys = [
+            db.Key.from_path(_GAEBingoExperimentNotes.kind(),
+                _GAEBingoExperimentNotes.key_for_experiment(
+                    experiments_by_canonical_name[name][0]),
+                parent=experiments_by_canonical_name[name][0].key())
+            for name in canonical_names]
+    notes_by_canonical_name = dict(zip(canonical_names, db.get(notes_keys)))
+
+    experiment_results = []
+    for experiment in results:
+        result = dumps(experiment)
+
+        alternatives = result.get("alternatives") or []
+        result["total_participants"] = sum(a["participants"]
+                                           for a in alternatives)
+        result["total_conversions"] = sum(a["conversions"]
+                                          for a in alternatives)
+
+        notes = notes_by_canonical_name.get(experiment.canonical_name)
+        result["notes_excerpt"] = (
+                notes.notes[:NOTES_EXCERPT_LENGTH]
+                if notes and notes.notes else None)
+
+        experiment_results.append(result)
+
+    summaries = dict(
+            (name, dumps(summary_context(experiments_by_canonical_name[name],
+                                         notes_by_canonical_name[name])))
+            for name in canonical_names)
+
+    return {
+        "built": datetime.datetime.utcnow(),
+        "experiment_results": experiment_results,
+        "summaries": summaries,
+    }
+
+
+def refresh(bingo_cache):
+    """Rebuild and store the summary document.
+
+    The BingoCache generation is bumped once it's stored, so ETags tagged
+    before (or while) it was rebuilt don't match the new summary.
+    """
+    summary = build(bingo_cache)
+    compressed = zlib.compress(pickle_util.dump(summary))
+
+    memcache.set(SUMMARY_KEY, compressed)
+    _GAEBingoDashboardSummary(key_name=SUMMARY_KEY,
+                              compressed=compressed).put()
+    BingoCache.bump_generation()
+    return summary
+
+
+def is_current(summary, bingo_cache):
+    """True if summary covers exactly bingo_cache's live canonical experiments.
+    """
+    canonical_names = set(
+            canonical_name for canonical_name, experiment_names
+            in bingo_cache.experiment_names_by_canonical_name.iteritems()
+            if any(name in bingo_cache.experiments
+                   for name in experiment_names))
+    return set(summary["summaries"]) == canonical_names
+
+
+def load():
+    """Return the stored summary document, or None if there isn't one."""
+    compressed = memcache.get(SUMMARY_KEY)
+    if compressed is None:
+        entity = _GAEBingoDashboardSummary.get_by_key_name(SUMMARY_KEY)
+        if not entity:
+            return None
+        compressed = entity.compressed
+        memcache.set(SUMMARY_KEY, compressed)
+
+    try:
+        return pickle_util.load(zlib.decompress(compressed))
+    except Exception, e:
+        logging.warning("Failed to load gae/bingo dashboard summary: %s" % e)
+        return None
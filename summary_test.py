@@ -0,0 +1,51 @@
+from google.appengine.api import memcache
+
+from testutil import gae_model
+
+from . import cache
+from . import models
+from . import summary
+
+
+class SummaryTest(gae_model.GAEModelTestCase):
+    def test_refresh_and_load(self):
+        bingo_cache = cache.BingoCache()
+        experiment, alternatives = models.create_experiment_and_alternatives(
+                "monkeys", "monkeys")
+        bingo_cache.add_experiment(experiment, alternatives)
+        bingo_cache.persist_to_datastore()
+        models._GAEBingoExperimentNotes.save(experiment, "x" * 500, ["happy"])
+
+        generation = cache.BingoCache.generation()
+        summary.refresh(bingo_cache)
+        # ETags of the old summary no longer match
+        self.assertNotEqual(generation, cache.BingoCache.generation())
+
+        # Served from memcache, or from the datastore once evicted
+        for evict in [False, True]:
+            if evict:
+                memcache.delete(summary.SUMMARY_KEY)
+            stored = summary.load()
+
+            result, = stored["experiment_results"]
+            self.assertEqual("monkeys", result["canonical_name"])
+            self.assertEqual(0, result["total_participants"])
+            self.assertEqual(summary.NOTES_EXCERPT_LENGTH,
+                             len(result["notes_excerpt"]))
+
+            monkeys = stored["summaries"]["monkeys"]
+            self.assertEqual(["happy"], monkeys["emotions"])
+            self.assertEqual(["monkeys"], [e["experiment_name"]
+                                           for e in monkeys["experiments"]])
+
+    def test_is_current(self):
+        bingo_cache = cache.BingoCache()
+        bingo_cache.add_experiment(*models.create_experiment_and_alternatives(
+                "monkeys", "monkeys"))
+        stored = summary.build(bingo_cache)
+        self.assertTrue(summary.is_current(stored, bingo_cache))
+
+        # Experiments created since the summary was built aren't in it
+        bingo_cache.add_experiment(*models.create_experiment_and_alternatives(
+                "gorillas", "gorillas"))
+        self.assertFalse(summary.is_current(stored, bingo_cache))
@@ -101,6 +101,23 @@ class SynchronizedCounter(object):
         # Return the single counter value for the n'th counter
         return SynchronizedCounter._single_counter_value(combined_count, number)
 
+    @staticmethod
+    def get_multi(keys):
+        """Return values of all counters in many combinations w/ one get.
+
+        Args:
+            keys: names of the counter combinations
+        Returns:
+            dict of each key to a list of its combination's counter values,
+            indexed by counter number
+        """
+        combined_counts = memcache.get_multi(keys)
+        return dict(
+                (key, [SynchronizedCounter._single_counter_value(
+                           long(combined_counts.get(key) or 0), number)
+                       for number in range(COUNTERS_PER_COMBINATION)])
+                for key in keys)
+
     @staticmethod
     def _single_counter_value(combined_count, number):
         """Return the n'th counter value from the combination's total value.
@@ -122,13 +139,16 @@ class SynchronizedCounter(object):
 
     @staticmethod
     @ndb.tasklet
-    def incr_async(key, number, delta=1):
+    def incr_async(key, number, delta=1, on_high_value=None):
         """Increment the n'th counter in key's counter combination.
         
         Args:
             key: name of the counter combination
             number: n'th counter value being incremented
             delta: amount to increment by
+            on_high_value: optional function called with key whenever this
+                increment leaves the counter above WARNING_HIGH_COUNTER_VALUE,
+                so client code can pop the combination before it rolls over.
         """
         if not (0 <= number < COUNTERS_PER_COMBINATION):
             raise ValueError("Invalid counter number.")
@@ -173,6 +193,8 @@ class SynchronizedCounter(object):
         elif count > WARNING_HIGH_COUNTER_VALUE:
             logging.warning("SynchronizedCounter %s approaching max value" %
                     key)
+            if on_high_value:
+                on_high_value(key)
 
         raise ndb.Return(True)
 
@@ -118,6 +118,32 @@ class SynchronizedCounterTest(gae_model.GAEModelTestCase):
         self.assert_counter_value("giraffe", 0, 0)
         self.assert_counter_value("giraffe", 2, 0)
 
+    def test_high_value_callback(self):
+        warning_value = synchronized_counter.WARNING_HIGH_COUNTER_VALUE
+        on_high_value = mock.Mock()
+
+        def incr(delta=1):
+            future = synchronized_counter.SynchronizedCounter.incr_async(
+                    "otters", 2, delta=delta, on_high_value=on_high_value)
+            self.assertTrue(future.get_result())
+
+        # Reaching (but not passing) the warning value is fine...
+        incr(warning_value)
+        self.assertEquals(0, on_high_value.call_count)
+
+        # ...but every increment past it should ask for the counters to be
+        # popped.
+        with mock.patch('logging.warning'):
+            incr()
+            incr()
+        self.assertEquals(2, on_high_value.call_count)
+        on_high_value.assert_called_with("otters")
+
+        # Once popped, the counter is back to normal.
+        self.pop_counters(["otters"])
+        incr()
+        self.assertEquals(2, on_high_value.call_count)
+
     def test_invalid_input(self):
         def negative_delta():
             self.sync_incr("chimps", 1, delta=-1)